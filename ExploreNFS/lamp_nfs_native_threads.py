@@ -8,14 +8,20 @@
 
 from ipaddress import ip_address, ip_network, IPv4Network, IPv6Network, IPv4Address, IPv6Address
 import collections
+import itertools
 from string import printable
 import concurrent.futures
 import struct
 import socket
+import errno
 import time
 from random import randint
 import datetime
-from json import dumps
+import threading
+import queue
+import sqlite3
+from os.path import join as join_path, expanduser
+from json import dumps, loads
 
 try:
     from ontology import (
@@ -26,33 +32,62 @@ except ImportError as ontology_exception:
     print('...missing or invalid ontology')
     raise ontology_exception
 
+NFS_CACHE_PATH = join_path(expanduser('~'), 'lampyre_nfs_cache.sqlite')
+# IPv6 networks larger than this are not expanded (/120), use hitlist with addresses instead
+IPV6_EXPAND_LIMIT = 256
+# seconds between checks of stop of crawler, while queue of rows is full
+STOP_CHECK_INTERVAL = 0.5
+
+
+def address_family(host):
+    try:
+        return socket.AF_INET6 if ip_address(host).version == 6 else socket.AF_INET
+    except ValueError:
+        # hostname - family of first resolved address
+        try:
+            return socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)[0][0]
+        except socket.gaierror:
+            return socket.AF_INET
+
+
 class RPC(object):
+    # call headers built once: (program, version, procedure, message type, rpc version, auth) -> bytes
+    templates = {}
+
     def __init__(self, host, port, timeout):
         self.host = host
         self.port = port
         self.timeout = timeout
         self.client = None
-
-    def request(self, program, program_version, procedure, data=None, message_type=0, version=2, auth=None):
-
-        rpc_XID  = int(time.time())
-        rpc_message_type = message_type # 0=call
-        rpc_RPC_version = version
-        rpc_program = program
-        rpc_program_version = program_version
-        rpc_procedure = procedure
+        self.xid = randint(0, 0xffffffff)
+        # per connection copies of templates, only XID and record mark are patched
+        self.buffers = {}
+
+    @staticmethod
+    def auth_key(auth):
+        if auth == None:
+            return None
+        return auth["flavor"], auth["machine_name"], auth["uid"], auth["gid"], tuple(auth["aux_gid"])
+
+    @classmethod
+    def template(cls, program, program_version, procedure, message_type, version, auth):
+        """
+        record mark + RPC call header + credentials + verifier,
+        record mark and XID are zero
+        """
         rpc_Verifier_Flavor = 0  # AUTH_NULL
         rpc_Verifier_Length = 0
 
         proto = struct.pack(
-            # Remote Procedure Call
-            '!LLLLLL',
-            rpc_XID,
-            rpc_message_type,
-            rpc_RPC_version,
-            rpc_program,
-            rpc_program_version,
-            rpc_procedure,
+            # Record mark, Remote Procedure Call
+            '!LLLLLLL',
+            0,
+            0,
+            message_type,
+            version,
+            program,
+            program_version,
+            procedure,
         )
 
         if auth == None: # AUTH_NULL
@@ -62,7 +97,6 @@ class RPC(object):
                 0,
             )
         elif auth["flavor"] == 1: # AUTH_UNIX
-            stamp = int(time.time())
             stamp = int(time.time()) & 0xffff
             auth_data = struct.pack(
                     "!LL",
@@ -98,16 +132,29 @@ class RPC(object):
             rpc_Verifier_Flavor,
             rpc_Verifier_Length,
         )
+        return proto
 
+    def request(self, program, program_version, procedure, data=None, message_type=0, version=2, auth=None):
+        key = (program, program_version, procedure, message_type, version, self.auth_key(auth))
+        proto = self.buffers.get(key)
+        if proto is None:
+            template = self.templates.get(key)
+            if template is None:
+                template = self.templates[key] = self.template(program, program_version, procedure,
+                                                               message_type, version, auth)
+            proto = self.buffers[key] = bytearray(template)
+
+        self.xid = (self.xid + 1) & 0xffffffff
+        length = len(proto) - 4
         if data != None:
-            proto += data
-
-        rpc_fragment_header = 0x80000000 + len(proto)
-
-        proto = struct.pack('!L', rpc_fragment_header) + proto
+            length += len(data)
+        struct.pack_into('!LL', proto, 0, 0x80000000 + length, self.xid)
 
         try:
-            self.client.send(proto)
+            if data != None:
+                self.send(proto, data)
+            else:
+                self.send(proto)
 
             last_fragment = False
             data = b""
@@ -142,45 +189,71 @@ class RPC(object):
 
         return data
 
-    def connect(self):
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.settimeout(self.timeout)
-        # if we are running as root, use a source port between 500 and 1024 (NFS security options...)
-        try:
-            binded = False
-            while not binded:
-                try:
-                    random_port = randint(500, 1024)
-                    self.client.bind(('',random_port))
-                    binded = True
-                except OSError as e:
-                    if "Permission denied" in str(e):
-                        break
-        except PermissionError as e:
-            pass
+    def connect(self, attempts=8):
+        for attempt in range(attempts):
+            family = address_family(self.host)
+            self.client = socket.socket(family, socket.SOCK_STREAM)
+            self.client.settimeout(self.timeout)
+            # if we are running as root, use a source port between 500 and 1024 (NFS security options...)
+            # SO_REUSEADDR - ports in TIME_WAIT after previous hosts can be used again
+            self.client.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                binded = False
+                tries = 0
+                while not binded and tries < 64:
+                    tries += 1
+                    try:
+                        random_port = randint(500, 1024)
+                        self.client.bind(('::' if family == socket.AF_INET6 else '', random_port))
+                        binded = True
+                    except OSError as e:
+                        if "Permission denied" in str(e):
+                            break
+            except PermissionError as e:
+                pass
 
-        self.client.connect((self.host, self.port))
+            try:
+                self.client.connect((self.host, self.port))
+                return
+            except OSError as e:
+                self.client.close()
+                # source port is used by other connection to the same host - try another one
+                if e.errno not in (errno.EADDRINUSE, errno.EADDRNOTAVAIL) or attempt == attempts - 1:
+                    raise
 
     def disconnect(self):
         self.client.close()
 
+    def send(self, *buffers):
+        # scatter/gather, header and payload are not concatenated
+        if hasattr(self.client, 'sendmsg'):
+            sent = self.client.sendmsg(buffers)
+            if sent < sum(map(len, buffers)):
+                self.client.sendall(b''.join(buffers)[sent:])
+        else:
+            self.client.sendall(b''.join(buffers))
+
     def recv(self):
         rpc_response = None
 
         rpc_response_size = b""
         while len(rpc_response_size) != 4:
-            rpc_response_size = self.client.recv(4)
+            chunk = self.client.recv(4 - len(rpc_response_size))
+            if not chunk:
+                raise RPCProtocolError("incorrect recv response size: %d" % len(rpc_response_size))
+            rpc_response_size += chunk
 
-        if len(rpc_response_size) != 4:
-            raise RPCProtocolError("incorrect recv response size: %d" % len(rpc_response_size))
         response_size = struct.unpack('!L', rpc_response_size)[0] & 0x7fffffff
 
         if response_size > 0x00010000: # len too high, propably an error
             raise RPCProtocolError("response_size > 0x00010000: %d" % response_size)
 
         rpc_response = rpc_response_size
-        while len(rpc_response) < response_size:
-            rpc_response = rpc_response + self.client.recv(response_size-len(rpc_response)+4)
+        while len(rpc_response) < response_size + 4:
+            chunk = self.client.recv(response_size-len(rpc_response)+4)
+            if not chunk:
+                raise RPCProtocolError("connection closed")
+            rpc_response = rpc_response + chunk
 
         return rpc_response
 
@@ -320,7 +393,7 @@ class NFS(RPC):
             attributes = data[:84]
             data = data[84:]
 
-            (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLL', attributes[:24])
+            (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLQ', attributes[:28])
             # File types:
             # 1: Regular file
             # 2: Directory
@@ -361,7 +434,7 @@ class NFS(RPC):
             attributes = data[:84]
             data = data[84:]
 
-            (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLL', attributes[:24])
+            (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLQ', attributes[:28])
             # File types:
             # 1: Regular file
             # 2: Directory
@@ -380,9 +453,10 @@ class NFS(RPC):
         data = data[(4-file_len % 4)%4:]
 
         if len(file_data) != count:
-            raise Exception("File size mismatch")
+            raise RPCProtocolError("File size mismatch")
 
-        if EOF == 0:
+        # empty chunk without EOF - server does not move forward
+        if EOF == 0 and file_data:
             file_data += self.read(file_handle, auth=auth, offset=offset+len(file_data))
 
         return file_data
@@ -392,93 +466,105 @@ class NFS(RPC):
         if type(dir_handle) != bytes:
             raise Exception("file_id should be bytes")
 
-        procedure = 17 # Export
+        procedure = 17 # ReaddirPlus
 
         dircount = 4096
         maxcount = dircount*8
 
-        data = struct.pack('!L', len(dir_handle))
-        data += dir_handle
-        data += struct.pack('!Q', cookie)
-        data += struct.pack('!QLL', 0, dircount, maxcount)
-
-        data = super(NFS, self).request(self.program, self.program_version, procedure, data=data, auth=auth)
-
-        nfs_status = struct.unpack('!L', data[:4])[0]
-        data = data[4:]
-
-        if nfs_status != 0:
-            raise NFSAccessError("Error: %d" % nfs_status)
-
-        dir_attributes = data[:88]
-        data = data[88:]
-
-        opaque_data = data[:8]
-        data = data[8:]
-
         contents = []
-        last_cookie = 0
-
-        value_follows = data[:4]
-        data = data[4:]
-        while value_follows == b'\x00\x00\x00\x01':
-            file_id = struct.unpack("!Q", data[:8])[0]
-            data = data[8:]
-
-            name_len = struct.unpack("!L", data[:4])[0]
+        last_cookie = cookie
+        cookie_verifier = b'\x00'*8
+        EOF = b'\x00\x00\x00\x00'
+
+        # reply is paged: ask again from last cookie until EOF
+        while EOF == b'\x00\x00\x00\x00':
+            data = struct.pack('!L', len(dir_handle))
+            data += dir_handle
+            data += b'\x00'*((4-len(dir_handle) % 4)%4)
+            data += struct.pack('!Q', cookie)
+            data += cookie_verifier
+            data += struct.pack('!LL', dircount, maxcount)
+
+            data = super(NFS, self).request(self.program, self.program_version, procedure, data=data, auth=auth)
+
+            nfs_status = struct.unpack('!L', data[:4])[0]
             data = data[4:]
 
-            name = data[:name_len].decode()
-            data = data[name_len:]
-            data = data[(4-name_len % 4)%4:]
+            if nfs_status != 0:
+                raise NFSAccessError("Error: %d" % nfs_status)
 
-            cookie = struct.unpack("!Q", data[:8])[0]
-            last_cookie = cookie
+            if data[:4] == b'\x00\x00\x00\x01':
+                dir_attributes = data[4:88]
+                data = data[88:]
+            else:
+                data = data[4:]
+
+            cookie_verifier = data[:8]
             data = data[8:]
 
+            entries = 0
             value_follows = data[:4]
             data = data[4:]
+            while value_follows == b'\x00\x00\x00\x01':
+                file_id = struct.unpack("!Q", data[:8])[0]
+                data = data[8:]
 
-            if value_follows == b'\x00\x00\x00\x01':
-                attributes = data[:84]
-                data = data[84:]
+                name_len = struct.unpack("!L", data[:4])[0]
+                data = data[4:]
 
-                (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLL', attributes[:24])
-                # File types:
-                # 1: Regular file
-                # 2: Directory
-                # 5: Symbolic link
-            else:
-                file_type = None
-                file_size = None
+                name = data[:name_len].decode(errors='replace')
+                data = data[name_len:]
+                data = data[(4-name_len % 4)%4:]
 
-            handle_value_follows = data[:4]
-            data = data[4:]
+                cookie = struct.unpack("!Q", data[:8])[0]
+                data = data[8:]
 
-            if handle_value_follows == b'\x00\x00\x00\x01':
-                len_file_handle = struct.unpack('!L', data[:4])[0]
+                value_follows = data[:4]
                 data = data[4:]
-                file_handle = data[:len_file_handle]
-                data = data[len_file_handle:]
-            else:
-                file_handle = None
 
-            contents.append({
-                "name": name,
-                "file_type": file_type,
-                "cookie": cookie,
-                "file_id": file_id,
-                "file_handle": file_handle,
-                "file_size": file_size,
-            })
+                if value_follows == b'\x00\x00\x00\x01':
+                    attributes = data[:84]
+                    data = data[84:]
 
-            value_follows = data[:4]
-            data = data[4:]
+                    (file_type, mode, ulink, uid, gid, file_size) = struct.unpack('!LLLLLQ', attributes[:28])
+                    # File types:
+                    # 1: Regular file
+                    # 2: Directory
+                    # 5: Symbolic link
+                else:
+                    file_type = None
+                    file_size = None
+
+                handle_value_follows = data[:4]
+                data = data[4:]
 
-        EOF = data[:4]
+                if handle_value_follows == b'\x00\x00\x00\x01':
+                    len_file_handle = struct.unpack('!L', data[:4])[0]
+                    data = data[4:]
+                    file_handle = data[:len_file_handle]
+                    data = data[len_file_handle:]
+                    data = data[(4-len_file_handle % 4)%4:]
+                else:
+                    file_handle = None
+
+                contents.append({
+                    "name": name,
+                    "file_type": file_type,
+                    "cookie": cookie,
+                    "file_id": file_id,
+                    "file_handle": file_handle,
+                    "file_size": file_size,
+                })
+                entries += 1
+
+                value_follows = data[:4]
+                data = data[4:]
 
-        if EOF == b'\x00\x00\x00\x00':
-            self.readdirplus(dir_handle, cookie=last_cookie, auth=auth)
+            EOF = data[:4]
+            # server does not move forward - stop
+            if entries == 0 or cookie == last_cookie:
+                break
+            last_cookie = cookie
 
         return contents
 
@@ -522,6 +608,7 @@ class Mount(RPC):
         data = data[4:]
         file_handle = data[:len_file_handle]
         data = data[len_file_handle:]
+        data = data[(4-len_file_handle % 4)%4:]
 
         flavors = []
         flavors_nb = struct.unpack('!L', data[:4])[0]
@@ -594,13 +681,117 @@ class Mount(RPC):
         return exports
 
 
-def showmount(host, port, timeout):
+class NFSCache(object):
+    """
+    persistent (sqlite) cache of portmap GETPORT and mountd EXPORT answers,
+    key - (host, port, program); hosts without answer (dead, without mountd, export failed) are stored too,
+    they are not probed again while record is fresh
+    """
+    modes = ['use cache', 'refresh', 'cache only']
+
+    def __init__(self, path, ttl, mode='use cache'):
+        """
+        :param path: sqlite file
+        :param ttl: time to live of record, seconds
+        :param mode: one of NFSCache.modes
+        """
+        if mode not in self.modes:
+            raise Exception("unknown cache mode: %s" % mode)
+        self.ttl = ttl
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS rpc_cache ('
+                'host TEXT, port INTEGER, program INTEGER, kind TEXT, value TEXT, created REAL, '
+                'PRIMARY KEY (host, port, program, kind))')
+
+    @property
+    def read_enabled(self):
+        return self.mode != 'refresh'
+
+    @property
+    def probe_enabled(self):
+        return self.mode != 'cache only'
+
+    def record(self, host, port, program, kind):
+        """
+        :return: fresh (value, created) or None
+        """
+        if not self.read_enabled:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value, created FROM rpc_cache WHERE host=? AND port=? AND program=? AND kind=?',
+                (host, port, program, kind)).fetchone()
+        if row and time.time() - row[1] <= self.ttl:
+            return loads(row[0]), row[1]
+
+    def get(self, host, port, program, kind):
+        row = self.record(host, port, program, kind)
+        if row:
+            return row[0]
+
+    def put(self, host, port, program, kind, value):
+        if not self.probe_enabled:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO rpc_cache (host, port, program, kind, value, created) VALUES (?,?,?,?,?,?)',
+                (host, port, program, kind, dumps(value), time.time()))
+
+    def getport(self, host, port, program):
+        return self.get(host, port, program, 'getport')
+
+    def exports(self, host, port):
+        """
+        :param port: portmap port
+        :return: cached exports of host or None
+        """
+        return self.lookup(host, port)[1]
+
+    def lookup(self, host, port):
+        """
+        :param port: portmap port
+        :return: (True, exports) - fresh answer of host, exports is None - host was not available;
+                 (False, None) - host has to be probed
+        """
+        unavailable = self.record(host, port, Mount.program, 'unavailable')
+        mount_port = self.getport(host, port, Mount.program)
+        exports = self.record(host, mount_port, Mount.program, 'export') if mount_port is not None else None
+        if exports and (not unavailable or exports[1] >= unavailable[1]):
+            return True, exports[0]
+        return bool(unavailable), None
+
+    def mark_unavailable(self, host, port):
+        """
+        host is dead, without mountd or export failed
+        :param port: portmap port
+        """
+        self.put(host, port, Mount.program, 'unavailable', True)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def showmount(host, port, timeout, cache=None, cached=None):
+    """
+    :param cached: result of cache.lookup, if it is known
+    """
+    if cache:
+        found, exports = cached or cache.lookup(host, port)
+        if found or not cache.probe_enabled:
+            return exports
     try:
         portmap = Portmap(host, port, timeout)
         portmap.connect()
-        port = portmap.getport(Mount.program, Mount.program_version)
+        mount_port = portmap.getport(Mount.program, Mount.program_version)
+        if cache:
+            cache.put(host, port, Mount.program, 'getport', mount_port)
 
-        mount = Mount(host, port, timeout)
+        mount = Mount(host, mount_port, timeout)
         mount.connect()
         check = False
         try:
@@ -613,9 +804,198 @@ def showmount(host, port, timeout):
         if check:
             mount.disconnect()
             portmap.disconnect()
+            if cache:
+                cache.put(host, mount_port, Mount.program, 'export', exports)
             return exports
     except:
         pass
+    if cache:
+        cache.mark_unavailable(host, port)
+
+
+def return_rpc_port(host, port, timeout, program, program_version, cache=None):
+    if cache:
+        rpc_port = cache.getport(host, port, program)
+        if rpc_port is not None:
+            return rpc_port
+    portmap = Portmap(host, port, timeout)
+    portmap.connect()
+    try:
+        rpc_port = portmap.getport(program, program_version)
+    finally:
+        portmap.disconnect()
+    if cache:
+        cache.put(host, port, program, 'getport', rpc_port)
+    return rpc_port
+
+
+class NFSCrawler(object):
+    """
+    mounts exports with AUTH_UNIX and walks directories,
+    one bounded work queue for all hosts and exports.
+    Row: host, export, path, type, size
+    """
+    file_types = {1: 'file', 2: 'directory', 3: 'block device', 4: 'character device',
+                  5: 'symbolic link', 6: 'socket', 7: 'fifo'}
+
+    def __init__(self, timeout, auth, depth, workers=8, queue_size=4096, cache=None, connections=4, port=111):
+        """
+        :param auth: AUTH_UNIX credentials, see RPC.request
+        :param depth: 1 - only root of export
+        :param queue_size: max. directories waiting in queue, when full - directory is walked by current worker
+        :param connections: max. open connections per worker
+        :param port: portmap port
+        """
+        self.port = port
+        self.timeout = timeout
+        self.auth = auth
+        self.depth = depth
+        self.workers = workers
+        self.cache = cache
+        self.connections = connections
+        self.tasks = queue.Queue(maxsize=queue_size)
+        self.rows = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pending = 0
+        # consumer stopped reading rows - threads skip the rest of tasks
+        self.stopped = threading.Event()
+
+    def walk(self, exports):
+        """
+        :param exports: iterable of (host, export path)
+        :return: generator of rows
+        """
+        self.pending = 1  # held by feeder
+        threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(self.workers)]
+        threads.append(threading.Thread(target=self.feeder, args=(exports,), daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            row = self.rows.get()
+            while row is not None:
+                yield row
+                row = self.rows.get()
+        finally:
+            self.stopped.set()
+
+    def feeder(self, exports):
+        try:
+            for host, export in exports:
+                if self.stopped.is_set():
+                    break
+                self.submit(('mount', host, export))
+            self.done()
+        finally:
+            # clients of tasks walked in place by feeder
+            self.disconnect()
+
+    def worker(self):
+        task = self.tasks.get()
+        while task is not None:
+            self.process(task)
+            task = self.tasks.get()
+        self.disconnect()
+
+    def disconnect(self):
+        for client in self.local.__dict__.pop('clients', {}).values():
+            client.disconnect()
+
+    def put_row(self, row):
+        """
+        put with timeout - thread is not blocked forever, when consumer stopped
+        :return: False - consumer stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                self.rows.put(row, timeout=STOP_CHECK_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def submit(self, task):
+        if self.stopped.is_set():
+            return
+        with self.lock:
+            self.pending += 1
+        try:
+            self.tasks.put_nowait(task)
+        except queue.Full:
+            # queue is full - walk in place
+            self.process(task)
+
+    def done(self):
+        with self.lock:
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            for _ in range(self.workers):
+                self.tasks.put(None)
+            self.put_row(None)
+
+    def client(self, host, rpc_class):
+        clients = self.local.__dict__.setdefault('clients', collections.OrderedDict())
+        key = (host, rpc_class.program)
+        if key in clients:
+            clients.move_to_end(key)
+            return clients[key]
+        port = return_rpc_port(host, self.port, self.timeout, rpc_class.program, rpc_class.program_version, self.cache)
+        client = rpc_class(host, port, self.timeout)
+        client.connect()
+        clients[key] = client
+        while len(clients) > self.connections:
+            _, old_client = clients.popitem(last=False)
+            old_client.disconnect()
+        return client
+
+    def drop(self, host):
+        clients = self.local.__dict__.get('clients', {})
+        for key in [key for key in clients if key[0] == host]:
+            clients.pop(key).disconnect()
+
+    def call(self, host, rpc_class, method, *args, **kwargs):
+        try:
+            return getattr(self.client(host, rpc_class), method)(*args, **kwargs)
+        except (OSError, struct.error):
+            # connection is broken - once more with new one
+            self.drop(host)
+            return getattr(self.client(host, rpc_class), method)(*args, **kwargs)
+
+    def process(self, task):
+        host = task[1]
+        try:
+            if self.stopped.is_set():
+                pass
+            elif task[0] == 'mount':
+                _, host, export = task
+                file_handle = self.call(host, Mount, 'mnt', export, auth=self.auth)["file_handle"]
+                self.submit(('dir', host, export, file_handle, '', 1))
+            else:
+                _, host, export, dir_handle, path, depth = task
+                for item in self.call(host, NFS, 'readdirplus', dir_handle, auth=self.auth):
+                    if item["name"] in ('.', '..'):
+                        continue
+                    file_path = f'{path}/{item["name"]}'
+                    if not self.put_row({'host_query': host,
+                                         'shared_path': export,
+                                         'file_path': file_path,
+                                         'file_type': self.file_types.get(item["file_type"], ''),
+                                         'file_size': item["file_size"]}):
+                        break
+                    if item["file_type"] == 2 and depth < self.depth:
+                        file_handle = item["file_handle"]
+                        if not file_handle:
+                            file_handle = self.call(host, NFS, 'lookup', dir_handle, item["name"],
+                                                    auth=self.auth)["file_handle"]
+                        self.submit(('dir', host, export, file_handle, file_path, depth + 1))
+        except (OSError, struct.error):
+            self.drop(host)
+        except Exception:
+            # access errors etc.
+            pass
+        finally:
+            self.done()
 
 
 def reparse_record_from_exports(record_host, unpack_network):
@@ -674,15 +1054,22 @@ def reparse_record_from_exports(record_host, unpack_network):
     return result
 
 
-def process_get_nfs(host, port, unpack_network, timeout, actions, uid, gid, auth_hostname, recurse, lg):
+def process_get_nfs(host, port, unpack_network, timeout, actions, uid, gid, auth_hostname, recurse, lg, cache=None):
+    cached = cache.lookup(host, port) if cache else None
     try:
-        portmap = Portmap(host, 111, timeout)
-        portmap.connect()
-        res = portmap.null()
-        portmap.disconnect()
+        if cache and (cached[0] or not cache.probe_enabled):
+            # answer (or nothing) from cache, host is not probed
+            res = cached[1] is not None
+        else:
+            portmap = Portmap(host, port, timeout)
+            portmap.connect()
+            res = portmap.null()
+            portmap.disconnect()
+            if not res and cache:
+                cache.mark_unavailable(host, port)
         if res:
             if "list_mounts" in actions:
-                iter_shomount = showmount(host, port, timeout)
+                iter_shomount = showmount(host, port, timeout, cache, cached)
                 if iter_shomount:
                     for item in iter_shomount:
                         current_day = datetime.datetime.now().replace(microsecond=0)
@@ -696,16 +1083,22 @@ def process_get_nfs(host, port, unpack_network, timeout, actions, uid, gid, auth
                                 yield _result
 
     except OSError:
-        pass
+        if cache and not cached[0]:
+            cache.mark_unavailable(host, port)
     except Exception as e:
         print("%s:%d Exception %s:%s" % (host, port, type(e), e))
         # raise e
 
 
+def process_get_nfs_rows(*args):
+    # process_get_nfs is generator - run it in worker, not in consumer
+    return list(process_get_nfs(*args))
+
+
 # ---- change Insurgent2018
 def is_open_port(ip_port, GLOBAL_TIMEOUT_CHECK=3):
     ip, port = ip_port
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s = socket.socket(address_family(ip), socket.SOCK_STREAM)
     s.settimeout(GLOBAL_TIMEOUT_CHECK)
     try:
         s.connect((ip, int(port)))
@@ -713,6 +1106,8 @@ def is_open_port(ip_port, GLOBAL_TIMEOUT_CHECK=3):
         return True
     except:
         return False
+    finally:
+        s.close()
 
 
 def reparse_ip_hosts(hosts):
@@ -728,7 +1123,9 @@ def reparse_ip_hosts(hosts):
         _tmp = None
         if '/' in host:
             try:
-                _tmp = list(map(str, ip_network(host)))
+                network = ip_network(host)
+                if network.version == 4 or network.num_addresses <= IPV6_EXPAND_LIMIT:
+                    _tmp = list(map(str, network))
             except ValueError:
                 pass
         else:
@@ -742,34 +1139,88 @@ def reparse_ip_hosts(hosts):
 
 
 # scans for open ports, # like ping
-def async_check_hosts_ports(list_ip_port, lg, timeout=3, threads=256):
+def async_check_hosts_ports(list_ip_port, lg, timeout=3, threads=256, closed=None):
+    # not more than window checks in flight - list_ip_port can be long stream (hitlist)
+    # closed - function, called with (ip, port), which is not open
+    window = threads * 4
     with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-        future_rows = {executor.submit(is_open_port, host_port, timeout):
-                           host_port for host_port in list_ip_port}
-        for future in concurrent.futures.as_completed(future_rows):
-            server_try = future_rows[future]
-            result = future.result()
-            if result:
-                lg.info(f'online: {server_try}')
-                yield server_try
-
-
-def return_list_ip(in_ips, lg):  # list
+        future_rows = {}
+        list_ip_port = iter(list_ip_port)
+        while True:
+            for host_port in list_ip_port:
+                future_rows[executor.submit(is_open_port, host_port, timeout)] = host_port
+                if len(future_rows) >= window:
+                    break
+            if not future_rows:
+                break
+            finished, _ = concurrent.futures.wait(future_rows, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                server_try = future_rows.pop(future)
+                result = future.result()
+                if result:
+                    lg.info(f'online: {server_try}')
+                    yield server_try
+                elif closed:
+                    closed(server_try)
+
+
+def return_ips(in_ips):  # list
     ips = []
     for input_ip in set(map(lambda z: z.strip(), in_ips)):
         ips.extend(reparse_ip_hosts(input_ip))
-    ports = [111, 2049]
-    targets = ((ip, port) for ip in ips for port in ports)
-    need_ips = async_check_hosts_ports(targets, lg)  # like ping
-    return need_ips
+    return ips
 
 
-def main_scan(in_ips, lg):  # list
-    current_targets = (ip for ip, port in return_list_ip(in_ips, lg))
-    return current_targets
+def read_hitlist(path):
+    """
+    Addresses (IPv4 or IPv6, one per line) from file; networks are expanded like in IP parameter.
+    File is read line by line, so hitlist can be larger than memory
+    """
+    with open(path, encoding='utf-8', errors='replace') as hitlist:
+        for line in hitlist:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                yield from reparse_ip_hosts(line)
 
 
-def main_nfs(targets, unpack_network, log_writer, _timeout=10, workers=32):
+SCAN_PORTS = [111, 2049]
+
+
+def return_list_ip(ips, lg, closed=None):  # iterable
+    ports = SCAN_PORTS
+    targets = ((ip, port) for ip in ips for port in ports)
+    need_ips = async_check_hosts_ports(targets, lg, closed=closed)  # like ping
+    return need_ips
+
+
+def main_scan(ips, lg, cache=None):  # iterable of addresses
+    """
+    :param cache: NFSCache - hosts with all ports closed are stored as unavailable
+    """
+    if cache is None:
+        return (ip for ip, port in return_list_ip(ips, lg))
+    online = set()
+    # ip -> count of closed ports, while other ports are checked
+    closed_ports = {}
+
+    def closed(ip_port):
+        ip = ip_port[0]
+        if ip in online:
+            return
+        closed_ports[ip] = closed_ports.get(ip, 0) + 1
+        if closed_ports[ip] == len(SCAN_PORTS):
+            del closed_ports[ip]
+            cache.mark_unavailable(ip, 111)
+
+    def current_targets():
+        for ip, port in return_list_ip(ips, lg, closed):
+            online.add(ip)
+            closed_ports.pop(ip, None)
+            yield ip
+    return current_targets()
+
+
+def main_nfs(targets, unpack_network, log_writer, _timeout=10, workers=32, cache=None):
     # set default values
     port = 111
     timeout = _timeout
@@ -783,14 +1234,14 @@ def main_nfs(targets, unpack_network, log_writer, _timeout=10, workers=32):
     log_writer.info(f'all targets:{c_targets}')
     results = []
     with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        future_rows = {executor.submit(process_get_nfs, ip, port,  unpack_network, timeout, actions, uid, gid, hostname, recurse, log_writer):
+        future_rows = {executor.submit(process_get_nfs_rows, ip, port,  unpack_network, timeout, actions, uid, gid, hostname, recurse, log_writer, cache):
                            ip for ip in targets}
 
         for future in concurrent.futures.as_completed(future_rows):
             ip = future_rows[future]
             result = future.result()
-            if result:
-                _tmp = [line for line in result]
+            if result is not None:
+                _tmp = result
                 results.extend(_tmp)
                 if len(_tmp) > 0:
                     log_writer.info(f'{i} from({c_targets}). done host:{ip}')
@@ -800,6 +1251,22 @@ def main_nfs(targets, unpack_network, log_writer, _timeout=10, workers=32):
     return results
 
 
+def main_walk(exports, log_writer, _timeout=10, workers=32, uid=0, gid=0, hostname='nfsclient', recurse=1,
+              cache=None, port=111):
+    """
+    :param exports: iterable of (host, export path)
+    :param recurse: depth of walk
+    """
+    auth = {"flavor": 1, "machine_name": hostname, "uid": uid, "gid": gid, "aux_gid": [gid]}
+    crawler = NFSCrawler(_timeout, auth, recurse, workers=workers, cache=cache, port=port)
+    i = 0
+    start = time.time()
+    for row in crawler.walk(exports):
+        i += 1
+        yield row
+    log_writer.info(f'walked entries:{i}, {i / max(time.time() - start, 0.001):.0f} per sec.')
+
+
 def not_empty(field: Field):
     return Condition(field, Operations.NotEqual, '')
 
@@ -818,6 +1285,16 @@ class NFSHeader(metaclass=Header):
     status = Field('raw record', ValueType.String)
 
 
+class NFSFilesHeader(metaclass=Header):
+    display_name = 'Files from NFS service'
+
+    host_query = Field('Search ip', ValueType.String)
+    shared_path = Field('NFS path', ValueType.String)
+    file_path = Field('File path', ValueType.String)
+    file_type = Field('Type', ValueType.String)
+    file_size = Field('Size', ValueType.Integer)
+
+
 class ShareNFSToIP(metaclass=Link):
     name = Utils.make_link_name(ShareNFS, IP)
 
@@ -921,7 +1398,7 @@ class SearchDataNFS(Task):
         return 'ips'
 
     def get_headers(self):
-        return NFSHeader
+        return HeaderCollection(NFSHeader, NFSFilesHeader)
 
     def get_schemas(self):
         return SchemaCollection(NFSSchema)
@@ -936,7 +1413,10 @@ class SearchDataNFS(Task):
         ep_coll = EnterParamCollection()
         ep_coll.add_enter_param('ips', 'IP', ValueType.String, is_array=True,
                                 value_sources=[Attributes.System.IPAddress, Attributes.System.IPAndPort, Attributes.Netblock],
-                                description="""IPs, networks, e.g.:\n1. 192.168.1.1\n2. 192.168.1.0/24""")
+                                description="""IPs, networks, e.g.:\n1. 192.168.1.1\n2. 192.168.1.0/24\n3. 2001:db8::1"""
+                                            """\nIPv6 networks larger than /120 are skipped, use hitlist""")
+        ep_coll.add_enter_param('hitlist', 'Hitlist file', ValueType.String, file_path=True,
+                                description='text file with IPv4/IPv6 addresses, one per line; read as stream')
         ep_coll.add_enter_param('unpack_network', 'Unpack network record', ValueType.Boolean, default_value=False,
                                 description = """unpack network:\n192.168.1.0/24 -> 192.168.1.0, 192.168.1.1, 192.168.1.2 .. 192.168.1.255""")
         ep_coll.add_enter_param('timeout', 'timeout', ValueType.Integer, is_array=False,
@@ -944,36 +1424,87 @@ class SearchDataNFS(Task):
                                 description='timeout, int. value')
         ep_coll.add_enter_param('max_threads', 'Max. threads', ValueType.Integer, predefined_values= [8, 16, 32],
                                 default_value=8, required=True)
+        ep_coll.add_enter_param('walk', 'Walk exports', ValueType.Boolean, default_value=False,
+                                description='mount exports with AUTH_UNIX and list files')
+        ep_coll.add_enter_param('depth', 'Walk depth', ValueType.Integer, predefined_values=[1, 2, 3, 5],
+                                default_value=2, description='1 - only root directory of export')
+        ep_coll.add_enter_param('uid', 'AUTH_UNIX uid', ValueType.Integer, default_value=0)
+        ep_coll.add_enter_param('gid', 'AUTH_UNIX gid', ValueType.Integer, default_value=0)
+        ep_coll.add_enter_param('cache_mode', 'Cache', ValueType.String, predefined_values=NFSCache.modes,
+                                default_value='use cache', required=True,
+                                description="""use cache - probe only hosts without fresh records\n"""
+                                            """refresh - probe all hosts and update records\n"""
+                                            """cache only - do not probe hosts""")
+        ep_coll.add_enter_param('cache_ttl', 'Cache TTL(hours)', ValueType.Integer, predefined_values=[1, 6, 24, 168],
+                                default_value=24, required=True)
 
         return ep_coll
 
     def execute(self, enter_params, result_writer, log_writer, temp_dir=None):
         unpack_network = enter_params.unpack_network
         max_threads = enter_params.max_threads
-        scan_network = set(map(lambda z:z.strip(), enter_params.ips))
+        scan_network = set(map(lambda z:z.strip(), enter_params.ips or []))
         time_for_connect = enter_params.timeout
         from warnings import filterwarnings
         filterwarnings("ignore")
         like_cache = []
-        targets = set(list(main_scan(scan_network, log_writer)))
-        fields_table = NFSHeader.get_fields()
-        all_nfs_shares = main_nfs(targets, unpack_network, log_writer, _timeout=time_for_connect, workers=max_threads)
-        for row in all_nfs_shares:
-            # like cache
-            _tmp_c = row.copy()
-            _tmp_c.pop('current_day')
-            _c = dumps(_tmp_c)
-            # ---------
-            if _c not in like_cache:
-                like_cache.append(_c)
-                tmp = NFSHeader.create_empty()
-                for field in fields_table:
-                    if field in row:
-                        if isinstance(row[field], str):
-                            tmp[fields_table[field]] = row[field].strip()
-                        else:
-                            tmp[fields_table[field]] = row[field]
-                result_writer.write_line(tmp, header_class=NFSHeader)
+        cache = NFSCache(NFS_CACHE_PATH, enter_params.cache_ttl * 3600, enter_params.cache_mode)
+        try:
+            ips = set(return_ips(scan_network))
+            if getattr(enter_params, 'hitlist', None):
+                ips = itertools.chain(ips, read_hitlist(enter_params.hitlist))
+            targets = set()
+
+            def not_cached(addresses):
+                for ip in addresses:
+                    found, exports = cache.lookup(ip, 111)
+                    if not found:
+                        yield ip
+                    elif exports is not None:
+                        targets.add(ip)
+                    # else: host was not available - it is not probed again while record is fresh
+
+            if cache.probe_enabled:
+                targets.update(main_scan(not_cached(ips), log_writer, cache))
+            else:
+                collections.deque(not_cached(ips), maxlen=0)
+            log_writer.info(f'from cache and online:{len(targets)}')
+            fields_table = NFSHeader.get_fields()
+            all_nfs_shares = main_nfs(targets, unpack_network, log_writer, _timeout=time_for_connect, workers=max_threads,
+                                      cache=cache)
+            for row in all_nfs_shares:
+                # like cache
+                _tmp_c = row.copy()
+                _tmp_c.pop('current_day')
+                _c = dumps(_tmp_c)
+                # ---------
+                if _c not in like_cache:
+                    like_cache.append(_c)
+                    tmp = NFSHeader.create_empty()
+                    for field in fields_table:
+                        if field in row:
+                            if isinstance(row[field], str):
+                                tmp[fields_table[field]] = row[field].strip()
+                            else:
+                                tmp[fields_table[field]] = row[field]
+                    result_writer.write_line(tmp, header_class=NFSHeader)
+
+            if enter_params.walk:
+                if cache.probe_enabled:
+                    exports = set((row['host_query'], row['shared_path']) for row in all_nfs_shares)
+                    files_table = NFSFilesHeader.get_fields()
+                    for row in main_walk(exports, log_writer, _timeout=time_for_connect, workers=max_threads,
+                                         uid=enter_params.uid, gid=enter_params.gid, recurse=enter_params.depth,
+                                         cache=cache):
+                        tmp = NFSFilesHeader.create_empty()
+                        for field in files_table:
+                            if field in row:
+                                tmp[files_table[field]] = row[field]
+                        result_writer.write_line(tmp, header_class=NFSFilesHeader)
+                else:
+                    log_writer.info("walk exports is skipped with 'cache only'")
+        finally:
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -986,9 +1517,16 @@ if __name__ == '__main__':
         # ips = ['46.32.248.0/24']
         # ips = ['46.32.248.187', '46.32.248.141']
         ips = ['192.168.2.0/24']
+        hitlist = ''
         unpack_network = False
         max_threads = 16
         timeout = 5
+        cache_mode = 'use cache'
+        cache_ttl = 24
+        walk = False
+        depth = 2
+        uid = 0
+        gid = 0
 
     class WriterFake:
         @classmethod
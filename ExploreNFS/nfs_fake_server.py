@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -
+
+#
+# In-process fake ONC-RPC server (portmap v2, mountd v3, nfsd v3) for offline
+# benchmarks and fuzzing of lamp_nfs_native_threads.py
+#
+# run benchmarks:  python nfs_fake_server.py
+# run fuzzing:     python nfs_fake_server.py --fuzz 10000
+#
+# lamp_nfs_native_threads.py imports ontology, so root of repository must be in sys.path
+
+import socketserver
+import threading
+import struct
+import socket
+import time
+import random
+import os
+import sys
+
+PORTMAP = 100000
+NFS = 100003
+MOUNT = 100005
+
+NFS3_OK = 0
+NFS3ERR_NOENT = 2
+NFS3ERR_NOTDIR = 20
+NFS3ERR_STALE = 70
+MNT3ERR_NOENT = 2
+
+
+def pack_opaque(data):
+    return struct.pack('!L', len(data)) + data + b'\x00'*((4-len(data) % 4) % 4)
+
+
+def pack_string(text):
+    return pack_opaque(text.encode())
+
+
+def unpack_opaque(data, offset):
+    (length,) = struct.unpack_from('!L', data, offset)
+    offset += 4
+    return data[offset:offset+length], offset + length + (4-length % 4) % 4
+
+
+class FakeNode(object):
+    __slots__ = ('node_id', 'name', 'file_type', 'size', 'children', 'content')
+
+    def __init__(self, node_id, name, file_type, size=0):
+        self.node_id = node_id
+        self.name = name
+        self.file_type = file_type  # 1 - file, 2 - directory
+        self.size = size
+        self.children = []
+        self.content = b''
+
+
+class FakeTree(object):
+    """
+    synthetic export table and directory trees
+    every export: <width> directories and <files> files on each level, <depth> levels
+    """
+    def __init__(self, exports=4, width=4, depth=3, files=8, file_size=4096, handle_size=28, authorized=2):
+        self.nodes = {}
+        self.handle_size = handle_size
+        self.exports = []
+        for i in range(exports):
+            path = f'/export/share{i}'
+            groups = [f'10.{i}.{g}.0/24' for g in range(authorized)]
+            root = self.add(path, 2)
+            self.fill(root, width, depth, files, file_size)
+            self.exports.append((path, groups, root))
+
+    def add(self, name, file_type, size=0):
+        node = FakeNode(len(self.nodes) + 1, name, file_type, size)
+        self.nodes[node.node_id] = node
+        return node
+
+    def fill(self, node, width, depth, files, file_size):
+        for i in range(files):
+            child = self.add(f'file_{i}.dat', 1, file_size)
+            child.content = bytes(random.getrandbits(8) for _ in range(min(file_size, 256)))
+            node.children.append(child)
+        if depth > 1:
+            for i in range(width):
+                child = self.add(f'dir_{i}', 2)
+                node.children.append(child)
+                self.fill(child, width, depth - 1, files, file_size)
+
+    def handle(self, node):
+        handle = struct.pack('!Q', node.node_id)
+        return handle + b'\xfe'*(self.handle_size - len(handle))
+
+    def node(self, handle):
+        if len(handle) != self.handle_size:
+            return None
+        return self.nodes.get(struct.unpack('!Q', handle[:8])[0])
+
+    def fattr3(self, node):
+        return struct.pack('!LLLLLQQLLQQLLLLLL',
+                           node.file_type, 0o755 if node.file_type == 2 else 0o644, 1, 0, 0,
+                           node.size, node.size, 0, 0, 1, node.node_id,
+                           0, 0, 0, 0, 0, 0)
+
+    def entries_count(self):
+        return sum(1 for node in self.nodes.values()) - len(self.exports)
+
+
+class FakeRPCHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                call = self.read_record()
+            except OSError:
+                return
+            if call is None:
+                return
+            if server.latency:
+                time.sleep(server.latency)
+            reply = server.dispatch(call)
+            try:
+                self.request.sendall(struct.pack('!L', 0x80000000 + len(reply)) + reply)
+            except OSError:
+                return
+
+    def recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def read_record(self):
+        message = b''
+        last = False
+        while not last:
+            header = self.recv_exactly(4)
+            if header is None:
+                return None
+            (mark,) = struct.unpack('!L', header)
+            last = mark & 0x80000000 != 0
+            fragment = self.recv_exactly(mark & 0x7fffffff)
+            if fragment is None:
+                return None
+            message += fragment
+        return message
+
+
+class FakeRPCServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    all programs are served on one port, portmap GETPORT returns this port
+
+    with FakeRPCServer(FakeTree()) as server:
+        host, port = server.address
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tree, host='127.0.0.1', port=0, latency=0.0, family=socket.AF_INET):
+        self.address_family = family
+        self.tree = tree
+        self.latency = latency
+        self.calls = 0
+        socketserver.TCPServer.__init__(self, (host, port), FakeRPCHandler)
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server_address[:2]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def dispatch(self, call):
+        self.calls += 1
+        try:
+            xid, message_type, rpc_version, program, version, procedure = struct.unpack_from('!LLLLLL', call, 0)
+            offset = 24
+            _, offset = self.skip_auth(call, offset)  # credentials
+            _, offset = self.skip_auth(call, offset)  # verifier
+            args = call[offset:]
+        except struct.error:
+            return struct.pack('!LLLLL', 0, 1, 1, 0, 0)  # MSG_DENIED, RPC_MISMATCH
+        head = struct.pack('!LLLLLL', xid, 1, 0, 0, 0, 0)
+        handler = {PORTMAP: self.portmap, MOUNT: self.mount, NFS: self.nfs}.get(program)
+        if handler is None:
+            return struct.pack('!LLLLLL', xid, 1, 0, 0, 0, 1)  # PROG_UNAVAIL
+        try:
+            return head + handler(procedure, args)
+        except (struct.error, IndexError):
+            return struct.pack('!LLLLLL', xid, 1, 0, 0, 0, 4)  # GARBAGE_ARGS
+
+    @staticmethod
+    def skip_auth(call, offset):
+        (flavor,) = struct.unpack_from('!L', call, offset)
+        body, offset = unpack_opaque(call, offset + 4)
+        return (flavor, body), offset
+
+    def portmap(self, procedure, args):
+        port = self.address[1]
+        if procedure == 0:
+            return b''
+        if procedure == 3:
+            return struct.pack('!L', port)
+        if procedure == 4:
+            result = b''
+            for program, version in ((PORTMAP, 2), (MOUNT, 3), (NFS, 3)):
+                result += struct.pack('!LLLLL', 1, program, version, 6, port)
+            return result + struct.pack('!L', 0)
+        return b''
+
+    def mount(self, procedure, args):
+        tree = self.tree
+        if procedure == 0:
+            return b''
+        if procedure == 1:
+            path, _ = unpack_opaque(args, 0)
+            for export, groups, root in tree.exports:
+                if export.encode() == path:
+                    return struct.pack('!L', 0) + pack_opaque(tree.handle(root)) + struct.pack('!LLL', 2, 0, 1)
+            return struct.pack('!L', MNT3ERR_NOENT)
+        if procedure == 5:
+            result = b''
+            for export, groups, root in tree.exports:
+                result += struct.pack('!L', 1) + pack_string(export)
+                for group in groups:
+                    result += struct.pack('!L', 1) + pack_string(group)
+                result += struct.pack('!L', 0)
+            return result + struct.pack('!L', 0)
+        return b''
+
+    def nfs(self, procedure, args):
+        tree = self.tree
+        if procedure == 0:
+            return b''
+        handle, offset = unpack_opaque(args, 0)
+        node = tree.node(handle)
+        if node is None:
+            return struct.pack('!L', NFS3ERR_STALE)
+        if procedure == 3:  # LOOKUP
+            name, _ = unpack_opaque(args, offset)
+            for child in node.children:
+                if child.name.encode() == name:
+                    return (struct.pack('!L', NFS3_OK) + pack_opaque(tree.handle(child)) +
+                            struct.pack('!L', 1) + tree.fattr3(child) + struct.pack('!L', 1) + tree.fattr3(node))
+            return struct.pack('!LL', NFS3ERR_NOENT, 0)
+        if procedure == 6:  # READ
+            read_offset, count = struct.unpack_from('!QL', args, offset)
+            chunk = node.content[read_offset:read_offset+count]
+            eof = 1 if read_offset + len(chunk) >= len(node.content) else 0
+            return (struct.pack('!LL', NFS3_OK, 1) + tree.fattr3(node) +
+                    struct.pack('!LL', len(chunk), eof) + pack_opaque(chunk))
+        if procedure == 17:  # READDIRPLUS
+            if node.file_type != 2:
+                return struct.pack('!LL', NFS3ERR_NOTDIR, 0)
+            cookie, _, dircount, maxcount = struct.unpack_from('!Q8sLL', args, offset)
+            result = struct.pack('!LL', NFS3_OK, 1) + tree.fattr3(node) + b'\x00'*8
+            size = len(result) + 8
+            eof = 1
+            for index in range(cookie, len(node.children)):
+                child = node.children[index]
+                entry = (struct.pack('!LQ', 1, child.node_id) + pack_string(child.name) +
+                         struct.pack('!QL', index + 1, 1) + tree.fattr3(child) +
+                         struct.pack('!L', 1) + pack_opaque(tree.handle(child)))
+                if size + len(entry) > maxcount:
+                    eof = 0
+                    break
+                result += entry
+                size += len(entry)
+            return result + struct.pack('!LL', 0, eof)
+        return struct.pack('!L', 10004)  # NFS3ERR_NOTSUPP
+
+
+class LoopbackSocket(object):
+    """
+    socket replacement for RPC.client: every request is answered with next canned record
+    """
+    def __init__(self, records):
+        self.records = records
+        self.index = 0
+        self.buffer = b''
+
+    def send(self, data):
+        self.buffer = self.records[self.index % len(self.records)]
+        self.index += 1
+        return len(data)
+
+    sendall = send
+
+    def sendmsg(self, buffers):
+        return self.send(b''.join(buffers))
+
+    def recv(self, size):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+def record(server, program, procedure, args=b''):
+    """
+    reply record of fake server (with record mark)
+    """
+    call = struct.pack('!LLLLLL', 1, 0, 2, program, 3, procedure) + struct.pack('!LLLL', 0, 0, 0, 0) + args
+    reply = server.dispatch(call)
+    return struct.pack('!L', 0x80000000 + len(reply)) + reply
+
+
+def measure(name, function, count, unit):
+    start = time.perf_counter()
+    items = 0
+    for _ in range(count):
+        items += function() or 0
+    elapsed = time.perf_counter() - start
+    print(f'{name:<32} {count / elapsed:>12.0f} calls/sec. {items / elapsed:>12.0f} {unit}/sec.')
+
+
+def benchmark(lamp, count=2000):
+    tree = FakeTree(exports=16, width=6, depth=3, files=40)
+    # 0.0.0.0 - every 127.x.y.z is another host for scanner (privileged source ports are not exhausted)
+    server = FakeRPCServer(tree, host='0.0.0.0')
+    root = tree.exports[0][2]
+
+    def parse(rpc_class, records, method, *args, **kwargs):
+        client = rpc_class('127.0.0.1', 0, 1)
+        client.client = LoopbackSocket(records)
+        return lambda: len(getattr(client, method)(*args, **kwargs))
+
+    auth = {"flavor": 1, "machine_name": 'nfsclient', "uid": 0, "gid": 0, "aux_gid": [0]}
+    measure('parse Portmap.dump', parse(lamp.Portmap, [record(server, PORTMAP, 4)], 'dump'), count, 'entries')
+    measure('parse Mount.export', parse(lamp.Mount, [record(server, MOUNT, 5)], 'export'), count, 'exports')
+    readdirplus_args = pack_opaque(tree.handle(root)) + struct.pack('!Q8sLL', 0, b'', 4096, 32768)
+    measure('parse NFS.readdirplus', parse(lamp.NFS, [record(server, NFS, 17, readdirplus_args)],
+                                           'readdirplus', tree.handle(root), auth=auth), count, 'entries')
+    file_node = root.children[0]
+    read_args = pack_opaque(tree.handle(file_node)) + struct.pack('!QL', 0, 1024 * 1024)
+    measure('parse NFS.read', parse(lamp.NFS, [record(server, NFS, 6, read_args)],
+                                    'read', tree.handle(file_node), auth=auth), count, 'bytes')
+
+    with server:
+        host, port = '127.0.0.1', server.address[1]
+        hosts = 200
+        start = time.perf_counter()
+        rows = 0
+        for i in range(hosts):
+            target = f'127.0.{i // 250}.{i % 250 + 1}'
+            rows += len(list(lamp.process_get_nfs(target, port, False, 3, ["list_mounts"], 0, 0, 'nfsclient', 1, None)))
+        elapsed = time.perf_counter() - start
+        print(f'{"scan process_get_nfs":<32} {hosts / elapsed:>12.0f} hosts/sec. {rows / elapsed:>12.0f} rows/sec.')
+
+        class LogFake:
+            @classmethod
+            def info(cls, message, *args):
+                pass
+
+        if socket.has_ipv6:
+            with FakeRPCServer(tree, host='::1', family=socket.AF_INET6) as server6:
+                port6 = server6.address[1]
+                start = time.perf_counter()
+                rows = 0
+                for i in range(hosts):
+                    rows += len(list(lamp.process_get_nfs('::1', port6, False, 3, ["list_mounts"], 0, 0, 'nfsclient', 1,
+                                                          None)))
+                elapsed = time.perf_counter() - start
+                print(f'{"scan process_get_nfs(IPv6)":<32} {hosts / elapsed:>12.0f} hosts/sec. {rows / elapsed:>12.0f} rows/sec.')
+
+        exports = [(host, export) for export, groups, root in tree.exports]
+        start = time.perf_counter()
+        rows = sum(1 for _ in lamp.main_walk(exports, LogFake, _timeout=3, workers=8, recurse=3, port=port))
+        elapsed = time.perf_counter() - start
+        print(f'{"walk main_walk":<32} {rows / elapsed:>12.0f} rows/sec. ({rows} of {tree.entries_count()})')
+
+
+def fuzz(lamp, iterations=10000, seed=None):
+    """
+    feeds mutated replies to codecs, only protocol errors are allowed
+    """
+    seed = random.randrange(1 << 32) if seed is None else seed
+    rnd = random.Random(seed)
+    tree = FakeTree(exports=3, width=2, depth=2, files=3)
+    server = FakeRPCServer(tree)
+    server.server_close()
+    root = tree.exports[0][2]
+    file_node = root.children[0]
+    auth = {"flavor": 1, "machine_name": 'nfsclient', "uid": 0, "gid": 0, "aux_gid": [0]}
+    readdirplus_args = pack_opaque(tree.handle(root)) + struct.pack('!Q8sLL', 0, b'', 4096, 32768)
+    read_args = pack_opaque(tree.handle(file_node)) + struct.pack('!QL', 0, 1024 * 1024)
+    lookup_args = pack_opaque(tree.handle(root)) + pack_string(file_node.name)
+    mnt_args = pack_string(tree.exports[0][0])
+    cases = [
+        (lamp.Portmap, record(server, PORTMAP, 4), 'dump', (), {}),
+        (lamp.Portmap, record(server, PORTMAP, 3), 'getport', (MOUNT, 3), {}),
+        (lamp.Mount, record(server, MOUNT, 5), 'export', (), {}),
+        (lamp.Mount, record(server, MOUNT, 1, mnt_args), 'mnt', (tree.exports[0][0],), {'auth': auth}),
+        (lamp.NFS, record(server, NFS, 17, readdirplus_args), 'readdirplus', (tree.handle(root),), {'auth': auth}),
+        (lamp.NFS, record(server, NFS, 6, read_args), 'read', (tree.handle(file_node),), {'auth': auth}),
+        (lamp.NFS, record(server, NFS, 3, lookup_args), 'lookup', (tree.handle(root), file_node.name), {'auth': auth}),
+    ]
+    allowed = (struct.error, lamp.NFSAccessError, lamp.MountAccessError, lamp.RPCProtocolError, UnicodeDecodeError)
+    failures = 0
+    seen = set()
+    for i in range(iterations):
+        rpc_class, reply, method, args, kwargs = rnd.choice(cases)
+        data = bytearray(reply)
+        for _ in range(rnd.randint(1, 4)):
+            position = rnd.randrange(4, len(data))
+            action = rnd.random()
+            if action < 0.5:
+                data[position] = rnd.randrange(256)
+            elif action < 0.8:
+                del data[position:]
+                data[0:4] = struct.pack('!L', 0x80000000 + len(data) - 4)
+                if len(data) <= 4:
+                    break
+            else:
+                data[position:position] = bytes(rnd.randrange(256) for _ in range(rnd.randint(1, 8)))
+                data[0:4] = struct.pack('!L', 0x80000000 + len(data) - 4)
+        client = rpc_class('127.0.0.1', 0, 1)
+        client.client = LoopbackSocket([bytes(data)])
+        try:
+            getattr(client, method)(*args, **kwargs)
+        except allowed:
+            pass
+        except Exception as e:
+            failures += 1
+            kind = (rpc_class.__name__, method, type(e).__name__)
+            if kind not in seen:
+                seen.add(kind)
+                print(f'seed:{seed} iteration:{i} {rpc_class.__name__}.{method}: {type(e).__name__}: {e}')
+    print(f'fuzz: {iterations} iterations, {failures} unexpected exceptions, seed:{seed}')
+    return failures
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import lamp_nfs_native_threads
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--fuzz':
+        sys.exit(1 if fuzz(lamp_nfs_native_threads, int(sys.argv[2])) else 0)
+    benchmark(lamp_nfs_native_threads)
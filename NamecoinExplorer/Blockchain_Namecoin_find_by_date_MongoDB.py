@@ -1,8 +1,6 @@
 # -*- coding: utf8 -*-
 __author__ = 'sai'
 
-import time
-from pymongo import MongoClient
 from datetime import timedelta, datetime
 
 # region Import System Ontology
@@ -29,35 +27,23 @@ except ImportError as ontology_exception:
     raise ontology_exception
 # endregion
 
+# region load Namecoin MongoDB
+try:
+    from NamecoinMongoDB import (init_connect_to_mongodb, parse_server, cached_domain_rows, time_buckets,
+                                 prefetch_ordered, chain_tip)
+    from NamecoinCache import ResultCache
+except ImportError as mongodb_exception:
+    print('...missing or invalid NamecoinMongoDB, NamecoinCache')
+    raise mongodb_exception
+# endregion
 
-def init_connect_to_mongodb(ip, port, dbname, username=None, password=None):
-    """
-    :param ip:  ip server MongoDB
-    :param port: 27017
-    :return: True, if connected, and set value mongoclient - MongoClient
-    """
-    if username and password:
-        connect_string_to = 'mongodb://{}:{}@{}:{}/{}'.format(username, password, ip, port, dbname)
-    else:
-        connect_string_to = 'mongodb://{}:{}/{}'.format(ip, port, dbname)
-
-    check = False
-    count_repeat = 4
-    sleep_sec = 1
-    check_i = 0
-
-    while not check and check_i < count_repeat:
-        try:
-            client = MongoClient(connect_string_to, serverSelectionTimeoutMS=60)
-            client.server_info()
-            check = True
-        except Exception as ex:
-            print(f"try {check_i}, error:'{str(ex)}' connecting - error, sleep - 1 sec.")
-            time.sleep(sleep_sec)
-            check_i += 1
-        else:
-            return client
-
+# region load Namecoin profile
+try:
+    from NamecoinProfile import profiled
+except ImportError as profile_exception:
+    print('...missing or invalid NamecoinProfile')
+    raise profile_exception
+# endregion
 
 def not_empty(field: Field):
     return Condition(field, Operations.NotEqual, '')
@@ -66,77 +52,44 @@ def not_empty(field: Field):
 def return_massive_about_domains_between_dates(start, stop, what_about_ip, server, user, password):
 
     def prepare_row(line):
-        _name = return_namecoin(line['clean_name'])
+        _name = return_namecoin(line.get('namecoin_domain') or '')
         if _name:
-            _result = dict()
-
-            _result['date_time'] = line['clean_datetime_block']
-            _result['domain'] = _name['domain'].strip()
-            _result['namecoin_domain'] = line['clean_name'].strip()
-
-            _result['height'] = line['height_block']
-            _result['hash_block'] = line['blockhash']
-            _result['txid'] = line['txid']
-            _result['short_txid'] = line['txid'][:8]
-            try:
-                _result['operation'] =  line['clean_op'].strip()
-            except:
-                pass
-            if 'ips' in line:
-                for ip in line['ips']:
-                    _result_row = _result.copy()
-                    _result_row['ip'] = ip.strip()
-                    yield _result_row
-            else:
-                yield _result
-
-    def return_info(search_dict, need_fields):
-        rows = db[collection_name_tx].find(search_dict, need_fields)
-        massive_all = [row for row in rows]
-
-        _need_block_fields = {'_id': 1, 'height': 1}
-        hashs_block = list(set([row['blockhash'] for row in massive_all]))
-        _search_filter = {"_id": {"$in": hashs_block}}
-        _tmp = db[collection_name_blocks].find(_search_filter, _need_block_fields)
-        _cache = {}
-        for row in _tmp:
-            if row['_id'] not in _cache:
-                _cache[row['_id']] = row['height']
-
-        for row in massive_all:
-            if row['blockhash'] in _cache:
-                row['height_block'] = _cache[row['blockhash']]
+            line['domain'] = _name['domain'].strip()
+            line['namecoin_domain'] = line['namecoin_domain'].strip()
+            if isinstance(line.get('operation'), str):
+                line['operation'] = line['operation'].strip()
+            if isinstance(line.get('ip'), str):
+                line['ip'] = line['ip'].strip()
+            yield line
+
+    def return_info(search_dicts):
+        # rows are joined with Blocks and unwound by ips on server, every bucket is sorted by server,
+        # buckets are queried concurrently and read in order - rows are in order of time;
+        # every bucket is a query of result cache - old buckets are not queried again, tip is the same for all
+        tip = chain_tip(db)
+        streams = [lambda search_dict=search_dict: cached_domain_rows(
+            db, ResultCache.key(server, dbname, user, 'namecoin_find_by_date', [], query=search_dict), [search_dict],
+            tip=tip) for search_dict in search_dicts]
+        for row in prefetch_ordered(streams):
             rows_for_table_lampyre = prepare_row(row)
             for _row in rows_for_table_lampyre:
                 yield _row
 
-    ip, port = server.split(":")
+    ip, port = parse_server(server)
     dbname = "NamecoinExplorer"
-    collection_name_blocks = "Blocks"
-    collection_name_tx = "Tx"
 
     cl_mongo = init_connect_to_mongodb(ip, port, dbname, user, password)
     if cl_mongo:
         db = cl_mongo[dbname]
 
-        need_fields = {'clean_name': 1,
-                       'ips': 1,
-                       'clean_op':1,
-                        'clean_datetime_block': 1,
-                       'blockhash': 1,
-                       'txid': 1,
-                       '_id': 0}
-
-        if not what_about_ip:
-            search_dict ={'clean_datetime_block': {'$gte':start, '$lte': stop},
-                          'clean_name': {'$exists': 1}}
-        else:
-            search_dict = {'clean_datetime_block': {'$gte':start, '$lte': stop},
-                           'ips': {'$exists': 1},
-                           'clean_name':{'$exists': 1}}
-
+        search_dicts = []
+        for bucket in time_buckets(start, stop):
+            search_dict = dict(bucket, clean_name={'$exists': 1})
+            if what_about_ip:
+                search_dict['ips'] = {'$exists': 1}
+            search_dicts.append(search_dict)
 
-        for row in return_info(search_dict, need_fields):
+        for row in return_info(search_dicts):
             yield row
 
 
@@ -228,14 +181,19 @@ class NamecoinHistoryDomainIPDateMongoDB(Task):
                                 default_value=False)
 
         ep_coll.add_enter_param('server', 'host with MongoDB', ValueType.String, is_array=False, required=True,
-                                default_value="68.183.0.119:27017")
+                                default_value="68.183.0.119:27017",
+                                description='host:port of MongoDB or local index of NamecoinIndex.py, e.g.:\n'
+                                            'sqlite:/home/user/lampyre_namecoin_index.sqlite')
         ep_coll.add_enter_param('usermongodb', 'user', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
         ep_coll.add_enter_param('passwordmongodb', 'password', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
 
+        ep_coll.add_enter_param('profile', 'Profile queries', ValueType.Boolean, required=False, default_value=False,
+                                description='time of stages, commands and plans of queries - summary in log')
         return ep_coll
 
+    @profiled
     def execute(self, enter_params, result_writer, log_writer, temp_dir=None):
         start_date = enter_params.start_date
         stop_date = enter_params.stop_date
@@ -271,6 +229,7 @@ if __name__ == '__main__':
         server = "68.183.0.119:27017"
         usermongodb = "anonymous"
         passwordmongodb = "anonymous"
+        profile = False
         check_ip = False
 
     class WriterFake:
@@ -1,9 +1,9 @@
 # -*- coding: utf8 -*-
 __author__ = 'sai'
 
-import time
-from pymongo import MongoClient
+import os
 import ipaddress
+import itertools
 
 # region Import System Ontology
 try:
@@ -30,35 +30,23 @@ except ImportError as ontology_exception:
     raise ontology_exception
 # endregion
 
+# region load Namecoin MongoDB
+try:
+    from NamecoinMongoDB import (init_connect_to_mongodb, parse_server, cached_domain_rows, domain_rows, chunks,
+                                 prefetch_ordered, bulk_path, read_identifiers, ValueSpool, BULK_BATCH_SIZE)
+    from NamecoinCache import ResultCache
+except ImportError as mongodb_exception:
+    print('...missing or invalid NamecoinMongoDB, NamecoinCache')
+    raise mongodb_exception
+# endregion
 
-def init_connect_to_mongodb(ip, port, dbname, username=None, password=None):
-    """
-    :param ip:  ip server MongoDB
-    :param port: 27017
-    :return: True, if connected, and set value mongoclient - MongoClient
-    """
-    if username and password:
-        connect_string_to = 'mongodb://{}:{}@{}:{}/{}'.format(username, password, ip, port, dbname)
-    else:
-        connect_string_to = 'mongodb://{}:{}/{}'.format(ip, port, dbname)
-
-    check = False
-    count_repeat = 4
-    sleep_sec = 1
-    check_i = 0
-
-    while not check and check_i < count_repeat:
-        try:
-            client = MongoClient(connect_string_to, serverSelectionTimeoutMS=60)
-            client.server_info()
-            check = True
-        except Exception as ex:
-            print(f"try {check_i}, error:'{str(ex)}', connecting - error, sleep - 1 sec.")
-            time.sleep(sleep_sec)
-            check_i += 1
-        else:
-            return client
-
+# region load Namecoin profile
+try:
+    from NamecoinProfile import profiled
+except ImportError as profile_exception:
+    print('...missing or invalid NamecoinProfile')
+    raise profile_exception
+# endregion
 
 def not_empty(field: Field):
     return Condition(field, Operations.NotEqual, '')
@@ -78,68 +66,53 @@ def valid_ip(address):
         return False
 
 
-def return_massive_about_ips(ips, server, user, password):
+def return_massive_about_ips(ips, server, user, password, bulk_file=None, temp_dir=None):
 
     def prepare_row(line):
-        _name = return_namecoin(line['clean_name'])
-        if _name:
-            _result = dict()
-            _result['date_time'] = line['clean_datetime_block']
-            _result['domain'] = _name['domain']
-            _result['namecoin_domain'] = line['clean_name']
-            _result['height'] = line['height_block']
-            _result['hash_block'] = line['blockhash']
-            _result['txid'] = line['txid']
-            _result['short_txid'] = line['txid'][:8]
-
-            try:
-                _result['operation'] = line['clean_op']
-            except:
-                pass
-            if 'ips' in line:
-                for ip in line['ips']:
-                    _result_row = _result.copy()
-                    _result_row['ip'] = ip.strip()
-                    yield _result_row
-
-    def return_info(search_dict, need_fields):
-        rows = db[collection_name_tx].find(search_dict, need_fields)
-        massive_all = [row for row in rows]
-
-        _need_block_fields = {'_id': 1, 'height': 1}
-        hashs_block = list(set([row['blockhash'] for row in massive_all]))
-        _search_filter = {"_id": {"$in": hashs_block}}
-        _tmp = db[collection_name_blocks].find(_search_filter, _need_block_fields)
-        _cache = {}
-        for row in _tmp:
-            if row['_id'] not in _cache:
-                _cache[row['_id']] = row['height']
-
-        for row in massive_all:
-            if row['blockhash'] in _cache:
-                row['height_block'] = _cache[row['blockhash']]
+        _name = return_namecoin(line.get('namecoin_domain') or '')
+        if _name and line.get('ip'):
+            line['domain'] = _name['domain']
+            line['ip'] = line['ip'].strip()
+            yield line
+
+    def return_info(search_dicts):
+        # rows are joined with Blocks and unwound by ips on server, old rows - from result cache
+        query_key = ResultCache.key(server, dbname, user, 'namecoin_find_by_ip', ips)
+        for row in cached_domain_rows(db, query_key, search_dicts):
             rows_for_table_lampyre = prepare_row(row)
             for _row in rows_for_table_lampyre:
                 yield _row
 
-    ip, port = server.split(":")
+    def return_info_bulk(ips_checked, spool):
+        # batches of unique ips are queried in parallel, rows - in order of batches;
+        # transaction with ips of different batches is found by each of them - (txid, ip) once
+        streams = (lambda chunk=chunk: domain_rows(db, [{"ips": {"$in": chunk}}])
+                   for chunk in chunks(ips_checked, BULK_BATCH_SIZE))
+        row_key = lambda row: f"{row.get('txid')} {row.get('ip')}"
+        for rows in chunks(prefetch_ordered(streams), BULK_BATCH_SIZE):
+            fresh = set(spool.unique(map(row_key, rows), 'rows'))
+            for row in rows:
+                if row_key(row) in fresh:
+                    fresh.discard(row_key(row))
+                    for _row in prepare_row(row):
+                        yield _row
+
+    ip, port = parse_server(server)
     dbname = "NamecoinExplorer"
-    collection_name_blocks = "Blocks"
-    collection_name_tx = "Tx"
     cl_mongo = init_connect_to_mongodb(ip, port, dbname, user, password)
-    ips_checked = list(filter(valid_ip, ips))
     if cl_mongo:
         db = cl_mongo[dbname]
-        search_dict = {"ips": {"$in": ips_checked}}
-        need_fields = {'clean_name': 1,
-                       'ips': 1,
-                       'clean_op': 1,
-                        'clean_datetime_block': 1,
-                       'blockhash': 1,
-                       'txid': 1,
-                       '_id': 0}
-        for line in return_info(search_dict, need_fields):
-            yield line
+        if bulk_file:
+            # bulk mode: ips of file are deduplicated on disk - memory does not depend on size of file
+            with ValueSpool(temp_dir) as spool:
+                values = filter(valid_ip, itertools.chain(ips, read_identifiers(bulk_file)))
+                for line in return_info_bulk(spool.unique(values, 'ips'), spool):
+                    yield line
+        else:
+            ips_checked = list(filter(valid_ip, ips))
+            search_dict = {"ips": {"$in": ips_checked}}
+            for line in return_info([search_dict]):
+                yield line
 
 
 def return_namecoin(namedomain):
@@ -223,30 +196,47 @@ class NamecoinHistoryIPDomainMongoDB(Task):
                   schemas=[NamecoinDomainIP]))
 
 
-
     def get_enter_params(self):
         ep_coll = EnterParamCollection()
-        ep_coll.add_enter_param('ips', 'IP', ValueType.String, is_array=True, required=True,
+        ep_coll.add_enter_param('ips', 'IP', ValueType.String, is_array=True, required=False,
                                 value_sources=[Attributes.System.IPAddress, Attributes.System.IPAndPort],
                                 description='IPv4 addresses or IPv4 addresses, e.g.:\n192.168.1.1')
+        ep_coll.add_enter_param('bulk_file', 'File with IP', ValueType.String, file_path=True, required=False,
+                                description='bulk mode for big lists: file in temp directory of task or full path,\n'
+                                            'one or several addresses per line')
         ep_coll.add_enter_param('server', 'Host with MongoDB', ValueType.String, is_array=False, required=True,
-                                default_value="68.183.0.119:27017")
+                                default_value="68.183.0.119:27017",
+                                description='host:port of MongoDB or local index of NamecoinIndex.py, e.g.:\n'
+                                            'sqlite:/home/user/lampyre_namecoin_index.sqlite')
         ep_coll.add_enter_param('usermongodb', 'user', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
         ep_coll.add_enter_param('passwordmongodb', 'password', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
+        ep_coll.add_enter_param('profile', 'Profile queries', ValueType.Boolean, required=False, default_value=False,
+                                description='time of stages, commands and plans of queries - summary in log')
         return ep_coll
 
+    @profiled
     def execute(self, enter_params, result_writer, log_writer, temp_dir=None):
         server = enter_params.server
-        ips = enter_params.ips
+        ips = enter_params.ips or []
         user = enter_params.usermongodb
         password = enter_params.passwordmongodb
+        bulk_file = bulk_path(enter_params.bulk_file, temp_dir)
+        if bulk_file and not os.path.isfile(bulk_file):
+            log_writer.error(f'file is not found: {bulk_file}')
+            return
+        if not ips and not bulk_file:
+            log_writer.error('ip-addresses or file with ip-addresses are required')
+            return
 
         log_writer.info("input ip-addresses:{}".format(len(ips)))
-        result_lines = return_massive_about_ips(ips, server, user, password)
+        if bulk_file:
+            log_writer.info(f'ip-addresses from file:{bulk_file}')
+        result_lines = return_massive_about_ips(ips, server, user, password, bulk_file, temp_dir)
         i = 1
-        for line in sorted(result_lines,  key=lambda line: line['date_time']):
+        # ordered by server (bulk mode - inside every batch)
+        for line in result_lines:
             log_writer.info('ready:{}.\t{}'.format(i, line['domain']))
             fields_table = NamecoinDomainExplorer.get_fields()
             tmp = NamecoinDomainExplorer.create_empty()
@@ -262,9 +252,11 @@ if __name__ == '__main__':
 
     class EnterParamsFake:
         ips = ['132.148.40.220', '185.126.202.186', '37.44.213.187', '50.248.53.221']
+        bulk_file = None
         server = "68.183.0.119:27017"
         usermongodb = "anonymous"
         passwordmongodb = "anonymous"
+        profile = False
 
 
     class WriterFake:
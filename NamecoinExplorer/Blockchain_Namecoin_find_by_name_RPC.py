@@ -1,14 +1,8 @@
 # -*- coding: utf8 -*-
 __author__ = 'sai'
 
-import requests
-import json
-import ipaddress
-import re
 from collections.abc import Iterable
 import datetime
-import concurrent.futures
-from requests.auth import HTTPBasicAuth
 import urllib3
 urllib3.disable_warnings()
 
@@ -39,89 +33,41 @@ except ImportError as ontology_exception:
 # endregion
 
 
-def return_ip(text):
-    result = []
-    ipPattern = r'(?:[\d]{1,3})\.(?:[\d]{1,3})\.(?:[\d]{1,3})\.(?:[\d]{1,3})'
-    ipaddress_subtmp = re.findall(ipPattern, text)
-    if ipaddress_subtmp:
-        for ip in ipaddress_subtmp:
-            try:
-                _ip = ipaddress.ip_address(ip.strip())
-                result.append(str(_ip))
-            except:
-                pass
-    return result
+# region load Namecoin RPC
+try:
+    from NamecoinRPC import names_history
+except ImportError as rpc_exception:
+    print('...missing or invalid NamecoinRPC')
+    raise rpc_exception
+# endregion
+
+
+# region load Namecoin values
+try:
+    from NamecoinValues import value_ips
+except ImportError as values_exception:
+    print('...missing or invalid NamecoinValues')
+    raise values_exception
+# endregion
 
 
 def not_empty(field: Field):
     return Condition(field, Operations.NotEqual, '')
 
 
-def get_block_hashs(hashs, server, user, password):
-    headers = {'content-type':'text/plain'}
-    if isinstance(hashs, Iterable):
-        v = hashs
-    else:
-        v = [hashs]
-    payload = {
-        "method": "getblockhash",
-        "params": v,
-        "jsonrpc": "1.0",
-        "id": "curltest"
-    }
-    response = requests.post(
-        server, data=json.dumps(payload), headers=headers, auth=HTTPBasicAuth(user, password))
-    if response.ok:
-        data = response.json()
-        return data.get('result')
-
-
-def get_block_info(hashs, server, user, password):
-    headers = {'content-type': 'text/plain'}
-    if isinstance(hashs, Iterable) and not isinstance(hashs, str):
-        v = hashs
-    else:
-        v = [hashs]
-    # v = [hashs]
-    payload = {
-        "method": "getblock",
-        "params": v,
-        "jsonrpc": "1.0",
-        "id": "curltest"
-    }
-
-    response = requests.post(
-        server, data=json.dumps(payload), headers=headers, auth=HTTPBasicAuth(user, password))
-
-    if response.ok:
-        data = response.json()
-        return data.get('result')
-
-
-def name_history_one(domain, value, server, user, password):
-
-    def parse_record(row):
+def history_rows(domain, history, blocks):
+    """
+    Rows (one per ip) of name_history
+    :param blocks: height -> (hash, time)
+    """
+
+    def parse_record(row, blocks):
         tmp_result = {"domain": domain}
         tmp_result['ips'] = []
         if 'name' in row:
             tmp_result['namecoin_domain'] = row['name']
         if 'value' in row:
-            try:
-                v = json.loads(row['value'].replace('\n', ' ').replace('\t', ' '))
-                if 'ip' in v:
-                    if isinstance(v['ip'], list):
-                        for ip in v['ip']:
-                            tmp_result['ips'].append(ip)
-                    elif isinstance(v['ip'], str):
-                        ips = return_ip(v['ip'])
-                        tmp_result['ips'].extend(ips)
-                else:
-                    ips = return_ip(row['value'])
-                    tmp_result['ips'].extend(ips)
-
-            except:
-                ips = return_ip(row['value'])
-                tmp_result['ips'].extend(ips)
+            tmp_result['ips'].extend(value_ips(row['value']))
 
         if 'txid' in row:
             tmp_result['txid'] = row['txid']
@@ -136,49 +82,27 @@ def name_history_one(domain, value, server, user, password):
         timeblock = None
         hash_block = None
         if 'height' in tmp_result:
-            h = get_block_hashs(tmp_result['height'], server, user, password)
-            info = get_block_info(h, server, user, password)
-            if info:
+            block = blocks.get(tmp_result['height'])
+            if block:
                 try:
-                    timeblock = datetime.datetime.utcfromtimestamp(info['time'])
-                    hash_block = info['hash']
+                    timeblock = datetime.datetime.utcfromtimestamp(block[1])
+                    hash_block = block[0]
                 except:
                     pass
         tmp_result['date_time'] = timeblock
         tmp_result['hash_block'] = hash_block
         return tmp_result
 
-    headers = {'content-type':'text/plain'}
-
-    payload = {
-        "method": "name_history",
-        "params": [value],
-        "jsonrpc": "1.0",
-        "id": "curltest"
-    }
     try:
-        response = requests.post(
-            server, data=json.dumps(payload), headers=headers, auth=HTTPBasicAuth(user, password))
-        check = response.ok
-        data = response.json()
-    except Exception as e:
-        check = False
-        data = None
-        print(f"errors:'{str(e)}'")
-    if check and data:
-        try:
-            if isinstance(data.get('result'), Iterable):
-                for block in data['result']:
-                    _tmp_row = parse_record(block)
-                    row = _tmp_row.copy()
-                    row.pop('ips')
-                    for _ip in _tmp_row['ips']:
-                        row['ip'] = _ip
-                        yield row
-        except:
-            print('high level errors...')
-    else:
-        print(f'errors with service...:{check}, {data}')
+        for block in history:
+            _tmp_row = parse_record(block, blocks)
+            row = _tmp_row.copy()
+            row.pop('ips')
+            for _ip in _tmp_row['ips']:
+                row['ip'] = _ip
+                yield row
+    except:
+        print('high level errors...')
 
 
 def return_namecoin(namedomain):
@@ -189,20 +113,23 @@ def return_namecoin(namedomain):
 
 
 def return_massive_about_domains(domains, server, threads, lg, user, password):
-    namecoins = map(return_namecoin, domains)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-        future_rows = {executor.submit(name_history_one, namecoin['domain'], namecoin['namecoin_domain'],
-                                       server, user, password):
-                           namecoin for namecoin in namecoins}
-        i = 1
-        for future in concurrent.futures.as_completed(future_rows):
-            domain_try = future_rows[future]
-            result = future.result()
-            if result:
-                lg.info(f"{i}. done. {domain_try['domain']}, {domain_try['namecoin_domain']}")
-                i += 1
-                for line in result:
-                    yield line
+    namecoins = {}
+    for domain in domains:
+        namecoin = return_namecoin(domain)
+        if namecoin:
+            namecoins[namecoin['namecoin_domain']] = namecoin
+        else:
+            lg.info(f"not Namecoin domain: {domain}")
+    # batches of names are resolved concurrently, rows - as soon as batch is done
+    i = 1
+    for value, history, blocks in names_history(server, user, password, list(namecoins), concurrency=threads):
+        domain_try = namecoins[value]
+        if not isinstance(history, Iterable):
+            lg.info(f"errors with service... {domain_try['domain']}, {value}")
+            continue
+        lg.info(f"{i}. done. {domain_try['domain']}, {value}")
+        i += 1
+        yield from history_rows(domain_try['domain'], history, blocks)
 
 
 class NamecoinDomainIP(metaclass=Schema):
@@ -291,7 +218,8 @@ class NamecoinHistoryDomainIPRPC(Task):
         threadsmax = enter_params.threads
         result_lines = return_massive_about_domains(domains, server, threadsmax, log_writer, user, password)
         i = 1
-        for line in sorted(result_lines,  key=lambda line: line['date_time']):
+        # lines are written as soon as names are resolved, lines of one name - in order of history
+        for line in result_lines:
             log_writer.info('ready:{}.\t{}'.format(i, line['domain']))
             fields_table = NamecoinDomainExplorer.get_fields()
             tmp = NamecoinDomainExplorer.create_empty()
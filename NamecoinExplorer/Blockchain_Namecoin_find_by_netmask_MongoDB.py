@@ -2,9 +2,8 @@
 __author__ = 'sai'
 
 import ipaddress
-import time
-from pymongo import MongoClient
 import itertools
+import heapq
 
 
 # region Import System Ontology
@@ -32,105 +31,52 @@ except ImportError as ontology_exception:
     raise ontology_exception
 # endregion
 
+# region load Namecoin MongoDB
+try:
+    from NamecoinMongoDB import (init_connect_to_mongodb, parse_server, connect_to_namecoin, network_filter,
+                                 has_index, COLLECTION_TX, IPS_KEY_FIELD, cached_domain_rows)
+    from NamecoinCache import ResultCache
+except ImportError as mongodb_exception:
+    print('...missing or invalid NamecoinMongoDB, NamecoinCache')
+    raise mongodb_exception
+# endregion
 
-def init_connect_to_mongodb(ip, port, dbname, username=None, password=None):
-    """
-    :param ip:  ip server MongoDB
-    :param port: 27017
-    :return: True, if connected, and set value mongoclient - MongoClient
-    """
-    if username and password:
-        connect_string_to = 'mongodb://{}:{}@{}:{}/{}'.format(username, password, ip, port, dbname)
-    else:
-        connect_string_to = 'mongodb://{}:{}/{}'.format(ip, port, dbname)
-
-    check = False
-    count_repeat = 4
-    sleep_sec = 1
-    check_i = 0
-
-    while not check and check_i < count_repeat:
-        try:
-            client = MongoClient(connect_string_to, serverSelectionTimeoutMS=60)
-            client.server_info()
-            check = True
-        except Exception as ex:
-            print(f"try {check_i}, error:'{str(ex)}', connecting - error, sleep - 1 sec.")
-            time.sleep(sleep_sec)
-            check_i += 1
-        else:
-            return client
-
+# region load Namecoin profile
+try:
+    from NamecoinProfile import profiled
+except ImportError as profile_exception:
+    print('...missing or invalid NamecoinProfile')
+    raise profile_exception
+# endregion
 
 def not_empty(field: Field):
     return Condition(field, Operations.NotEqual, '')
 
 
-def return_massive_about_ips(ips, server, user, password, cidr):
+def return_massive_about_ips(search_dicts, server, user, password, cidr):
 
     def prepare_row(line):
-        _name = return_namecoin(line['clean_name'])
-        if _name:
-            _result = dict()
-
-            _result['date_time'] = line['clean_datetime_block']
-            _result['domain'] = _name['domain']
-            _result['namecoin_domain'] = line['clean_name']
-
-            _result['height'] = line['height_block']
-            _result['hash_block'] = line['blockhash']
-            _result['txid'] = line['txid']
-            _result['short_txid'] = line['txid'][:8]
-
-            try:
-                _result['operation'] = line['clean_op']
-            except:
-                pass
-            if 'ips' in line:
-                for ip in line['ips']:
-                    _result_row = _result.copy()
-                    _result_row['ip'] = ip.strip()
-                    _result_row['Netblock'] = cidr
-                    yield _result_row
-            else:
-                yield _result
-
-    def return_info(search_dict, need_fields):
-        rows = db[collection_name_tx].find(search_dict, need_fields)
-        massive_all = [row for row in rows]
-
-        _need_block_fields = {'_id': 1, 'height': 1}
-        hashs_block = list(set([row['blockhash'] for row in massive_all]))
-        _search_filter = {"_id": {"$in": hashs_block}}
-        _tmp = db[collection_name_blocks].find(_search_filter, _need_block_fields)
-        _cache = {}
-        for row in _tmp:
-            if row['_id'] not in _cache:
-                _cache[row['_id']] = row['height']
-
-        for row in massive_all:
-            if row['blockhash'] in _cache:
-                row['height_block'] = _cache[row['blockhash']]
+        _name = return_namecoin(line.get('namecoin_domain') or '')
+        if _name and line.get('ip'):
+            line['domain'] = _name['domain']
+            line['ip'] = line['ip'].strip()
+            line['Netblock'] = cidr
+            yield line
+
+    def return_info(search_dicts):
+        # rows are joined with Blocks and unwound by ips on server, old rows - from result cache
+        query_key = ResultCache.key(server, dbname, user, 'namecoin_find_by_netmask', [cidr])
+        for row in cached_domain_rows(db, query_key, search_dicts):
             rows_for_table_lampyre = prepare_row(row)
             for _row in rows_for_table_lampyre:
                 yield _row
 
-    ip, port = server.split(":")
+    ip, port = parse_server(server)
     dbname = "NamecoinExplorer"
-    collection_name_blocks = "Blocks"
-    collection_name_tx = "Tx"
     cl_mongo = init_connect_to_mongodb(ip, port, dbname, user, password)
     if cl_mongo:
         db = cl_mongo[dbname]
-        search_dict = {"ips": {"$in": ips}}
-        need_fields = {'clean_name': 1,
-                       'ips': 1,
-                       'clean_op': 1,
-                        'clean_datetime_block': 1,
-                       'blockhash': 1,
-                       'txid': 1,
-                       '_id': 0}
-        for row in return_info(search_dict, need_fields):
+        for row in return_info(search_dicts):
             yield row
 
 
@@ -257,13 +203,18 @@ class NamecoinHistoryNetblockMongoDB(Task):
         ep_coll.add_enter_param('blocks', 'Netblocks', ValueType.String, is_array=True, required=True, value_sources=[
                     Netblock.Netblock], description='netblock in CIDR notation\nexample: 91.243.80.0/24')
         ep_coll.add_enter_param('server', 'Host with MongoDB', ValueType.String, is_array=False, required=True,
-                                default_value="68.183.0.119:27017")
+                                default_value="68.183.0.119:27017",
+                                description='host:port of MongoDB or local index of NamecoinIndex.py, e.g.:\n'
+                                            'sqlite:/home/user/lampyre_namecoin_index.sqlite')
         ep_coll.add_enter_param('usermongodb', 'user', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
         ep_coll.add_enter_param('passwordmongodb', 'password', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
+        ep_coll.add_enter_param('profile', 'Profile queries', ValueType.Boolean, required=False, default_value=False,
+                                description='time of stages, commands and plans of queries - summary in log')
         return ep_coll
 
+    @profiled
     def execute(self, enter_params, result_writer, log_writer, temp_dir=None):
         # enter params
         server = enter_params.server
@@ -273,20 +224,26 @@ class NamecoinHistoryNetblockMongoDB(Task):
 
         i = 1
         group_count = 1000
-        result = []
+        streams = []
+        db = connect_to_namecoin(server, user, password)
+        # without index on ips_key - old way, $in by groups of addresses
+        range_index = db is not None and has_index(db, COLLECTION_TX, IPS_KEY_FIELD)
         for cidr in netblock_enter_params:
             need_network = get_network(cidr)
             if need_network:
-                blocks_ips = grouper(group_count, map(str, need_network))
-                for ips in blocks_ips:
-                    # return all document
-                    _result_lines = return_massive_about_ips(ips, server, user, password, cidr)
-                    check_ip_cidr = lambda row: ipaddress.ip_address(row['ip']) in need_network
-                    result_lines = filter(check_ip_cidr, _result_lines)
-                    result.extend(list(result_lines))
-                log_writer.info('ready:{}.\t{}'.format(i, cidr))
+                if range_index:
+                    search_dicts = [network_filter(need_network)]
+                else:
+                    search_dicts = [{"ips": {"$in": ips}} for ips in grouper(group_count, map(str, need_network))]
+                # return all document
+                _result_lines = return_massive_about_ips(search_dicts, server, user, password, cidr)
+                check_ip_cidr = lambda row, network=need_network: ('ip' in row and
+                                                                   ipaddress.ip_address(row['ip']) in network)
+                streams.append(filter(check_ip_cidr, _result_lines))
+                log_writer.info('query:{}.\t{}'.format(i, cidr))
                 i += 1
-        for line in sorted(result,  key=lambda line: line['date_time']):
+        # every stream is ordered by server
+        for line in heapq.merge(*streams, key=lambda line: line['date_time']):
             fields_table = NamecoinDomainExplorer.get_fields()
             tmp = NamecoinDomainExplorer.create_empty()
             for field in fields_table:
@@ -303,6 +260,7 @@ if __name__ == '__main__':
         server = "68.183.0.119:27017"
         usermongodb = "anonymous"
         passwordmongodb = "anonymous"
+        profile = False
 
 
     class WriterFake:
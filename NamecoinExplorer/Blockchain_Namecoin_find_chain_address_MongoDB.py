@@ -1,9 +1,7 @@
 # -*- coding: utf8 -*-
 __author__ = 'sai'
 
-import time
-from pymongo import MongoClient
-
+from datetime import datetime
 
 # region Import System Ontology
 try:
@@ -31,157 +29,30 @@ except ImportError as ontology_exception:
     raise ontology_exception
 # endregion
 
+# region load Namecoin MongoDB
+try:
+    from NamecoinMongoDB import connect_to_namecoin
+    from NamecoinChain import ChainTraversal, DIRECTION_OUTPUT, DIRECTION_INPUT
+except ImportError as mongodb_exception:
+    print('...missing or invalid NamecoinMongoDB, NamecoinChain')
+    raise mongodb_exception
+# endregion
 
-chain_symbol_1 = '\u293e'
-
+# region load Namecoin profile
+try:
+    from NamecoinProfile import profiled
+except ImportError as profile_exception:
+    print('...missing or invalid NamecoinProfile')
+    raise profile_exception
+# endregion
 
-def init_connect_to_mongodb(ip, port, dbname, username=None, password=None):
-    """
-    :param ip:  ip server MongoDB
-    :param port: 27017
-    :return: True, if connected, and set value mongoclient - MongoClient
-    """
-    if username and password:
-        connect_string_to = f'mongodb://{username}:{password}@{ip}:{port}/{dbname}'
-    else:
-        connect_string_to = f'mongodb://{ip}:{port}/{dbname}'
-
-    check = False
-    count_repeat = 4
-    sleep_sec = 1
-    check_i = 0
-
-    while not check and check_i < count_repeat:
-        try:
-            client = MongoClient(connect_string_to, serverSelectionTimeoutMS=60)
-            client.server_info()
-            check = True
-        except Exception as ex:
-            print(f"try {check_i}, error:'{str(ex)}' connecting - error, sleep - 1 sec.")
-            time.sleep(sleep_sec)
-            check_i += 1
-        else:
-            return client
+chain_symbol_1 = '\u293e'
 
 
 def not_empty(field: Field):
     return Condition(field, Operations.NotEqual, '')
 
 
-def prepare_row_txaddress(line):
-    _result = dict()
-    _result['date_time'] = line['clean_datetime_block']
-    _result['txid'] = line['txid']
-    _result['short_txid'] = line['txid'][:8]
-
-    if 'vout' in line:
-        if isinstance(line['vout'], list):
-            for element in line['vout']:
-                _result['value'] = element['value']
-                if 'scriptPubKey' in element:
-                    if 'addresses' in element['scriptPubKey']:
-                        if isinstance(element['scriptPubKey']['addresses'], list):
-                            for a in element['scriptPubKey']['addresses']:
-                                _tmp = _result.copy()
-                                _tmp['address'] = a
-                                _tmp['short_address']= a[:8]
-                                yield _tmp
-
-
-def return_massive_simple_about_addresses_1(addresses, server, user, password):
-
-    def return_info_simple(search_dict, need_fields):
-        rows = db[collection_name_tx].find(search_dict, need_fields)
-        massive_all = [row for row in rows]
-
-        for row in massive_all:
-            rows_for_table_SimpleTxAddress = prepare_row_txaddress(row)
-            for line in rows_for_table_SimpleTxAddress:
-                yield line
-
-    if ':' in server:
-        ip, port = server.split(":")
-    else:
-        # try default
-        ip = server
-        port = '27017'
-
-    dbname = "NamecoinExplorer"
-    collection_name_tx = "Tx"
-    cl_mongo = init_connect_to_mongodb(ip, port, dbname, user, password)
-    if cl_mongo:
-        db = cl_mongo[dbname]
-
-        search_dict = {'$or': []}
-        for address in addresses:
-            _tmp_dict = {'vout.scriptPubKey.addresses': {'$regex': f"^{address}"}}
-            search_dict['$or'].append(_tmp_dict)
-
-        need_fields = {'_id': 0,
-                       'hash': 0,
-                       'version': 0,
-                       'size':0,
-                       'locktime': 0,
-                       'clean_name': 0,
-                       'clean_op': 0,
-                       'vsize': 0
-                       }
-        for line in return_info_simple(search_dict, need_fields):
-            yield line
-
-
-def return_massive_simple_about_txids_2(_txids, server, user, password):
-
-    if ':' in server:
-        ip, port = server.split(":")
-    else:
-        # try default
-        ip = server
-        port = '27017'
-
-    dbname = "NamecoinExplorer"
-    collection_name_tx = "Tx"
-    cl_mongo = init_connect_to_mongodb(ip, port, dbname, user, password)
-    if cl_mongo:
-        db = cl_mongo[dbname]
-        need_fields = {'_id':0,
-                       'txid':1}
-        search_dict = {'vin.txid':{"$in": _txids}}
-        rows = db[collection_name_tx].find(search_dict, need_fields)
-        txids = [row['txid'] for row in rows]
-
-        search_dict = {'txid':{"$in": txids}}
-
-        need_fields = {'_id': 0,
-                       'vin': 1,
-                       'txid': 1}
-        rows = db[collection_name_tx].find(search_dict, need_fields)
-        massive_all = [row for row in rows]
-        sub_result = []
-        for line in massive_all:
-            if 'vin' in line:
-                for element in line['vin']:
-                    _tmp = dict()
-                    _tmp['txid'] = line['txid']
-                    _tmp['cross_txid'] = element['txid']
-                    _tmp['vout'] = element['vout']
-                    sub_result.append(_tmp)
-        for row in sub_result:
-            search_dict = {'txid': row['cross_txid']}
-            need_fields = {'_id': 0,
-                           'vout': 1,
-                           'clean_datetime_block': 1}
-            element = db[collection_name_tx].find_one(search_dict, need_fields)
-            line = dict()
-            line['date_time'] = element['clean_datetime_block']
-            line['address'] = element['vout'][row['vout']]['scriptPubKey']['addresses'][0]
-            line['short_address'] = line['address'][:8]
-            line['value'] = element['vout'][row['vout']]['value']
-            line['txid'] = row['txid']
-            line['short_txid'] = row['txid'][:8]
-            yield line
-
-
 def check_direction_1(field: Field):
     return Condition(field, Operations.Equals, 1)
 
@@ -256,57 +127,54 @@ class NamecoinHistoryChainSearchAddressesMongoDB(Task):
                                 value_sources=[NamecoinAddress.namecoint_address,
                                                NamecoinAddress.namecoint_address_short],
                                 description='Namecoin Address, e.g.:\nMzHtiNhz - (min. 8 symbols)')
+        ep_coll.add_enter_param('depth', 'Depth(hops)', ValueType.Integer, predefined_values=[1, 2, 3, 5],
+                                default_value=1, required=True,
+                                description='1 - outputs of transactions of addresses,\n'
+                                            'inputs of transactions spending them')
+        ep_coll.add_enter_param('fan_out', 'Max. transactions in hop', ValueType.Integer,
+                                predefined_values=[100, 1000, 10000], default_value=1000, required=True)
+        ep_coll.add_enter_param('direction', 'Direction', ValueType.String, predefined_values=ChainTraversal.directions,
+                                default_value='both', required=True,
+                                description="""forward - to transactions which spend outputs\n"""
+                                            """backward - to transactions of inputs""")
         ep_coll.add_enter_param('server', 'Host with MongoDB', ValueType.String, is_array=False, required=True,
-                                default_value="68.183.0.119:27017")
+                                default_value="68.183.0.119:27017",
+                                description='host:port of MongoDB or local index of NamecoinIndex.py, e.g.:\n'
+                                            'sqlite:/home/user/lampyre_namecoin_index.sqlite')
         ep_coll.add_enter_param('usermongodb', 'user', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
         ep_coll.add_enter_param('passwordmongodb', 'password', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
+        ep_coll.add_enter_param('profile', 'Profile queries', ValueType.Boolean, required=False, default_value=False,
+                                description='time of stages, commands and plans of queries - summary in log')
         return ep_coll
 
+    @profiled
     def execute(self, enter_params, result_writer, log_writer, temp_dir=None):
         server = enter_params.server
         user = enter_params.usermongodb
         password = enter_params.passwordmongodb
         addresses = set([a.strip() for a in enter_params.addresses])
 
-        _table = list(return_massive_simple_about_addresses_1(addresses, server, user, password))
-        need_input_tx = list(set([row['txid'] for row in _table]))
-
-        table = []
-        union_table = []
+        db = connect_to_namecoin(server, user, password)
+        if db is None:
+            log_writer.error(f'MongoDB {server} is not available')
+            return
+        chain = ChainTraversal(db, depth=enter_params.depth, fan_out=enter_params.fan_out,
+                               direction=enter_params.direction, log=log_writer.info)
+        symbols = {DIRECTION_OUTPUT: Constants.RIGHTWARDS_ARROW,
+                   DIRECTION_INPUT: Constants.LEFTWARDS_ARROW}
         fields_table = UnionTxAddress.get_fields()
-
-        for row in _table:
-            row['SymbolDirection'] = Constants.RIGHTWARDS_ARROW
-            row['direction'] = 1
-            table.append(row)
-
-        for line in sorted(table, key=lambda line: line['date_time']):
-            tmp = UnionTxAddress.create_empty()
-            for field in fields_table:
-                if field in line:
-                    tmp[fields_table[field]] = line[field]
-            union_table.append(tmp)
-
-
-        _table = return_massive_simple_about_txids_2(need_input_tx, server, user, password)
-        table = []
-        for row in _table:
-            row['SymbolDirection'] = Constants.LEFTWARDS_ARROW
-            row['direction'] = 2
-            table.append(row)
-
-        for line in sorted(table, key=lambda line: line['date_time']):
-            tmp = UnionTxAddress.create_empty()
-            for field in fields_table:
-                if field in line:
-                    tmp[fields_table[field]] = line[field]
-            union_table.append(tmp)
-
-        for tmp_row in sorted(union_table, key=lambda line: line[fields_table['date_time']]):
-            result_writer.write_line(tmp_row, header_class=UnionTxAddress)
-
+        # rows of hop are written when hop is done
+        for hop, table in chain.walk_addresses(addresses):
+            for line in sorted(table, key=lambda line: (line['date_time'] is None, line['date_time'] or datetime.min)):
+                line['SymbolDirection'] = symbols[line['direction']]
+                tmp = UnionTxAddress.create_empty()
+                for field in fields_table:
+                    if field in line:
+                        tmp[fields_table[field]] = line[field]
+                result_writer.write_line(tmp, header_class=UnionTxAddress)
+            log_writer.info(f'hop {hop}: {len(table)} rows, visited transactions: {len(chain.visited)}')
 
 
 if __name__ == '__main__':
@@ -315,9 +183,13 @@ if __name__ == '__main__':
     class EnterParamsFake:
         addresses = ["N2rgk2Ev"]
 
+        depth = 2
+        fan_out = 1000
+        direction = 'both'
         server = "68.183.0.119:27017"
         usermongodb = "anonymous"
         passwordmongodb = "anonymous"
+        profile = False
 
 
     class WriterFake:
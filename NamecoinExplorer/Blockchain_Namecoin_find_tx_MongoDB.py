@@ -1,10 +1,8 @@
 # -*- coding: utf8 -*-
 __author__ = 'sai'
 
-import time
-from pymongo import MongoClient
-import ipaddress
-import re
+import os
+import itertools
 
 
 # region Import System Ontology
@@ -33,192 +31,48 @@ except ImportError as ontology_exception:
     raise ontology_exception
 # endregion
 
+# region load Namecoin MongoDB
+try:
+    from NamecoinMongoDB import (init_connect_to_mongodb, parse_server, prefix_filters, TXID_LENGTH, tx_rows,
+                                 tx_table_rows, bulk_path, read_identifiers, bulk_tx_rows, TXIDS_COLUMNS,
+                                 ADDRESSES_COLUMNS)
+except ImportError as mongodb_exception:
+    print('...missing or invalid NamecoinMongoDB')
+    raise mongodb_exception
+# endregion
 
-def return_ip(text):
-    result = []
-    ipPattern = r'(?:[\d]{1,3})\.(?:[\d]{1,3})\.(?:[\d]{1,3})\.(?:[\d]{1,3})'
-    ipaddress_subtmp = re.findall(ipPattern, text)
-    if ipaddress_subtmp:
-        for ip in ipaddress_subtmp:
-            try:
-                _ip = ipaddress.ip_address(ip.strip())
-                if str(_ip) not in result:
-                    result.append(str(_ip))
-            except:
-                pass
-    if len(result) > 0:
-        return result
-
-
-def init_connect_to_mongodb(ip, port, dbname, username=None, password=None):
-    """
-    :param ip:  ip server MongoDB
-    :param port: 27017
-    :return: True, if connected, and set value mongoclient - MongoClient
-    """
-    if username and password:
-        connect_string_to = f'mongodb://{username}:{password}@{ip}:{port}/{dbname}'
-    else:
-        connect_string_to = f'mongodb://{ip}:{port}/{dbname}'
-
-    check = False
-    count_repeat = 4
-    sleep_sec = 1
-    check_i = 0
-
-    while not check and check_i < count_repeat:
-        try:
-            client = MongoClient(connect_string_to, serverSelectionTimeoutMS=60)
-            client.server_info()
-            check = True
-        except Exception as ex:
-            print(f"try {check_i}, error:'{str(ex)}' connecting - error, sleep - 1 sec.")
-            time.sleep(sleep_sec)
-            check_i += 1
-        else:
-            return client
+# region load Namecoin profile
+try:
+    from NamecoinProfile import profiled
+except ImportError as profile_exception:
+    print('...missing or invalid NamecoinProfile')
+    raise profile_exception
+# endregion
 
 
 def not_empty(field: Field):
     return Condition(field, Operations.NotEqual, '')
 
 
-def return_massive_about_txids(txids, server, user, password):
-
-    def prepare_row_table_txids(line):
-
-        _name = line.copy()
-        _result = dict()
-
-        _result['date_time'] = line['clean_datetime_block']
-        _result['txid'] = line['txid']
-        _result['short_txid'] = line['txid'][:8]
-        _result['hash_block'] = line['blockhash']
-        if 'vin' in line:
-            if isinstance(line['vin'], list):
-                for tx in line['vin']:
-                    if 'txid' in tx:
-                        for_yield_line = _result.copy()
-                        for_yield_line['txid_in'] = tx['txid']
-                        for_yield_line['short_txid_in'] = tx['txid'][:8]
-                        yield {'value':for_yield_line,
-                               'type': 'txids'}
-
-    def prepare_row_table_address(line):
-
-        _name = line.copy()
-        _result = dict()
-
-        _result['date_time'] = line['clean_datetime_block']
-        _result['txid'] = line['txid']
-        _result['short_txid'] = line['txid'][:8]
-        _result['hash_block'] = line['blockhash']
-        _result_massive = []
-        if 'vout' in line:
-            if isinstance(line['vout'], list):
-                # go for vout
-                for el in line['vout']:
-                    for_yield_line = _result.copy()
-                    if 'value' in el:
-                        for_yield_line['value'] = el['value']
-                    if 'scriptPubKey' in el:
-                        if 'addresses' in el['scriptPubKey']:
-                            if isinstance(el['scriptPubKey']['addresses'], list):
-                                for_yield_line['address']= el['scriptPubKey']['addresses'][0]
-                                for_yield_line['short_address'] = el['scriptPubKey']['addresses'][0][:8]
-                        if 'nameOp' in el['scriptPubKey']:
-                            if 'op' in el['scriptPubKey']['nameOp']:
-                                for_yield_line['nameOp'] = el['scriptPubKey']['nameOp']['op']
-                            if 'name' in el['scriptPubKey']['nameOp']:
-                                for_yield_line['raw_name'] = el['scriptPubKey']['nameOp']['name']
-                            if 'value' in el['scriptPubKey']['nameOp']:
-                                for_yield_line['value_scripts'] = el['scriptPubKey']['nameOp']['value']
-                    if 'raw_name' in for_yield_line:
-                        _n = return_namecoin(for_yield_line['raw_name'])
-                        if _n:
-                            for_yield_line['namecoin_domain'] = _n['domain']
-                    _tmp_ips =None
-                    if 'value_scripts' in for_yield_line:
-                        _tmp_ips = return_ip(for_yield_line['value_scripts'].strip())
-                    if _tmp_ips:
-                        for ip in _tmp_ips:
-                            _row = for_yield_line.copy()
-                            _row['ip'] = ip
-                            yield {'value': _row,
-                                       'type': 'addresses'}
-                    else:
-                        yield {'value': for_yield_line,
-                               'type': 'addresses'}
-
-
-
-    def return_info(search_dict, need_fields):
-        rows = db[collection_name_tx].find(search_dict, need_fields)
-        massive_all = [row for row in rows]
-
-        _need_block_fields = {'_id': 1, 'height': 1}
-        hashs_block = list(set([row['blockhash'] for row in massive_all]))
-        _search_filter = {"_id": {"$in": hashs_block}}
-        _tmp = db[collection_name_blocks].find(_search_filter, _need_block_fields)
-        _cache = {}
-        for row in _tmp:
-            if row['_id'] not in _cache:
-                _cache[row['_id']] = row['height']
-
-        for row in massive_all:
-            if row['blockhash'] in _cache:
-                row['height_block'] = _cache[row['blockhash']]
-            rows_for_table_txids_lampyre = prepare_row_table_txids(row)
-            rows_for_table_addresses_lampyre = prepare_row_table_address(row)
-            # for _row in rows_for_table_lampyre:
-            #     # yield _row
-            # yield row
-            for line in rows_for_table_txids_lampyre:
-                yield line
-            for line in rows_for_table_addresses_lampyre:
-                yield line
-
-    if ':' in server:
-        ip, port = server.split(":")
-    else:
-        # try default
-        ip = server
-        port = '27017'
+def return_massive_about_txids(txids, server, user, password, bulk_file=None, temp_dir=None):
+
+    ip, port = parse_server(server)
 
     dbname = "NamecoinExplorer"
-    collection_name_blocks = "Blocks"
-    collection_name_tx = "Tx"
     cl_mongo = init_connect_to_mongodb(ip, port, dbname, user, password)
     if cl_mongo:
         db = cl_mongo[dbname]
 
-        search_dict = {'$or': []}
-        for txid in txids:
-            _tmp_dict = {'txid': {'$regex': f"^{txid}"}}
-            search_dict['$or'].append(_tmp_dict)
-            _tmp_dict = {'vin.txid':{'$regex': f"^{txid}"}}
-            search_dict['$or'].append(_tmp_dict)
-        need_fields = {'_id': 0,
-                       'hash':0,
-                       'version':0,
-                       'size':0,
-                       'locktime':0,
-                       'clean_name':0,
-                       'clean_op':0,
-                       'vsize':0
-                       }
-        for line in return_info(search_dict, need_fields):
+        # only needed fields, vin and vout are flattened by server
+        if bulk_file:
+            values = itertools.chain(txids, read_identifiers(bulk_file))
+            rows = bulk_tx_rows(db, values, ['txid', 'vin.txid'], TXID_LENGTH, temp_dir)
+        else:
+            rows = tx_rows(db, prefix_filters(txids, ['txid', 'vin.txid'], TXID_LENGTH))
+        for line in tx_table_rows(rows):
             yield line
 
 
-def return_namecoin(namedomain):
-    if namedomain.count(' ') == 0:
-        if namedomain.endswith(".bit"):
-            return {'domain': namedomain, 'namecoin_domain': f"d/{namedomain[:-4]}"}
-        elif namedomain.startswith('d/'):
-            return {'domain': namedomain[2:]+'.bit', 'namecoin_domain': namedomain}
-
-
 class NamecoinNamecoinTxtoNamecoinTx(metaclass=Schema):
     name = f'Namecoin schema: Namecoin transaction {Constants.RIGHTWARDS_ARROW} Namecoin transaction'
     Header = NamecoinTXnExplorer_in
@@ -246,7 +100,6 @@ class NamecoinNamecoinTxtoNamecoinAddress(metaclass=Schema):
                                                                NamecoinAddress.namecoint_address_short: Header.short_address})
 
 
-
     SchemaSchemaNamecoinTXid_to_SchemaAddress = NamecoinTXidToAddress.between(
         SchemaNamecoinTXid, SchemaAddress,
         mapping={NamecoinTXidToAddress.DateTime: Header.date_time,
@@ -313,52 +166,56 @@ class NamecoinHistoryTxMongoDB(Task):
 
     def get_enter_params(self):
         ep_coll = EnterParamCollection()
-        ep_coll.add_enter_param('txids', 'Namecoin txid', ValueType.String, is_array=True, required=True,
+        ep_coll.add_enter_param('txids', 'Namecoin txid', ValueType.String, is_array=True, required=False,
                                 value_sources=[NamecoinTXid.txid],
                                 description='Namecoin Transaction, e.g.:\n94a3ab7df4753a'
                                             '\n32f8cc90 - (min. 8 symbols)')
+        ep_coll.add_enter_param('bulk_file', 'File with txids', ValueType.String, file_path=True, required=False,
+                                description='bulk mode for big lists: file in temp directory of task or full path,\n'
+                                            'one or several txids per line')
         ep_coll.add_enter_param('server', 'Host with MongoDB', ValueType.String, is_array=False, required=True,
-                                default_value="68.183.0.119:27017")
+                                default_value="68.183.0.119:27017",
+                                description='host:port of MongoDB or local index of NamecoinIndex.py, e.g.:\n'
+                                            'sqlite:/home/user/lampyre_namecoin_index.sqlite')
         ep_coll.add_enter_param('usermongodb', 'user', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
         ep_coll.add_enter_param('passwordmongodb', 'password', ValueType.String, is_array=False, required=True,
                                 default_value="anonymous")
+        ep_coll.add_enter_param('profile', 'Profile queries', ValueType.Boolean, required=False, default_value=False,
+                                description='time of stages, commands and plans of queries - summary in log')
         return ep_coll
 
+    @profiled
     def execute(self, enter_params, result_writer, log_writer, temp_dir=None):
         server = enter_params.server
         user = enter_params.usermongodb
         password = enter_params.passwordmongodb
 
-        txids = set([a.strip() for a in enter_params.txids])
+        txids = set([a.strip() for a in enter_params.txids or []])
+        bulk_file = bulk_path(enter_params.bulk_file, temp_dir)
+        if bulk_file and not os.path.isfile(bulk_file):
+            log_writer.error(f'file is not found: {bulk_file}')
+            return
+        if not txids and not bulk_file:
+            log_writer.error('txids or file with txids are required')
+            return
 
         log_writer.info("Number of txids:{}".format(len(txids)))
-        result_lines = return_massive_about_txids(txids, server, user, password)
-
-        table_txids = []
-        table_addresses = []
-
-        for row in result_lines:
-            if row['type'] == 'txids':
-                table_txids.append(row['value'])
-            elif row['type'] == 'addresses':
-                table_addresses.append(row['value'])
-
-        for line in sorted(table_txids,  key=lambda line: line['date_time']):
-            fields_table = NamecoinTXnExplorer_in.get_fields()
-            tmp = NamecoinTXnExplorer_in.create_empty()
-            for field in fields_table:
-                if field in line:
-                    tmp[fields_table[field]] = line[field]
-            result_writer.write_line(tmp, header_class=NamecoinTXnExplorer_in)
-
-        for line in sorted(table_addresses,  key=lambda line: line['date_time']):
-            fields_table = NamecoinTXnExplorer_out.get_fields()
-            tmp = NamecoinTXnExplorer_out.create_empty()
-            for field in fields_table:
-                if field in line:
-                    tmp[fields_table[field]] = line[field]
-            result_writer.write_line(tmp, header_class=NamecoinTXnExplorer_out)
+        if bulk_file:
+            log_writer.info(f'txids from file:{bulk_file}')
+        result_lines = return_massive_about_txids(txids, server, user, password, bulk_file, temp_dir)
+
+        headers = {'txids': (NamecoinTXnExplorer_in, TXIDS_COLUMNS),
+                   'addresses': (NamecoinTXnExplorer_out, ADDRESSES_COLUMNS)}
+        columns = {}
+        for kind, (header, names) in headers.items():
+            fields_table = header.get_fields()
+            columns[kind] = (header, [fields_table[name] for name in names])
+
+        # rows are ordered by server (bulk mode - inside every batch) - written at once to both tables
+        for kind, values in result_lines:
+            header, fields = columns[kind]
+            result_writer.write_line(dict(zip(fields, values)), header_class=header)
 
 
 if __name__ == '__main__':
@@ -366,9 +223,11 @@ if __name__ == '__main__':
 
     class EnterParamsFake:
         txids = ['32f8cc90e2679e160b482']
+        bulk_file = None
         server = "68.183.0.119:27017"
         usermongodb = "anonymous"
         passwordmongodb = "anonymous"
+        profile = False
 
 
     class WriterFake:
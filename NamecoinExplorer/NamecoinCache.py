@@ -0,0 +1,217 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import json
+import time
+import pickle
+import hashlib
+import sqlite3
+import threading
+from os.path import expanduser, join as join_path
+
+BLOCKS_CACHE_PATH = join_path(expanduser('~'), 'lampyre_namecoin_blocks.sqlite')
+# block is cached by height after this count of confirmations - reorganizations do not reach it
+CONFIRMATIONS = 12
+# max. count of parameters in one sqlite query
+SQL_BATCH_SIZE = 500
+RESULTS_CACHE_PATH = join_path(expanduser('~'), 'lampyre_namecoin_results.sqlite')
+# bytes of all results, the least recently used are evicted
+RESULTS_CACHE_SIZE = 256 * 1024 * 1024
+# seconds to wait for lock of file held by other process
+RESULTS_CACHE_TIMEOUT = 30
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class BlockCache(object):
+    """
+    persistent (sqlite) cache of blocks shared by Namecoin lamps: height -> (hash, time), hash -> height.
+    Hash of block always has the same height, so hash -> height is stored for every block,
+    height -> hash - only for confirmed blocks. Read rows stay in memory for next lookups
+    """
+
+    def __init__(self, path=BLOCKS_CACHE_PATH):
+        """
+        :param path: sqlite file
+        """
+        self.lock = threading.Lock()
+        self.by_height = {}
+        self.by_hash = {}
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS blocks ('
+                'hash TEXT PRIMARY KEY, height INTEGER, time INTEGER, confirmed INTEGER)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS blocks_height ON blocks (height) WHERE confirmed = 1')
+
+    def select(self, query, values):
+        for start in range(0, len(values), SQL_BATCH_SIZE):
+            chunk = values[start:start + SQL_BATCH_SIZE]
+            yield from self.connection.execute(query % ','.join('?' * len(chunk)), chunk).fetchall()
+
+    def blocks(self, heights):
+        """
+        :return: dict height -> (hash, time) of confirmed blocks
+        """
+        with self.lock:
+            result = {height: self.by_height[height] for height in heights if height in self.by_height}
+            need = [height for height in set(heights) if height not in result]
+            if need:
+                for blockhash, height, blocktime in self.select(
+                        'SELECT hash, height, time FROM blocks '
+                        'WHERE confirmed = 1 AND time IS NOT NULL AND height IN (%s)', need):
+                    result[height] = self.by_height[height] = (blockhash, blocktime)
+                    self.by_hash[blockhash] = height
+        return result
+
+    def block(self, height):
+        return self.blocks([height]).get(height)
+
+    def heights(self, hashes):
+        """
+        :return: dict hash -> height
+        """
+        with self.lock:
+            result = {blockhash: self.by_hash[blockhash] for blockhash in hashes if blockhash in self.by_hash}
+            need = [blockhash for blockhash in set(hashes) if blockhash not in result]
+            if need:
+                for blockhash, height in self.select('SELECT hash, height FROM blocks WHERE hash IN (%s)', need):
+                    result[blockhash] = self.by_hash[blockhash] = height
+        return result
+
+    def put(self, rows):
+        """
+        :param rows: iterable of (height, hash, time or None, confirmations)
+        """
+        values = [(blockhash, height, blocktime, int(confirmations >= CONFIRMATIONS))
+                  for height, blockhash, blocktime, confirmations in rows]
+        if not values:
+            return
+        with self.lock, self.connection:
+            # known time and confirmation are not lost; not upsert - it needs SQLite 3.24+
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO blocks (hash, height, time, confirmed) '
+                'SELECT ?1, ?2, coalesce(?3, (SELECT time FROM blocks WHERE hash = ?1)), '
+                'max(?4, coalesce((SELECT confirmed FROM blocks WHERE hash = ?1), 0))', values)
+            for blockhash, height, blocktime, confirmed in values:
+                self.by_hash[blockhash] = height
+                if confirmed and blocktime is not None:
+                    self.by_height[height] = (blockhash, blocktime)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class ResultCache(object):
+    """
+    persistent (sqlite) LRU cache of results of lamps shared by processes: normalized query -> rows and height.
+    Only rows of blocks below height are stored - they are not changed, rows near tip are queried again
+    (from time "since" - the earliest row, which is not stored)
+    """
+
+    def __init__(self, path=RESULTS_CACHE_PATH, max_size=RESULTS_CACHE_SIZE):
+        """
+        :param path: sqlite file
+        :param max_size: bytes of all results
+        """
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=RESULTS_CACHE_TIMEOUT)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, rows BLOB, height INTEGER, size INTEGER, used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+
+    @staticmethod
+    def key(server, dbname, user, lamp, inputs, **params):
+        """
+        :param server: server of lamp ("host:port" or "sqlite:..."), dbname and user - results of one database
+                       are not shared with other databases and users
+        :param lamp: id of lamp (or of query)
+        :param inputs: values entered by user, order and duplicates do not change key
+        :return: str, hash of normalized query
+        """
+        query = [server, dbname, user, lamp, sorted(set(str(value) for value in inputs)), params]
+        return hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        :return: (list of rows, since, height) or None
+        """
+        with self.lock, self.connection:
+            record = self.connection.execute('SELECT rows, height FROM results WHERE key = ?', (key,)).fetchone()
+            if record is None:
+                return None
+            self.connection.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+        try:
+            value = pickle.loads(record[0])
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+        if not isinstance(value, tuple) or len(value) != 2:
+            # entry of other version
+            return None
+        rows, since = value
+        return rows, since, record[1]
+
+    def put(self, key, rows, height, since=None):
+        """
+        :param rows: list of rows of blocks with height <= height
+        :param since: time of the earliest row of result, which is not in rows (block is near tip or unknown)
+        """
+        data = pickle.dumps((rows, since), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO results (key, rows, height, size, used) VALUES (?,?,?,?,?)',
+                                    (key, data, height, len(data), time.time()))
+            self.evict()
+
+    def evict(self):
+        total = self.connection.execute('SELECT coalesce(sum(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_size:
+            return
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM results ORDER BY used'):
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        self.connection.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def block_cache(path=None):
+    """
+    One cache per file in process, when the file can not be opened - cache in memory only
+    """
+    path = path or BLOCKS_CACHE_PATH
+    with _caches_lock:
+        if path not in _caches:
+            try:
+                _caches[path] = BlockCache(path)
+            except sqlite3.Error as e:
+                print(f'block cache {path} is not available: {e}')
+                _caches[path] = BlockCache(':memory:')
+        return _caches[path]
+
+
+def result_cache(path=None):
+    """
+    One result cache per file in process, when the file can not be opened - cache in memory only
+    """
+    path = path or RESULTS_CACHE_PATH
+    with _caches_lock:
+        if path not in _caches:
+            try:
+                _caches[path] = ResultCache(path)
+            except sqlite3.Error as e:
+                print(f'result cache {path} is not available: {e}')
+                _caches[path] = ResultCache(':memory:')
+        return _caches[path]
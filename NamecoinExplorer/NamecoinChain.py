@@ -0,0 +1,182 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import concurrent.futures
+
+# region load Namecoin MongoDB
+try:
+    from NamecoinMongoDB import (COLLECTION_TX, TXID_LENGTH, ADDRESS_LENGTH, prefix_filters, find_batches,
+                                 resolve_vouts, remember_vouts)
+except ImportError as mongodb_exception:
+    print('...missing or invalid NamecoinMongoDB')
+    raise mongodb_exception
+# endregion
+
+# region load Namecoin profile
+try:
+    from NamecoinProfile import with_profile
+except ImportError as profile_exception:
+    print('...missing or invalid NamecoinProfile')
+    raise profile_exception
+# endregion
+
+# direction of row UnionTxAddress: 1 - transaction -> address(output), 2 - address(spent output) -> transaction
+DIRECTION_OUTPUT = 1
+DIRECTION_INPUT = 2
+
+
+class ChainTraversal(object):
+    """
+    Breadth-first walk over transactions: every hop is one batched query for frontier,
+    then spent outputs and next frontier - two independent queries in parallel,
+    visited transactions are not fetched again
+    """
+    directions = ['both', 'forward', 'backward']
+    need_fields = {'_id': 0,
+                   'txid': 1,
+                   'vin': 1,
+                   'vout': 1,
+                   'clean_datetime_block': 1}
+
+    def __init__(self, db, depth=1, fan_out=1000, direction='both', log=None):
+        """
+        :param depth: count of hops, 1 - only transactions from input
+        :param fan_out: max. transactions in one hop
+        :param direction: forward - to transactions which spend outputs, backward - to transactions of inputs
+        """
+        self.db = db
+        self.depth = depth
+        self.fan_out = fan_out
+        self.direction = direction if direction in self.directions else 'both'
+        self.log = log
+        self.visited = set()
+
+    def info(self, message):
+        if self.log:
+            self.log(message)
+
+    def walk_addresses(self, addresses):
+        """
+        Walk from addresses (or their prefixes): hop 1 - outputs of transactions paying addresses and inputs of
+        transactions spending their outputs; inputs of paying transactions and outputs of spenders are rows of hop 2,
+        with the next hop of both
+        :return: generator of (hop, rows for UnionTxAddress)
+        """
+        search_dicts = prefix_filters(addresses, ['vout.scriptPubKey.addresses'], ADDRESS_LENGTH)
+        paying = list(find_batches(self.db[COLLECTION_TX], search_dicts, self.need_fields))
+        search_dicts = prefix_filters(self.spenders([doc['txid'] for doc in paying]), ['txid'], TXID_LENGTH)
+        spending = list(find_batches(self.db[COLLECTION_TX], search_dicts, self.need_fields))
+        docs = paying + spending
+        self.visited.update(doc['txid'] for doc in docs)
+        remember_vouts(docs)
+        yield 1, list(self.outputs(paying)) + list(self.inputs(spending))
+        if self.depth == 1:
+            return
+        rows = []
+        if self.direction in ('both', 'forward'):
+            rows.extend(self.outputs(spending))
+        if self.direction in ('both', 'backward'):
+            rows.extend(self.inputs(paying))
+        yield from self.walk(self.next_frontier(docs), hop=2, rows=rows)
+
+    def spenders(self, txids):
+        search_dicts = prefix_filters(txids, ['vin.txid'], TXID_LENGTH)
+        return [row['txid'] for row in find_batches(self.db[COLLECTION_TX], search_dicts, {'_id': 0, 'txid': 1})]
+
+    def next_frontier(self, docs):
+        frontier = []
+        if self.direction in ('both', 'forward'):
+            frontier.extend(self.spenders([doc['txid'] for doc in docs]))
+        if self.direction in ('both', 'backward'):
+            frontier.extend(element['txid'] for doc in docs for element in doc.get('vin', []) if 'txid' in element)
+        return unique(frontier)
+
+    def walk(self, txids, hop=1, rows=()):
+        """
+        :param txids: txids or their prefixes
+        :param hop: number of the first hop
+        :param rows: rows added to the first hop
+        :return: generator of (hop, rows for UnionTxAddress), rows of hop are ready before next hop is fetched
+        """
+        frontier = unique(txids)
+        rows = list(rows)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for hop in range(hop, self.depth + 1):
+                frontier = [txid for txid in frontier if txid not in self.visited]
+                if not frontier:
+                    break
+                if len(frontier) > self.fan_out:
+                    self.info(f'hop {hop}: {len(frontier)} transactions, limited to {self.fan_out}')
+                    frontier = frontier[:self.fan_out]
+                self.visited.update(frontier)
+                search_dicts = prefix_filters(frontier, ['txid'], TXID_LENGTH)
+                docs = list(find_batches(self.db[COLLECTION_TX], search_dicts, self.need_fields))
+                # txids instead of prefixes from input
+                self.visited.update(doc['txid'] for doc in docs)
+                remember_vouts(docs)
+
+                # generator of inputs is run by other thread, spenders of next hop - while rows are written
+                inputs = executor.submit(with_profile(list), self.inputs(docs))
+                spenders = None
+                if hop < self.depth and self.direction in ('both', 'forward'):
+                    spenders = executor.submit(with_profile(self.spenders), [doc['txid'] for doc in docs])
+                rows.extend(self.outputs(docs))
+                rows.extend(inputs.result())
+                yield hop, rows
+                rows = []
+
+                if hop == self.depth:
+                    break
+                next_frontier = []
+                if spenders is not None:
+                    next_frontier.extend(spenders.result())
+                if self.direction in ('both', 'backward'):
+                    next_frontier.extend(element['txid'] for doc in docs for element in doc.get('vin', [])
+                                         if 'txid' in element)
+                frontier = unique(next_frontier)
+        if rows:
+            # frontier is empty - only rows of previous hop
+            yield hop, rows
+
+    @staticmethod
+    def outputs(docs):
+        for doc in docs:
+            for element in doc.get('vout', []):
+                addresses = element.get('scriptPubKey', {}).get('addresses')
+                if not isinstance(addresses, list):
+                    continue
+                for address in addresses:
+                    yield {'date_time': doc['clean_datetime_block'],
+                           'txid': doc['txid'],
+                           'short_txid': doc['txid'][:8],
+                           'value': element.get('value'),
+                           'address': address,
+                           'short_address': address[:8],
+                           'direction': DIRECTION_OUTPUT}
+
+    def inputs(self, docs):
+        spent = resolve_vouts(self.db, [element['txid'] for doc in docs for element in doc.get('vin', [])
+                                        if 'txid' in element])
+        for doc in docs:
+            for element in doc.get('vin', []):
+                if element.get('txid') not in spent:
+                    # coinbase or transaction is not in database
+                    continue
+                source = spent[element['txid']]
+                try:
+                    output = source['vout'][element['vout']]
+                    address = output['scriptPubKey']['addresses'][0]
+                except (IndexError, KeyError, TypeError):
+                    continue
+                yield {'date_time': source['clean_datetime_block'],
+                       'txid': doc['txid'],
+                       'short_txid': doc['txid'][:8],
+                       'value': output.get('value'),
+                       'address': address,
+                       'short_address': address[:8],
+                       'direction': DIRECTION_INPUT}
+
+
+def unique(values):
+    # order is kept - first transactions of input are in first hop
+    return list(dict.fromkeys(values))
@@ -0,0 +1,522 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import re
+import sys
+import json
+import sqlite3
+import datetime
+import threading
+from functools import lru_cache
+from os.path import expanduser, join as join_path
+
+# region load Namecoin MongoDB
+try:
+    from NamecoinMongoDB import (DBNAME, COLLECTION_TX, COLLECTION_BLOCKS, COLLECTION_NAMES, TRIGRAMS_FIELD,
+                                 IPS_KEY_FIELD, SORT_FIELD, INDEX_SCHEME, BATCH_SIZE, ASCENDING, OperationFailure,
+                                 ip_key, chunks, trigrams)
+    from NamecoinValues import transaction_ips
+except ImportError as mongodb_exception:
+    print('...missing or invalid NamecoinMongoDB, NamecoinValues')
+    raise mongodb_exception
+# endregion
+
+INDEX_PATH = join_path(expanduser('~'), 'lampyre_namecoin_index.sqlite')
+EPOCH = datetime.datetime(1970, 1, 1)
+# deterministic functions (Python 3.8+) can be used by query planner
+FUNCTION_FLAGS = {'deterministic': True} if sys.version_info >= (3, 8) else {}
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS tx (id INTEGER PRIMARY KEY, txid TEXT UNIQUE, blockhash TEXT, height INTEGER, '
+    'time REAL, clean_name TEXT, clean_op TEXT, doc TEXT)',
+    'CREATE TABLE IF NOT EXISTS tx_ip (tx INTEGER, ip TEXT, ip_key BLOB)',
+    'CREATE TABLE IF NOT EXISTS tx_address (tx INTEGER, address TEXT)',
+    'CREATE TABLE IF NOT EXISTS tx_vin (tx INTEGER, txid TEXT)',
+    'CREATE TABLE IF NOT EXISTS blocks (hash TEXT PRIMARY KEY, height INTEGER, time INTEGER)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    'CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS name_trigram (name INTEGER, trigram TEXT)',
+    'CREATE INDEX IF NOT EXISTS tx_time ON tx (time)',
+    'CREATE INDEX IF NOT EXISTS tx_clean_name ON tx (clean_name)',
+    'CREATE INDEX IF NOT EXISTS tx_height ON tx (height)',
+    'CREATE INDEX IF NOT EXISTS tx_ip_ip ON tx_ip (ip)',
+    'CREATE INDEX IF NOT EXISTS tx_ip_key ON tx_ip (ip_key)',
+    'CREATE INDEX IF NOT EXISTS tx_ip_tx ON tx_ip (tx)',
+    'CREATE INDEX IF NOT EXISTS tx_address_address ON tx_address (address)',
+    'CREATE INDEX IF NOT EXISTS tx_address_tx ON tx_address (tx)',
+    'CREATE INDEX IF NOT EXISTS tx_vin_txid ON tx_vin (txid)',
+    'CREATE INDEX IF NOT EXISTS tx_vin_tx ON tx_vin (tx)',
+    'CREATE INDEX IF NOT EXISTS blocks_height ON blocks (height)',
+    'CREATE INDEX IF NOT EXISTS name_trigram_trigram ON name_trigram (trigram)',
+]
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+@lru_cache(maxsize=256)
+def compiled_regex(pattern, options):
+    return re.compile(pattern, re.IGNORECASE if 'i' in (options or '') else 0)
+
+
+def regex_match(pattern, options, value):
+    return value is not None and compiled_regex(pattern, options).search(value) is not None
+
+
+def to_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return (value.replace(tzinfo=None) - EPOCH).total_seconds()
+    return value
+
+
+def from_timestamp(value):
+    if value is not None:
+        return EPOCH + datetime.timedelta(seconds=value)
+
+
+def sql_value(value):
+    # bson Binary and other subclasses of bytes - as blob
+    if isinstance(value, bytes):
+        return bytes(value)
+    return to_timestamp(value)
+
+
+def project(doc, projection):
+    """
+    Subset of MongoDB projection: top level fields, inclusion or exclusion
+    """
+    if not projection:
+        return doc
+    include = [field for field, value in projection.items() if value and field != '_id']
+    if include:
+        result = {field: doc[field] for field in include if field in doc}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return {field: value for field, value in doc.items() if projection.get(field, 1)}
+
+
+class IndexCursor(object):
+    """
+    Lazy result of find: query is executed by iteration
+    """
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self.order = []
+        self.count = None
+
+    def sort(self, key, direction=ASCENDING):
+        self.order = [(key, direction)] if isinstance(key, str) else list(key)
+        return self
+
+    def limit(self, count):
+        self.count = count or None
+        return self
+
+    def batch_size(self, count):
+        return self
+
+    def __iter__(self):
+        return self.collection.select(self.query, self.projection, self.order, self.count)
+
+
+class IndexCollection(object):
+    """
+    Subset of pymongo Collection over table of local index: filters by indexed fields with
+    equality, $in, $all, $gt/$gte/$lt/$lte, $regex, $exists, $elemMatch, $or, $and.
+    Conditions on arrays are matched by one element (as with $elemMatch).
+    Unsupported query - OperationFailure, like from MongoDB
+    """
+    table = None
+    # field -> column of table
+    scalar_fields = {}
+    # field -> (table of elements, column), element table has column element_owner with id of row
+    array_fields = {}
+    element_owner = 'tx'
+    # array of documents -> prefix of its fields in array_fields
+    element_arrays = {}
+
+    def __init__(self, database, name):
+        self.database = database
+        self.index = database.client
+        self.name = name
+
+    def find(self, query=None, projection=None):
+        return IndexCursor(self, query, projection)
+
+    def find_one(self, query=None, projection=None):
+        return next(iter(self.find(query, projection).limit(1)), None)
+
+    def count_documents(self, query):
+        where, params = self.compile(query)
+        return self.index.connection.execute(f'SELECT count(*) FROM {self.table} WHERE {where}', params).fetchone()[0]
+
+    def aggregate(self, pipeline, **kwargs):
+        raise OperationFailure('aggregation is not supported by local index')
+
+    def index_information(self):
+        fields = list(self.scalar_fields) + list(self.array_fields)
+        return {f'{field}_1': {'key': [(field, ASCENDING)]} for field in fields}
+
+    def create_index(self, keys, **kwargs):
+        # all indexes are created with tables
+        return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+    def compile(self, query):
+        """
+        :return: (sql condition, params)
+        """
+        params = []
+        parts = []
+        for key, value in (query or {}).items():
+            if key in ('$or', '$and'):
+                conditions = []
+                for sub_query in value:
+                    sql, sub_params = self.compile(sub_query)
+                    conditions.append(f'({sql})')
+                    params.extend(sub_params)
+                parts.append('(' + (' OR ' if key == '$or' else ' AND ').join(conditions or ['0']) + ')')
+            elif key in self.element_arrays and isinstance(value, dict) and '$elemMatch' in value:
+                for sub_field, condition in value['$elemMatch'].items():
+                    parts.append(self.field_condition(f'{self.element_arrays[key]}{sub_field}', condition, params))
+            else:
+                parts.append(self.field_condition(key, value, params))
+        return ' AND '.join(parts) or '1', params
+
+    def field_condition(self, field, condition, params):
+        if field in self.scalar_fields:
+            return self.operators(self.scalar_fields[field], condition, params)
+        if field in self.array_fields:
+            table, column = self.array_fields[field]
+            if isinstance(condition, dict) and '$elemMatch' in condition:
+                condition = condition['$elemMatch']
+            owner = self.element_owner
+            if isinstance(condition, dict) and list(condition) == ['$exists']:
+                negation = '' if condition['$exists'] else 'NOT '
+                return f'{self.table}.id {negation}IN (SELECT {owner} FROM {table})'
+            if isinstance(condition, dict) and list(condition) == ['$all']:
+                # intersection of posting lists
+                params.extend(sql_value(value) for value in condition['$all'])
+                return ' AND '.join([f'{self.table}.id IN (SELECT {owner} FROM {table} WHERE {column} = ?)']
+                                    * len(condition['$all'])) or '1'
+            sql = self.operators(column, condition, params)
+            return f'{self.table}.id IN (SELECT {owner} FROM {table} WHERE {sql})'
+        raise OperationFailure(f'field {field} is not indexed by local index')
+
+    @staticmethod
+    def operators(column, condition, params):
+        if condition is None:
+            # null matches missing field too
+            return f'{column} IS NULL'
+        if not isinstance(condition, dict):
+            params.append(sql_value(condition))
+            return f'{column} = ?'
+        parts = []
+        for operator, value in condition.items():
+            if operator == '$in':
+                values = [sql_value(v) for v in value]
+                params.extend(values)
+                parts.append(f'{column} IN ({",".join("?" * len(values))})')
+            elif operator in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+                params.append(sql_value(value))
+                sign = {'$eq': '=', '$ne': '!=', '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}[operator]
+                parts.append(f'{column} {sign} ?')
+            elif operator == '$regex':
+                params.extend([value, condition.get('$options', '')])
+                parts.append(f'mongo_regex(?, ?, {column})')
+            elif operator == '$options':
+                continue
+            elif operator == '$exists':
+                parts.append(f'{column} IS NOT NULL' if value else f'{column} IS NULL')
+            else:
+                raise OperationFailure(f'operator {operator} is not supported by local index')
+        return ' AND '.join(parts) or '1'
+
+    def sort_column(self, field):
+        if field not in self.scalar_fields:
+            raise OperationFailure(f'sort by {field} is not supported by local index')
+        return self.scalar_fields[field]
+
+    def select(self, query, projection, order, count):
+        where, params = self.compile(query)
+        sql = f'SELECT {self.select_columns} FROM {self.table} WHERE {where}'
+        if order:
+            sql += ' ORDER BY ' + ', '.join(f'{self.sort_column(field)} {"ASC" if direction >= 0 else "DESC"}'
+                                            for field, direction in order)
+        if count:
+            sql += f' LIMIT {int(count)}'
+        for record in self.index.connection.execute(sql, params):
+            yield project(self.document(record), projection)
+
+
+class TxCollection(IndexCollection):
+    table = 'tx'
+    scalar_fields = {'txid': 'tx.txid',
+                     'blockhash': 'tx.blockhash',
+                     'clean_name': 'tx.clean_name',
+                     'clean_op': 'tx.clean_op',
+                     SORT_FIELD: 'tx.time'}
+    array_fields = {'ips': ('tx_ip', 'ip'),
+                    IPS_KEY_FIELD: ('tx_ip', 'ip_key'),
+                    'vin.txid': ('tx_vin', 'txid'),
+                    'vout.scriptPubKey.addresses': ('tx_address', 'address')}
+    element_arrays = {'vin': 'vin.',
+                      'vout': 'vout.'}
+    select_columns = 'doc, time'
+
+    @staticmethod
+    def document(record):
+        doc = json.loads(record[0])
+        if record[1] is not None:
+            doc[SORT_FIELD] = from_timestamp(record[1])
+        return doc
+
+
+class BlocksCollection(IndexCollection):
+    table = 'blocks'
+    scalar_fields = {'_id': 'blocks.hash',
+                     'height': 'blocks.height',
+                     'time': 'blocks.time'}
+    select_columns = 'hash, height, time'
+
+    @staticmethod
+    def document(record):
+        doc = {'_id': record[0], 'height': record[1]}
+        if record[2] is not None:
+            doc['time'] = record[2]
+        return doc
+
+
+class NamesCollection(IndexCollection):
+    table = 'names'
+    scalar_fields = {'_id': 'names.name'}
+    array_fields = {TRIGRAMS_FIELD: ('name_trigram', 'trigram')}
+    element_owner = 'name'
+    select_columns = 'name'
+
+    @staticmethod
+    def document(record):
+        return {'_id': record[0]}
+
+
+class IndexDatabase(object):
+    collections = {COLLECTION_TX: TxCollection,
+                   COLLECTION_BLOCKS: BlocksCollection,
+                   COLLECTION_NAMES: NamesCollection}
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            raise OperationFailure(f'collection {name} is not in local index')
+        return self.collections[name](self, name)
+
+
+class NamecoinIndex(object):
+    """
+    Local embedded (sqlite) index of Namecoin transactions with secondary indexes:
+    name, ip (text and range key), address, spent txid, txid (prefix - by range), time of block,
+    trigrams of names.
+    Can be used by lamps instead of MongoClient: NamecoinIndex(path)[DBNAME][COLLECTION_TX].find(...)
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        with self.write_lock, self.connection:
+            for sql in SCHEMA:
+                self.connection.execute(sql)
+
+    @property
+    def connection(self):
+        # connection per thread - queries of one lamp can be executed in parallel
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('PRAGMA mmap_size=268435456')
+            connection.create_function('mongo_regex', 3, regex_match, **FUNCTION_FLAGS)
+            self.local.connection = connection
+        return connection
+
+    def __getitem__(self, name):
+        return IndexDatabase(self, name)
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    @staticmethod
+    def transaction_rows(doc):
+        """
+        :return: (row of tx, ips, addresses, spent txids) for document of Tx
+        """
+        doc = {field: value for field, value in doc.items() if field not in ('_id', IPS_KEY_FIELD, SORT_FIELD)}
+        if 'ips' not in doc:
+            # ips of lamps are materialized at ingestion
+            ips = transaction_ips(doc)
+            if ips:
+                doc['ips'] = ips
+        addresses = [address for element in doc.get('vout', [])
+                     for address in (element.get('scriptPubKey', {}).get('addresses') or [])]
+        spent = [element['txid'] for element in doc.get('vin', []) if 'txid' in element]
+        return doc, list(dict.fromkeys(doc.get('ips') or [])), list(dict.fromkeys(addresses)), spent
+
+    def add_transactions(self, docs, connection=None):
+        """
+        Insert or replace documents of Tx (MongoDB layout) with rows of secondary indexes,
+        all documents - in one sqlite transaction
+        :param connection: connection with open transaction of caller
+        """
+        if connection is None:
+            with self.write_lock, self.connection as connection:
+                return self.add_transactions(docs, connection)
+        count = 0
+        for source in docs:
+            doc, ips, addresses, spent = self.transaction_rows(source)
+            self.remove_transactions([doc['txid']], connection)
+            # height - from blocks of index
+            cursor = connection.execute(
+                'INSERT INTO tx (txid, blockhash, height, time, clean_name, clean_op, doc) '
+                'VALUES (?, ?, (SELECT height FROM blocks WHERE hash = ?), ?, ?, ?, ?)',
+                (doc['txid'], doc.get('blockhash'), doc.get('blockhash'), to_timestamp(source.get(SORT_FIELD)),
+                 doc.get('clean_name'), doc.get('clean_op'), json.dumps(doc, default=str)))
+            tx = cursor.lastrowid
+            ip_rows = []
+            for ip in ips:
+                try:
+                    key = bytes(ip_key(ip))
+                except (ValueError, AttributeError):
+                    key = None
+                ip_rows.append((tx, ip, key))
+            connection.executemany('INSERT INTO tx_ip (tx, ip, ip_key) VALUES (?,?,?)', ip_rows)
+            connection.executemany('INSERT INTO tx_address (tx, address) VALUES (?,?)',
+                                   [(tx, address) for address in addresses])
+            connection.executemany('INSERT INTO tx_vin (tx, txid) VALUES (?,?)', [(tx, txid) for txid in spent])
+            if isinstance(doc.get('clean_name'), str):
+                self.add_name(doc['clean_name'], connection)
+            count += 1
+        return count
+
+    @staticmethod
+    def add_name(name, connection):
+        cursor = connection.execute('INSERT OR IGNORE INTO names (name) VALUES (?)', (name,))
+        if cursor.rowcount == 1:
+            connection.executemany('INSERT INTO name_trigram (name, trigram) VALUES (?,?)',
+                                   [(cursor.lastrowid, trigram) for trigram in trigrams(name)])
+
+    @staticmethod
+    def remove_transactions(txids, connection):
+        for chunk in chunks(txids, 500):
+            marks = ','.join('?' * len(chunk))
+            for table in ('tx_ip', 'tx_address', 'tx_vin'):
+                connection.execute(f'DELETE FROM {table} WHERE tx IN (SELECT id FROM tx WHERE txid IN ({marks}))',
+                                   chunk)
+            connection.execute(f'DELETE FROM tx WHERE txid IN ({marks})', chunk)
+
+    def meta(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value, connection=None):
+        if connection is None:
+            with self.write_lock, self.connection as connection:
+                return self.set_meta(key, value, connection)
+        connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?,?)', (key, str(value)))
+
+    def last_height(self):
+        """
+        :return: height of last synchronized block, -1 - index is empty
+        """
+        return int(self.meta('height', -1))
+
+    def block_hashes(self, heights):
+        """
+        :return: dict height -> hash of blocks in index
+        """
+        result = {}
+        for chunk in chunks(list(heights), 500):
+            result.update(self.connection.execute(
+                f'SELECT height, hash FROM blocks WHERE height IN ({",".join("?" * len(chunk))})', chunk))
+        return result
+
+    def rollback(self, height, connection=None):
+        """
+        Remove blocks above height (orphaned by reorganization) with their transactions
+        """
+        if connection is None:
+            with self.write_lock, self.connection as connection:
+                return self.rollback(height, connection)
+        for table in ('tx_ip', 'tx_address', 'tx_vin'):
+            connection.execute(f'DELETE FROM {table} WHERE tx IN (SELECT id FROM tx WHERE height > ?)', (height,))
+        connection.execute('DELETE FROM tx WHERE height > ?', (height,))
+        connection.execute('DELETE FROM blocks WHERE height > ?', (height,))
+        self.set_meta('height', height, connection)
+
+    def add_blocks(self, blocks, connection=None):
+        """
+        :param blocks: iterable of (hash, height, time or None)
+        """
+        if connection is None:
+            with self.write_lock, self.connection as connection:
+                return self.add_blocks(blocks, connection)
+        connection.executemany('INSERT OR REPLACE INTO blocks (hash, height, time) VALUES (?,?,?)', blocks)
+
+    def ingest_mongo(self, db, batch_size=BATCH_SIZE, log=print):
+        """
+        Copy of Tx and Blocks from MongoDB NamecoinExplorer, batch_size documents in one sqlite transaction,
+        blocks are first - transactions get height of their block
+        """
+        count = 0
+        for chunk in chunks(db[COLLECTION_BLOCKS].find({}, {'_id': 1, 'height': 1, 'time': 1}), batch_size):
+            self.add_blocks([(row['_id'], row.get('height'), row.get('time')) for row in chunk])
+            count += len(chunk)
+        log(f'{COLLECTION_BLOCKS}: {count}')
+        count = 0
+        for chunk in chunks(db[COLLECTION_TX].find({}, {'_id': 0, IPS_KEY_FIELD: 0}), batch_size):
+            count += self.add_transactions(chunk)
+            log(f'{COLLECTION_TX}: {count}')
+        # synchronization with namecoind continues from the last block of copy
+        last = self.connection.execute('SELECT max(height) FROM blocks').fetchone()[0]
+        self.set_meta('height', -1 if last is None else last)
+        return count
+
+
+def open_index(server):
+    """
+    :param server: "sqlite:" (default file) or "sqlite:/path/to/index.sqlite"
+    :return: NamecoinIndex, one per file in process
+    """
+    path = server[len(INDEX_SCHEME):].strip() or INDEX_PATH
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = NamecoinIndex(path)
+        return _indexes[path]
+
+
+if __name__ == '__main__':
+    import argparse
+    from NamecoinMongoDB import connect_to_namecoin
+
+    parser = argparse.ArgumentParser(description='local index of NamecoinExplorer')
+    parser.add_argument('--path', default=INDEX_PATH)
+    parser.add_argument('--from-mongo', default=None, help='copy Tx and Blocks from MongoDB "host:port"')
+    parser.add_argument('--user', default=None)
+    parser.add_argument('--password', default=None)
+    args = parser.parse_args()
+    index = open_index(INDEX_SCHEME + args.path)
+    if args.from_mongo:
+        db = connect_to_namecoin(args.from_mongo, args.user, args.password)
+        if db is None:
+            raise SystemExit('MongoDB is not available')
+        index.ingest_mongo(db)
+    print(index[DBNAME][COLLECTION_TX].count_documents({}), 'transactions in', args.path)
@@ -0,0 +1,1035 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import os
+import re
+import time
+import sqlite3
+import tempfile
+import threading
+import ipaddress
+import concurrent.futures
+import heapq
+import queue
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from urllib.parse import quote_plus
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import OperationFailure
+from bson.binary import Binary
+from NamecoinCache import block_cache, result_cache, CONFIRMATIONS
+from NamecoinValues import transaction_ips, value_ips
+from NamecoinProfile import CommandMonitor, profile_stage, profile_iter, with_profile
+
+DBNAME = "NamecoinExplorer"
+COLLECTION_TX = "Tx"
+COLLECTION_BLOCKS = "Blocks"
+# clean_name -> trigrams of lower case name, index for search by substring
+COLLECTION_NAMES = "Names"
+TRIGRAMS_FIELD = 'trigrams'
+DEFAULT_PORT = '27017'
+# server of lamps "sqlite:/path/to/index.sqlite" - local index (NamecoinIndex) instead of MongoDB
+INDEX_SCHEME = 'sqlite:'
+# companion of "ips": 16 bytes per address (IPv4 as ::ffff:a.b.c.d), byte order == numeric order
+IPS_KEY_FIELD = 'ips_key'
+# size of query with $in
+BATCH_SIZE = 1000
+VOUT_CACHE_SIZE = 100000
+HEIGHT_CACHE_SIZE = 100000
+# rows of lamps are ordered by time of block (index on Tx)
+SORT_FIELD = 'clean_datetime_block'
+# more filters are not merged by open cursors, but sorted in memory
+MERGE_LIMIT = 64
+# ranges (prefixes) in one query
+RANGE_BATCH_SIZE = 100
+QUERY_WORKERS = 4
+# rows read ahead by one producer of prefetch_ordered
+PREFETCH_SIZE = 1000
+# unique identifiers of bulk mode (file) in one batch of queries
+BULK_BATCH_SIZE = BATCH_SIZE
+# widths of time buckets of date range - the narrowest one, which gives not more than MAX_DATE_BUCKETS buckets;
+# buckets are aligned to multiples of width - the same buckets (keys of result cache) for different ranges
+DATE_BUCKETS = (timedelta(days=1), timedelta(days=7), timedelta(days=30), timedelta(days=365))
+MAX_DATE_BUCKETS = 32
+# time of block may be earlier than time of previous blocks: rows near tip are queried from
+# the last cached time minus this slack
+TIME_SLACK = timedelta(hours=2)
+# bigger results are not stored in result cache
+CACHED_ROWS_LIMIT = 100000
+TXID_LENGTH = 64
+ADDRESS_LENGTH = 34
+# fields inside arrays: bounds of range have to match the same element - field -> (array, field in element)
+# term with them is regular expression, not substring for trigram index
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+ARRAY_FIELDS = {'vin.txid': ('vin', 'txid'),
+                'vout.scriptPubKey.addresses': ('vout.scriptPubKey.addresses', None)}
+
+# one client (with own connection pool) per server for whole process: lamps and repeated runs share it
+_clients = {}
+_checked = set()
+_lock = threading.Lock()
+_indexes = {}
+# txid -> {'clean_datetime_block', 'vout'}, outputs of transaction are not changed
+_vouts = OrderedDict()
+_vouts_lock = threading.Lock()
+# blockhash -> height
+_heights = OrderedDict()
+_heights_lock = threading.Lock()
+# clients, for which aggregation with $lookup failed
+_no_aggregation = set()
+
+
+def parse_server(server):
+    """
+    :param server: "host:port" or "host"
+    :return: (host, port)
+    """
+    server = server.strip()
+    if server.startswith(INDEX_SCHEME):
+        return server, None
+    if server.startswith('[') and ']' in server:
+        # [IPv6]:port
+        host, _, port = server[1:].partition(']')
+        return host, port.lstrip(':') or DEFAULT_PORT
+    if server.count(':') == 1:
+        host, port = server.split(':')
+        return host, port or DEFAULT_PORT
+    return server, DEFAULT_PORT
+
+
+def mongodb_uri(ip, port, dbname, username=None, password=None):
+    host = f'[{ip}]' if ':' in ip else ip
+    if username and password:
+        return f'mongodb://{quote_plus(username)}:{quote_plus(password)}@{host}:{port}/{dbname}'
+    return f'mongodb://{host}:{port}/{dbname}'
+
+
+def init_connect_to_mongodb(ip, port, dbname, username=None, password=None, count_repeat=4, sleep_sec=1):
+    """
+    Shared MongoClient: created once per server (connections are opened lazily by pool),
+    availability is checked only by first call in process
+    :param ip:  ip server MongoDB or "sqlite:..." - local index
+    :param port: 27017
+    :return: MongoClient (NamecoinIndex for local index), None - if server is not available
+    """
+    if ip.startswith(INDEX_SCHEME):
+        from NamecoinIndex import open_index
+        return open_index(ip)
+    connect_string_to = mongodb_uri(ip, port, dbname, username, password)
+    # lock only for pool of clients - other servers are not waited while this one is checked
+    with _lock:
+        client = _clients.get(connect_string_to)
+        if client is None:
+            # commands are recorded by profile of lamp (NamecoinProfile), when it is started
+            monitor = CommandMonitor()
+            client = MongoClient(connect_string_to, connect=False, appname='Lampyre NamecoinExplorer',
+                                 maxPoolSize=32, maxIdleTimeMS=300000,
+                                 serverSelectionTimeoutMS=2000, connectTimeoutMS=5000, event_listeners=[monitor])
+            monitor.client = client
+            _clients[connect_string_to] = client
+        if connect_string_to in _checked:
+            return client
+
+    check_i = 0
+    while check_i < count_repeat:
+        try:
+            # server selection and connection
+            with profile_stage('connect'):
+                client.admin.command('ping')
+        except Exception as ex:
+            print(f"try {check_i}, error:'{str(ex)}', connecting - error, sleep - {sleep_sec} sec.")
+            time.sleep(sleep_sec)
+            check_i += 1
+        else:
+            with _lock:
+                _checked.add(connect_string_to)
+            return client
+    # next call checks server again
+    with _lock:
+        if connect_string_to in _checked:
+            # other call has checked server meanwhile
+            return client
+        if _clients.get(connect_string_to) is not client:
+            # other call has closed it
+            return None
+        _clients.pop(connect_string_to)
+    client.close()
+
+
+def connect_to_namecoin(server, username=None, password=None):
+    """
+    :param server: "host:port" of MongoDB
+    :return: Database NamecoinExplorer, None - if server is not available
+    """
+    ip, port = parse_server(server)
+    client = init_connect_to_mongodb(ip, port, DBNAME, username, password)
+    if client:
+        return client[DBNAME]
+
+
+def close_all():
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _checked.clear()
+
+
+def ip_key(ip):
+    """
+    :param ip: IPv4Address, IPv6Address or str
+    :return: Binary(16 bytes), ranges of keys are ranges of addresses for IPv4 and IPv6
+    """
+    if not isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+        ip = ipaddress.ip_address(ip.strip())
+    if ip.version == 4:
+        return Binary(b'\x00' * 10 + b'\xff\xff' + ip.packed)
+    return Binary(ip.packed)
+
+
+def ips_keys(ips):
+    keys = []
+    for ip in ips:
+        try:
+            key = ip_key(ip)
+        except (ValueError, AttributeError):
+            continue
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def network_filter(network):
+    """
+    :param network: IPv4Network or IPv6Network
+    :return: filter for Tx - one range on ips_key index instead of $in for every address
+    """
+    return {IPS_KEY_FIELD: {"$elemMatch": {"$gte": ip_key(network[0]), "$lte": ip_key(network[-1])}}}
+
+
+def has_index(db, collection_name, field):
+    key = (id(db.client), db.name, collection_name, field)
+    if key not in _indexes:
+        try:
+            _indexes[key] = any(index['key'][0][0] == field
+                                for index in db[collection_name].index_information().values())
+        except Exception:
+            _indexes[key] = False
+    return _indexes[key]
+
+
+def ensure_ips_key(db, batch_size=1000, log=print):
+    """
+    Backfill ips_key for documents with ips and build index, new documents should be written with
+    ips_key = ips_keys(ips) by ingestion
+    """
+    collection = db[COLLECTION_TX]
+    search_dict = {"ips": {"$exists": True}, IPS_KEY_FIELD: {"$exists": False}}
+    requests = []
+    count = 0
+    for row in collection.find(search_dict, {'ips': 1}):
+        requests.append(UpdateOne({'_id': row['_id']}, {"$set": {IPS_KEY_FIELD: ips_keys(row['ips'])}}))
+        if len(requests) >= batch_size:
+            collection.bulk_write(requests, ordered=False)
+            count += len(requests)
+            requests = []
+            log(f'{IPS_KEY_FIELD}: {count}')
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+        count += len(requests)
+    collection.create_index([(IPS_KEY_FIELD, ASCENDING)])
+    _indexes.clear()
+    log(f'{IPS_KEY_FIELD}: {count} documents, index is ready')
+    return count
+
+
+def ensure_ips(db, batch_size=1000, log=print):
+    """
+    Materialize ips (and ips_key) of name operations for documents without them
+    """
+    collection = db[COLLECTION_TX]
+    search_dict = {"vout.scriptPubKey.nameOp.value": {"$exists": True}, "ips": {"$exists": False}}
+    requests = []
+    count = 0
+    for row in collection.find(search_dict, {'vout': 1}):
+        ips = transaction_ips(row)
+        if not ips:
+            continue
+        requests.append(UpdateOne({'_id': row['_id']}, {"$set": {'ips': ips, IPS_KEY_FIELD: ips_keys(ips)}}))
+        if len(requests) >= batch_size:
+            collection.bulk_write(requests, ordered=False)
+            count += len(requests)
+            requests = []
+            log(f'ips: {count}')
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+        count += len(requests)
+    log(f'ips: {count} documents')
+    return count
+
+
+def trigrams(text):
+    text = text.lower()
+    return sorted({text[i:i + 3] for i in range(len(text) - 2)})
+
+
+def ensure_name_trigrams(db, batch_size=1000, log=print):
+    """
+    Collection Names (clean_name and its trigrams) with index on trigrams, new names should be added
+    by ingestion
+    """
+    pipeline = [{'$match': {'clean_name': {'$type': 'string'}}},
+                {'$group': {'_id': '$clean_name'}}]
+    requests = []
+    count = 0
+    for row in db[COLLECTION_TX].aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+        requests.append(UpdateOne({'_id': row['_id']}, {"$set": {TRIGRAMS_FIELD: trigrams(row['_id'])}},
+                                  upsert=True))
+        if len(requests) >= batch_size:
+            db[COLLECTION_NAMES].bulk_write(requests, ordered=False)
+            count += len(requests)
+            requests = []
+            log(f'{COLLECTION_NAMES}: {count}')
+    if requests:
+        db[COLLECTION_NAMES].bulk_write(requests, ordered=False)
+        count += len(requests)
+    db[COLLECTION_NAMES].create_index([(TRIGRAMS_FIELD, ASCENDING)])
+    _indexes.clear()
+    log(f'{COLLECTION_NAMES}: {count} names, index is ready')
+    return count
+
+
+def name_like_filters(db, terms):
+    """
+    Plan for search of names by case-insensitive substrings: literal terms of 3+ chars - candidates
+    from trigram index (intersection of posting lists by $all), verified on client, then $in by clean_name;
+    short terms, regular expressions and database without Names - $regex
+    """
+    indexed = has_index(db, COLLECTION_NAMES, TRIGRAMS_FIELD)
+    names = {}
+    regex = []
+    for term in terms:
+        term = term.strip()
+        if not term:
+            continue
+        if indexed and len(term) >= 3 and not REGEX_CHARS & set(term):
+            lower = term.lower()
+            candidates = db[COLLECTION_NAMES].find({TRIGRAMS_FIELD: {'$all': trigrams(lower)}}, {'_id': 1})
+            for row in profile_iter(f'{COLLECTION_NAMES} trigrams', candidates):
+                if lower in row['_id'].lower():
+                    names[row['_id']] = None
+        else:
+            regex.append({'clean_name': {'$regex': term, '$options': 'i'}})
+    filters = [{'clean_name': {'$in': chunk}} for chunk in chunks(sorted(names), BATCH_SIZE)]
+    if regex:
+        filters.append({'$or': regex})
+    return filters
+
+
+def chunks(iterable, count=BATCH_SIZE):
+    chunk = []
+    for element in iterable:
+        chunk.append(element)
+        if len(chunk) >= count:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def resolve_vouts(db, txids, batch_size=BATCH_SIZE):
+    """
+    Outputs of transactions (spent by vin): one $in query per batch_size txids, known txids from cache
+    :return: dict txid -> {'clean_datetime_block', 'vout'}
+    """
+    result = {}
+    need = []
+    with _vouts_lock:
+        for txid in set(txids):
+            if txid in _vouts:
+                _vouts.move_to_end(txid)
+                result[txid] = _vouts[txid]
+            else:
+                need.append(txid)
+    need_fields = {'_id': 0,
+                   'txid': 1,
+                   'vout': 1,
+                   'clean_datetime_block': 1}
+    for chunk in chunks(need, batch_size):
+        with profile_stage(f'{COLLECTION_TX} vouts'):
+            rows = list(db[COLLECTION_TX].find({'txid': {"$in": chunk}}, need_fields))
+        with _vouts_lock:
+            for row in rows:
+                result[row['txid']] = _vouts[row['txid']] = row
+            while len(_vouts) > VOUT_CACHE_SIZE:
+                _vouts.popitem(last=False)
+    return result
+
+
+def remember_vouts(rows):
+    """
+    Put already fetched transactions (with txid, vout, clean_datetime_block) into cache of resolve_vouts
+    """
+    with _vouts_lock:
+        for row in rows:
+            if 'txid' in row and 'vout' in row:
+                _vouts[row['txid']] = {'txid': row['txid'], 'vout': row['vout'],
+                                       'clean_datetime_block': row.get('clean_datetime_block')}
+                _vouts.move_to_end(row['txid'])
+        while len(_vouts) > VOUT_CACHE_SIZE:
+            _vouts.popitem(last=False)
+
+
+def resolve_heights(db, hashes, batch_size=BATCH_SIZE):
+    """
+    Heights of blocks: known - from memory, then from block cache on disk (shared with other lamps),
+    one $in query per batch_size unknown hashes
+    :return: dict blockhash -> height
+    """
+    result = {}
+    need = []
+    with _heights_lock:
+        for blockhash in set(hashes):
+            if blockhash in _heights:
+                _heights.move_to_end(blockhash)
+                result[blockhash] = _heights[blockhash]
+            else:
+                need.append(blockhash)
+    if need:
+        cache = block_cache()
+        cached = cache.heights(need)
+        result.update(cached)
+        need = [blockhash for blockhash in need if blockhash not in cached]
+    for chunk in chunks(need, batch_size):
+        with profile_stage(f'{COLLECTION_BLOCKS} heights'):
+            rows = list(db[COLLECTION_BLOCKS].find({"_id": {"$in": chunk}}, {'_id': 1, 'height': 1, 'time': 1}))
+        # height of hash is not changed, confirmations are unknown - block is not cached by height
+        cache.put((row['height'], row['_id'], row.get('time'), 0) for row in rows)
+        with _heights_lock:
+            for row in rows:
+                result[row['_id']] = _heights[row['_id']] = row['height']
+            while len(_heights) > HEIGHT_CACHE_SIZE:
+                _heights.popitem(last=False)
+    return result
+
+
+def with_heights(db, rows, batch_size=BATCH_SIZE):
+    """
+    Stream of Tx rows with height_block, heights are resolved for every batch_size rows -
+    by other thread, while next batch is read from Tx
+    """
+    def resolve(chunk):
+        heights = resolve_heights(db, [row['blockhash'] for row in chunk if 'blockhash' in row])
+        for row in chunk:
+            if row.get('blockhash') in heights:
+                row['height_block'] = heights[row['blockhash']]
+        return chunk
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for chunk in chunks(rows, batch_size):
+            future = executor.submit(with_profile(resolve), chunk)
+            if pending is not None:
+                yield from pending.result()
+            pending = future
+        if pending is not None:
+            yield from pending.result()
+
+
+def find_sorted(collection, filters, need_fields, sort_field=SORT_FIELD, limit=None):
+    """
+    Stream of documents for all filters ordered by sort_field: every cursor is sorted by server,
+    cursors are merged, the same transaction from different filters - once
+    (more than MERGE_LIMIT filters - fetched one by one and sorted in memory)
+    """
+    def find(search_dict):
+        cursor = collection.find(search_dict, need_fields).sort(sort_field, ASCENDING).batch_size(BATCH_SIZE)
+        if limit:
+            cursor = cursor.limit(limit)
+        return profile_iter(f'{collection.name} find', cursor)
+
+    return merge_sorted(filters, find, sort_field, lambda row: row.get('txid'))
+
+
+def open_cursors(open_cursor, filters, workers=QUERY_WORKERS):
+    """
+    Independent queries are started in parallel by shared client (first batch of every cursor)
+    :return: dict id(filter) -> cursor for the first MERGE_LIMIT filters
+    """
+    filters = filters[:MERGE_LIMIT]
+    if workers > 1 and len(filters) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            cursors = list(executor.map(with_profile(open_cursor), filters))
+    else:
+        cursors = list(map(open_cursor, filters))
+    return {id(search_dict): cursor for search_dict, cursor in zip(filters, cursors)}
+
+
+def merge_sorted(filters, find, sort_field, unique_key):
+    """
+    :param find: function, filter -> cursor ordered by sort_field
+    :param unique_key: function, row -> key of the same row from different filters, None - not checked
+    """
+    if len(filters) == 1:
+        yield from find(filters[0])
+        return
+    seen = set()
+    # documents without field are first - like in MongoDB
+    key = lambda row: (row.get(sort_field) is not None, row.get(sort_field))
+    if len(filters) > MERGE_LIMIT:
+        rows = sorted((row for search_dict in filters for row in find(search_dict)), key=key)
+    else:
+        rows = heapq.merge(*map(find, filters), key=key)
+    for row in rows:
+        row_key = unique_key(row)
+        if row_key is not None:
+            if row_key in seen:
+                continue
+            seen.add(row_key)
+        yield row
+
+
+def time_buckets(start, stop, widths=DATE_BUCKETS, limit=MAX_DATE_BUCKETS):
+    """
+    Filters on SORT_FIELD for consecutive disjoint buckets of [start, stop], not more than limit buckets:
+    width is the narrowest of widths or multiple of the widest one, bounds are aligned to multiples of width
+    """
+    epoch = datetime(1970, 1, 1, tzinfo=start.tzinfo)
+    aligned = lambda width: start - (start - epoch) % width
+    count = lambda width: max(-(-(stop - aligned(width)) // width), 1)
+    width = next((width for width in widths if count(width) <= limit), None)
+    if width is None:
+        width = widths[-1] * -(-count(widths[-1]) // (limit - 1))
+    buckets = []
+    low = start
+    edge = aligned(width) + width
+    while edge < stop:
+        buckets.append({SORT_FIELD: {'$gte': low, '$lt': edge}})
+        low = edge
+        edge += width
+    buckets.append({SORT_FIELD: {'$gte': low, '$lte': stop}})
+    return buckets
+
+
+class StreamError(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch_ordered(streams, workers=QUERY_WORKERS, queue_size=PREFETCH_SIZE):
+    """
+    Concatenation of streams in their order, the current stream and next ones (not more than workers)
+    are read ahead by threads into bounded queues - memory is bounded by (workers + 1) * queue_size rows
+    :param streams: iterable of functions without arguments, each returns iterable; it is read lazily
+    """
+    done = object()
+    stop = threading.Event()
+    streams = iter(streams)
+    queues = deque()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(stream, q):
+        try:
+            for row in stream():
+                if not put(q, row):
+                    return
+        except Exception as e:
+            put(q, StreamError(e))
+        put(q, done)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def start():
+            stream = next(streams, None)
+            if stream is not None:
+                queues.append(queue.Queue(queue_size))
+                executor.submit(with_profile(produce), stream, queues[-1])
+
+        try:
+            for _ in range(workers):
+                start()
+            while queues:
+                q = queues.popleft()
+                start()
+                while True:
+                    row = q.get()
+                    if row is done:
+                        break
+                    if isinstance(row, StreamError):
+                        raise row.exception
+                    yield row
+        finally:
+            # consumer stopped or failed - producers are finished
+            stop.set()
+
+
+def domain_pipeline(search_dict, limit=None):
+    """
+    Rows for NamecoinDomainExplorer by server: $match -> $sort -> $lookup height in Blocks -> $unwind ips -> $project
+    """
+    pipeline = [{'$match': search_dict},
+                {'$sort': {SORT_FIELD: ASCENDING}}]
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline.extend([
+        {'$lookup': {'from': COLLECTION_BLOCKS,
+                     'let': {'blockhash': '$blockhash'},
+                     'pipeline': [{'$match': {'$expr': {'$eq': ['$_id', '$$blockhash']}}},
+                                  {'$project': {'_id': 0, 'height': 1}}],
+                     'as': 'block'}},
+        {'$unwind': {'path': '$ips', 'preserveNullAndEmptyArrays': True}},
+        {'$project': {'_id': 0,
+                      'date_time': f'${SORT_FIELD}',
+                      'namecoin_domain': '$clean_name',
+                      'height': {'$arrayElemAt': ['$block.height', 0]},
+                      'hash_block': '$blockhash',
+                      'txid': 1,
+                      'short_txid': {'$substrCP': ['$txid', 0, 8]},
+                      'operation': '$clean_op',
+                      'ip': '$ips'}}])
+    return pipeline
+
+
+def flat_domain_rows(row):
+    """
+    The same rows as domain_pipeline from Tx document with height_block
+    """
+    line = {'date_time': row.get(SORT_FIELD),
+            'namecoin_domain': row.get('clean_name'),
+            'hash_block': row.get('blockhash'),
+            'txid': row['txid'],
+            'short_txid': row['txid'][:8]}
+    if 'height_block' in row:
+        line['height'] = row['height_block']
+    if 'clean_op' in row:
+        line['operation'] = row['clean_op']
+    if row.get('ips'):
+        for ip in row['ips']:
+            _line = line.copy()
+            _line['ip'] = ip
+            yield _line
+    else:
+        yield line
+
+
+def tx_pipeline(search_dict):
+    """
+    Flat transactions for lamps of transactions and addresses by server: $match -> $sort -> $project,
+    inputs - txids of vin, outputs - [value, address, op, name, value of name] for every element of vout
+    """
+    script = '$$out.scriptPubKey'
+    return [{'$match': search_dict},
+            {'$sort': {SORT_FIELD: ASCENDING}},
+            {'$project': {'_id': 0,
+                          SORT_FIELD: 1,
+                          'txid': 1,
+                          'blockhash': 1,
+                          'inputs': '$vin.txid',
+                          'outputs': {'$map': {
+                              'input': {'$ifNull': ['$vout', []]},
+                              'as': 'out',
+                              'in': ['$$out.value',
+                                     {'$cond': [{'$isArray': f'{script}.addresses'},
+                                                {'$arrayElemAt': [f'{script}.addresses', 0]}, None]},
+                                     f'{script}.nameOp.op',
+                                     f'{script}.nameOp.name',
+                                     f'{script}.nameOp.value']}}}}]
+
+
+def flat_tx(doc):
+    """
+    The same row as tx_pipeline from Tx document
+    """
+    outputs = []
+    for element in doc.get('vout') or []:
+        script = element.get('scriptPubKey') or {}
+        addresses = script.get('addresses')
+        name_op = script.get('nameOp') or {}
+        outputs.append([element.get('value'), addresses[0] if isinstance(addresses, list) and addresses else None,
+                        name_op.get('op'), name_op.get('name'), name_op.get('value')])
+    return {SORT_FIELD: doc.get(SORT_FIELD),
+            'txid': doc['txid'],
+            'blockhash': doc.get('blockhash'),
+            'inputs': [element['txid'] for element in doc.get('vin') or [] if 'txid' in element],
+            'outputs': outputs}
+
+
+def tx_rows(db, filters):
+    """
+    Flat transactions (tx_pipeline) ordered by time of block: projection by server,
+    if aggregation is not available - find_sorted and flat_tx
+    """
+    collection = db[COLLECTION_TX]
+    if id(db.client) in _no_aggregation:
+        need_fields = {'_id': 0, SORT_FIELD: 1, 'txid': 1, 'blockhash': 1, 'vin': 1, 'vout': 1}
+        yield from map(flat_tx, find_sorted(collection, filters, need_fields))
+        return
+
+    def aggregate(search_dict):
+        return collection.aggregate(tx_pipeline(search_dict), allowDiskUse=True, batchSize=BATCH_SIZE)
+
+    stage = f'{COLLECTION_TX} aggregate'
+    try:
+        with profile_stage(stage):
+            cursors = open_cursors(aggregate, filters)
+    except OperationFailure as ex:
+        print(f"aggregation is not available, projection on client: {str(ex)}")
+        _no_aggregation.add(id(db.client))
+        yield from tx_rows(db, filters)
+        return
+    find = lambda search_dict: profile_iter(stage, cursors.pop(id(search_dict), None) or aggregate(search_dict))
+    yield from merge_sorted(filters, find, SORT_FIELD, lambda row: row.get('txid'))
+
+
+# columns of tables of tx and address lamps - order of values in rows of tx_table_rows
+TXIDS_COLUMNS = ('date_time', 'hash_block', 'txid', 'short_txid', 'txid_in', 'short_txid_in')
+ADDRESSES_COLUMNS = ('date_time', 'hash_block', 'txid', 'short_txid', 'address', 'short_address', 'value',
+                     'nameOp', 'raw_name', 'value_scripts', 'namecoin_domain', 'ip')
+
+
+def bit_domain(name):
+    """
+    d/example -> example.bit, None - name is not a domain
+    """
+    if name.count(' ') == 0:
+        if name.endswith(".bit"):
+            return name
+        elif name.startswith('d/'):
+            return name[2:] + '.bit'
+
+
+def tx_table_rows(rows):
+    """
+    Flat transactions (tx_rows) -> ('txids', tuple of TXIDS_COLUMNS), ('addresses', tuple of ADDRESSES_COLUMNS)
+    """
+    for row in rows:
+        date_time, hash_block, txid = row[SORT_FIELD], row['blockhash'], row['txid']
+        short_txid = txid[:8]
+        for txid_in in row.get('inputs') or []:
+            yield 'txids', (date_time, hash_block, txid, short_txid, txid_in, txid_in[:8])
+        for value, address, op, name, value_scripts in row['outputs']:
+            domain = bit_domain(name) if name else None
+            line = (date_time, hash_block, txid, short_txid, address or '', (address or '')[:8],
+                    '' if value is None else value, op or '', name or '', value_scripts or '', domain or '')
+            ips = value_ips(value_scripts.strip()) if isinstance(value_scripts, str) else None
+            if ips:
+                for ip in ips:
+                    yield 'addresses', line + (ip,)
+            else:
+                yield 'addresses', line + ('',)
+
+
+def domain_rows(db, filters, limit=None):
+    """
+    Rows (one per ip) for NamecoinDomainExplorer ordered by time of block: join with Blocks and unwind - by server,
+    if aggregation is not available - find_sorted and with_heights
+    """
+    collection = db[COLLECTION_TX]
+    need_fields = {'clean_name': 1,
+                   'ips': 1,
+                   'clean_op': 1,
+                   SORT_FIELD: 1,
+                   'blockhash': 1,
+                   'txid': 1,
+                   '_id': 0}
+    if id(db.client) in _no_aggregation:
+        rows = with_heights(db, find_sorted(collection, filters, need_fields, limit=limit))
+        yield from (line for row in rows for line in flat_domain_rows(row))
+        return
+
+    def aggregate(search_dict):
+        return collection.aggregate(domain_pipeline(search_dict, limit), allowDiskUse=True, batchSize=BATCH_SIZE)
+
+    stage = f'{COLLECTION_TX} aggregate'
+    try:
+        # commands are executed here - error is before first row
+        with profile_stage(stage):
+            cursors = open_cursors(aggregate, filters)
+    except OperationFailure as ex:
+        print(f"aggregation is not available, join on client: {str(ex)}")
+        _no_aggregation.add(id(db.client))
+        yield from domain_rows(db, filters, limit)
+        return
+    find = lambda search_dict: profile_iter(stage, cursors.pop(id(search_dict), None) or aggregate(search_dict))
+    yield from merge_sorted(filters, find, 'date_time', lambda row: (row['txid'], row.get('ip')))
+
+
+def chain_tip(db):
+    """
+    :return: height of the last block in Blocks or None
+    """
+    with profile_stage(f'{COLLECTION_BLOCKS} tip'):
+        for row in db[COLLECTION_BLOCKS].find({}, {'_id': 0, 'height': 1}).sort('height', -1).limit(1):
+            return row.get('height')
+    return None
+
+
+def cached_domain_rows(db, query_key, filters, limit=None, confirmations=CONFIRMATIONS, tip=None):
+    """
+    domain_rows with result cache: rows of blocks deeper than confirmations from tip are not changed -
+    they are taken from cache, only rows near tip are queried (by time of block), then merged;
+    stable rows of read result (complete or its beginning) are stored for next queries. Rows, which are not
+    stored (near tip, height of block is unknown), are queried again: from the earliest of them, rows without
+    time - always
+    :param query_key: key of ResultCache - server, lamp, sorted inputs, parameters
+    :param tip: height of the last block, if it is known (one lookup for many queries)
+    """
+    if tip is None:
+        tip = chain_tip(db)
+    if tip is None:
+        yield from domain_rows(db, filters, limit)
+        return
+    stable_height = tip - confirmations
+    cache = result_cache()
+    with profile_stage('result cache'):
+        cached = cache.get(query_key)
+    row_key = lambda row: (row['txid'], row.get('ip'))
+    if cached:
+        rows, since, _ = cached
+        last_time = max((row['date_time'] for row in rows if row.get('date_time')), default=None)
+        since = min((moment for moment in (since, last_time) if moment is not None), default=None)
+        if since is not None:
+            # rows without time are not stored - null matches them
+            fresh_dict = {'$or': [{SORT_FIELD: {'$gte': since - TIME_SLACK}}, {SORT_FIELD: None}]}
+            filters = [{'$and': [search_dict, fresh_dict]} for search_dict in filters]
+        seen = set(map(row_key, rows))
+        fresh = (row for row in domain_rows(db, filters, limit) if row_key(row) not in seen)
+        result = heapq.merge(rows, fresh, key=lambda row: (row.get('date_time') is not None, row.get('date_time')))
+    else:
+        result = domain_rows(db, filters, limit)
+    stable = []
+    # the earliest row, which is not stored
+    since = None
+    try:
+        for row in result:
+            if row.get('height') is not None and row['height'] <= stable_height and row.get('date_time'):
+                if stable is not None:
+                    stable.append(row)
+                    if len(stable) > CACHED_ROWS_LIMIT:
+                        stable = None
+            elif row.get('date_time') and (since is None or row['date_time'] < since):
+                since = row['date_time']
+            # lamp changes rows - cached rows stay as they are
+            yield dict(row)
+    finally:
+        # lamp can stop reading (limit of rows) - rows are ordered by time, the rest is after the last stored row
+        if stable is not None:
+            with profile_stage('result cache'):
+                cache.put(query_key, stable, stable_height, since)
+
+
+def ensure_indexes(db, log=print):
+    """
+    Indexes for queries of lamps
+    """
+    collection = db[COLLECTION_TX]
+    for field in ['txid', 'vin.txid', 'vout.scriptPubKey.addresses', 'clean_name', 'ips', SORT_FIELD]:
+        collection.create_index([(field, ASCENDING)])
+        log(f'index {COLLECTION_TX}.{field} is ready')
+    # tip of chain for result cache
+    db[COLLECTION_BLOCKS].create_index([('height', ASCENDING)])
+    log(f'index {COLLECTION_BLOCKS}.height is ready')
+    _indexes.clear()
+
+
+def prefix_range(prefix):
+    """
+    :return: bounds of strings started with prefix - {'$gte': 'abc', '$lt': 'abd'}
+    """
+    return {'$gte': prefix, '$lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)}
+
+
+def prefix_filters(values, fields, full_length):
+    """
+    Plan for search by values or their prefixes (instead of $or of $regex):
+    full values - $in, shorter - ranges, which use index; values covered by shorter prefix are skipped
+    :param values: txids, addresses or their prefixes
+    :param fields: names of fields, document matches any of them
+    :param full_length: length of full value
+    :return: list of filters, each is bounded by BATCH_SIZE values or RANGE_BATCH_SIZE prefixes
+    """
+    prefixes = []
+    for value in sorted(set(v.strip() for v in values if v and v.strip())):
+        # sorted - shorter prefix before values started with it
+        if prefixes and value.startswith(prefixes[-1]):
+            continue
+        prefixes.append(value)
+    full = [value for value in prefixes if len(value) >= full_length]
+    short = [value for value in prefixes if len(value) < full_length]
+    filters = []
+    for chunk in chunks(full, BATCH_SIZE):
+        conditions = [{field: {'$in': chunk}} for field in fields]
+        filters.append(conditions[0] if len(conditions) == 1 else {'$or': conditions})
+    for chunk in chunks(short, RANGE_BATCH_SIZE):
+        conditions = []
+        for prefix in chunk:
+            for field in fields:
+                if field in ARRAY_FIELDS:
+                    array, element_field = ARRAY_FIELDS[field]
+                    bounds = prefix_range(prefix)
+                    conditions.append({array: {'$elemMatch': {element_field: bounds} if element_field else bounds}})
+                else:
+                    conditions.append({field: prefix_range(prefix)})
+        filters.append({'$or': conditions})
+    return filters
+
+
+def find_batches(collection, filters, need_fields, workers=QUERY_WORKERS):
+    """
+    Documents for all filters (queries are executed in parallel by shared client),
+    the same transaction from different filters - once
+    """
+    def find(search_dict):
+        with profile_stage(f'{collection.name} find'):
+            return list(collection.find(search_dict, need_fields))
+
+    seen = set()
+    if workers > 1 and len(filters) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(with_profile(find), filters))
+    else:
+        results = map(find, filters)
+    for rows in results:
+        for row in rows:
+            if 'txid' in row:
+                if row['txid'] in seen:
+                    continue
+                seen.add(row['txid'])
+            yield row
+
+
+def bulk_path(name, temp_dir=None):
+    """
+    :return: path of file of bulk mode (relative - in temp dir of task) or None
+    """
+    if not name or not name.strip():
+        return None
+    name = name.strip()
+    if temp_dir and not os.path.isabs(name):
+        return os.path.join(temp_dir, name)
+    return name
+
+
+def read_identifiers(path):
+    """
+    Stream of identifiers from file (bulk mode): one or several per line, separated by spaces, commas, semicolons
+    """
+    with open(path, encoding='utf-8', errors='ignore') as file:
+        for line in file:
+            for value in re.split(r'[\s,;]+', line):
+                if value:
+                    yield value
+
+
+class ValueSpool(object):
+    """
+    Seen values on disk (sqlite file in temp dir) - deduplication of streams, which do not fit in memory
+    """
+
+    def __init__(self, directory=None):
+        handle, self.path = tempfile.mkstemp(prefix='namecoin_spool_', suffix='.sqlite', dir=directory)
+        os.close(handle)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE seen (kind TEXT, value TEXT, PRIMARY KEY (kind, value)) WITHOUT ROWID')
+
+    def unique(self, values, kind='', batch_size=BATCH_SIZE):
+        """
+        :param kind: values of different kinds are not compared
+        :return: stream of values, which were not seen before
+        """
+        for chunk in chunks(values, batch_size):
+            fresh = []
+            with profile_stage('spool'), self.lock, self.connection:
+                for value in dict.fromkeys(chunk):
+                    if self.connection.execute('INSERT OR IGNORE INTO seen VALUES (?, ?)', (kind, value)).rowcount:
+                        fresh.append(value)
+            yield from fresh
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def bulk_filters(values, fields, full_length, spool):
+    """
+    Plan of prefix_filters for stream of identifiers of any size: values are deduplicated on the fly,
+    every BULK_BATCH_SIZE unique values - their filters
+    """
+    for chunk in chunks(spool.unique(values, ' '.join(fields)), BULK_BATCH_SIZE):
+        yield from prefix_filters(chunk, fields, full_length)
+
+
+def bulk_find(find, filters, spool, workers=QUERY_WORKERS):
+    """
+    Documents for stream of filters (bulk mode): not more than workers queries in flight, rows are read ahead
+    into bounded queues and streamed in order of filters; the same transaction from different filters - once
+    :param find: function, filter -> iterable of rows
+    """
+    streams = (lambda search_dict=search_dict: find(search_dict) for search_dict in filters)
+    for chunk in chunks(prefetch_ordered(streams, workers), BATCH_SIZE):
+        fresh = set(spool.unique((row['txid'] for row in chunk if 'txid' in row), 'txid'))
+        for row in chunk:
+            if 'txid' not in row:
+                yield row
+            elif row['txid'] in fresh:
+                fresh.discard(row['txid'])
+                yield row
+
+
+
+def bulk_tx_rows(db, values, fields, full_length, directory=None):
+    """
+    tx_rows for stream of identifiers of any size (bulk mode): identifiers are deduplicated on disk and queried
+    by batches - memory and size of query do not depend on count of identifiers
+    :param directory: directory of ValueSpool (temp dir of task)
+    """
+    with ValueSpool(directory) as spool:
+        search_dicts = bulk_filters(values, fields, full_length, spool)
+        find = lambda search_dict: tx_rows(db, [search_dict])
+        yield from bulk_find(find, search_dicts, spool)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='maintenance of NamecoinExplorer MongoDB')
+    parser.add_argument('--server', default="68.183.0.119:27017")
+    parser.add_argument('--user', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--ips-key', action='store_true', help=f'backfill {IPS_KEY_FIELD} and build index')
+    parser.add_argument('--indexes', action='store_true', help='build indexes for lamps')
+    parser.add_argument('--ips', action='store_true', help='materialize ips of name operations')
+    parser.add_argument('--trigrams', action='store_true', help=f'build {COLLECTION_NAMES} for search by substring')
+    args = parser.parse_args()
+    db = connect_to_namecoin(args.server, args.user, args.password)
+    if db is None:
+        raise SystemExit('MongoDB is not available')
+    if args.indexes:
+        ensure_indexes(db)
+    if args.ips:
+        ensure_ips(db)
+    if args.trigrams:
+        ensure_name_trigrams(db)
+    if args.ips_key:
+        ensure_ips_key(db)
@@ -0,0 +1,327 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import json
+import time
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+# fields of command, which are not part of query (explain is run by other session)
+SESSION_FIELDS = {'lsid', '$db', '$clusterTime', '$readPreference', 'txnNumber', 'autocommit', 'startTransaction',
+                  'readConcern', 'writeConcern', 'apiVersion', 'apiStrict', 'apiDeprecationErrors'}
+# not more than this count of query shapes are explained
+EXPLAIN_LIMIT = 20
+# examined documents per returned document, more - index is not selective or is missing
+EXAMINED_RATIO = 10
+
+# profile of the current lamp: lamps of other threads have their own, worker threads get it by with_profile
+_profile = contextvars.ContextVar('namecoin_profile', default=None)
+
+
+class QueryProfile(object):
+    """
+    opt-in profile of lamp: time of stages (connect, queries of collections, writing of rows, the rest -
+    Python), commands of MongoDB by command monitoring (count, time, returned documents), plans of query
+    shapes by explain() (examined keys and documents, used indexes)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.thread = threading.get_ident()
+        self.begin = time.perf_counter()
+        # name -> [count, seconds], self time - without nested stages
+        self.stages = {}
+        self.parallel = set()
+        # (command, collection) -> [count, seconds, returned documents]
+        self.commands = {}
+        # request id -> key of command; cursor id -> key of command, which opened it
+        self.requests = {}
+        self.cursors = {}
+        # (collection, shape) -> (client, database, command) - the first command of every shape
+        self.queries = {}
+
+    # region stages
+    def enter(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(0.0)
+
+    def leave(self, name, elapsed):
+        stack = self.local.stack
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0])
+            stage[0] += 1
+            stage[1] += elapsed - nested
+            if threading.get_ident() != self.thread:
+                self.parallel.add(name)
+    # endregion
+
+    # region command monitoring
+    def started(self, client, event):
+        command = event.command
+        name = event.command_name
+        collection = command.get(name) if name != 'getMore' else command.get('collection')
+        if name == 'getMore':
+            key = self.cursors.get(command.get('getMore'), (name, collection))
+        else:
+            key = (name, collection)
+        with self.lock:
+            self.requests[event.request_id] = key
+            if name in ('find', 'aggregate', 'count', 'distinct'):
+                query = {field: value for field, value in command.items() if field not in SESSION_FIELDS}
+                shape = query_shape(query.get('filter') or query.get('pipeline') or query.get('query'))
+                self.queries.setdefault((collection, name, shape), (client, event.database_name, query))
+
+    def succeeded(self, event):
+        with self.lock:
+            key = self.requests.pop(event.request_id, (event.command_name, None))
+            command = self.commands.setdefault(key, [0, 0.0, 0])
+            command[0] += 1
+            command[1] += event.duration_micros / 1e6
+            cursor = event.reply.get('cursor') if isinstance(event.reply, dict) else None
+            if isinstance(cursor, dict):
+                command[2] += len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+                if cursor.get('id'):
+                    self.cursors[cursor['id']] = key
+
+    def failed(self, event):
+        with self.lock:
+            key = self.requests.pop(event.request_id, (event.command_name, None))
+            command = self.commands.setdefault(key, [0, 0.0, 0])
+            command[0] += 1
+            command[1] += event.duration_micros / 1e6
+    # endregion
+
+    def explain(self, limit=EXPLAIN_LIMIT):
+        """
+        :return: list of (collection, command, shape, plan) for recorded query shapes,
+                 plan - dict of examined keys, documents, returned documents, stages and indexes or error
+        """
+        result = []
+        for (collection, name, shape), (client, database, query) in list(self.queries.items())[:limit]:
+            try:
+                answer = client[database].command({'explain': query, 'verbosity': 'executionStats'})
+            except PyMongoError as e:
+                result.append((collection, name, shape, {'error': str(e)}))
+                continue
+            stats = find_key(answer, 'executionStats') or {}
+            stages, indexes = set(), set()
+            plan_stages(find_key(answer, 'queryPlanner') or {}, stages, indexes)
+            result.append((collection, name, shape, {'keys': stats.get('totalKeysExamined'),
+                                                     'docs': stats.get('totalDocsExamined'),
+                                                     'returned': stats.get('nReturned'),
+                                                     'stages': sorted(stages),
+                                                     'indexes': sorted(indexes)}))
+        return result
+
+    def report(self, log):
+        """
+        Summary of profile - lines of tables by log (log_writer.info)
+        """
+        wall = time.perf_counter() - self.begin
+        with self.lock:
+            stages = dict(self.stages)
+            commands = dict(self.commands)
+        log(f'profile: {wall:.3f} sec.')
+        log(f'{"stage":<32}{"count":>10}{"sec.":>12}{"%":>8}')
+        measured = 0.0
+        for name, (count, seconds) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            if name in self.parallel:
+                # time of other threads - overlaps with stages of main thread
+                name += ' (parallel)'
+            else:
+                measured += seconds
+            log(f'{name:<32}{count:>10}{seconds:>12.3f}{100 * seconds / wall if wall else 0:>8.1f}')
+        rest = max(wall - measured, 0.0)
+        log(f'{"python (rows of lamp)":<32}{"":>10}{rest:>12.3f}{100 * rest / wall if wall else 0:>8.1f}')
+        if commands:
+            log(f'{"command of MongoDB":<32}{"count":>10}{"sec.":>12}{"returned":>12}')
+            for (name, collection), (count, seconds, returned) in sorted(commands.items(),
+                                                                         key=lambda item: -item[1][1]):
+                title = f'{name} {collection}' if collection else name
+                log(f'{title:<32}{count:>10}{seconds:>12.3f}{returned:>12}')
+        for collection, name, shape, plan in self.explain():
+            log(f'plan {name} {collection}: {shape}')
+            if 'error' in plan:
+                log(f'    explain is not available: {plan["error"]}')
+                continue
+            log(f'    keys examined: {plan["keys"]}, documents examined: {plan["docs"]}, '
+                f'returned: {plan["returned"]}, stages: {",".join(plan["stages"])}, '
+                f'indexes: {",".join(plan["indexes"]) or "-"}')
+            if 'COLLSCAN' in plan['stages']:
+                log('    COLLSCAN - index is missing')
+            elif plan['docs'] and plan['docs'] > EXAMINED_RATIO * max(plan['returned'] or 0, 1):
+                log('    many documents are examined for returned ones - index is not selective')
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    Listener of one MongoClient (set in init_connect_to_mongodb), commands are recorded only when profile is started
+    """
+
+    def __init__(self):
+        self.client = None
+
+    def started(self, event):
+        profile = _profile.get()
+        if profile is not None and self.client is not None:
+            profile.started(self.client, event)
+
+    def succeeded(self, event):
+        profile = _profile.get()
+        if profile is not None:
+            profile.succeeded(event)
+
+    def failed(self, event):
+        profile = _profile.get()
+        if profile is not None:
+            profile.failed(event)
+
+
+def query_shape(query):
+    """
+    Query without values: {"ips": {"$in": ["1.2.3.4"]}} -> {"ips": {"$in": "?"}}
+    """
+    def strip(value):
+        if isinstance(value, dict):
+            return {key: strip(element) for key, element in value.items()}
+        if isinstance(value, list) and value and all(isinstance(element, dict) for element in value):
+            return [strip(element) for element in value]
+        return '?'
+
+    return json.dumps(strip(query), sort_keys=True, default=str)
+
+
+def find_key(doc, key):
+    """
+    The first value of key in nested documents of explain (aggregate has plan inside $cursor stage)
+    """
+    if isinstance(doc, dict):
+        if key in doc:
+            return doc[key]
+        values = doc.values()
+    elif isinstance(doc, list):
+        values = doc
+    else:
+        return None
+    for value in values:
+        found = find_key(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def plan_stages(plan, stages, indexes):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+        if 'indexName' in plan:
+            indexes.add(plan['indexName'])
+        values = plan.values()
+    elif isinstance(plan, list):
+        values = plan
+    else:
+        return
+    for value in values:
+        plan_stages(value, stages, indexes)
+
+
+def with_profile(function):
+    """
+    Function for worker thread (executor): it records into profile of the current lamp
+    """
+    profile = _profile.get()
+    if profile is None:
+        return function
+
+    def wrapper(*args, **kwargs):
+        token = _profile.set(profile)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _profile.reset(token)
+    return wrapper
+
+
+@contextmanager
+def profile_stage(name):
+    """
+    Time of block as stage of profile, without profile - nothing
+    """
+    profile = _profile.get()
+    if profile is None:
+        yield
+        return
+    profile.enter()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.leave(name, time.perf_counter() - start)
+
+
+def profile_iter(name, iterable):
+    """
+    Time of reading of rows (cursor) as stage of profile, without profile - iterable as is
+    """
+    profile = _profile.get()
+    if profile is None:
+        return iterable
+    return _timed_iter(profile, name, iter(iterable))
+
+
+def _timed_iter(profile, name, iterator):
+    while True:
+        profile.enter()
+        start = time.perf_counter()
+        try:
+            row = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            profile.leave(name, time.perf_counter() - start)
+        yield row
+
+
+class TimedWriter(object):
+    """
+    result_writer of lamp, write_line is stage "write"
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write_line(self, *args, **kwargs):
+        with profile_stage('write'):
+            return self.writer.write_line(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def profiled(execute):
+    """
+    Decorator of Task.execute: enter param "profile" - stages, commands and plans of queries are recorded,
+    summary is written by log_writer at the end
+    """
+    @functools.wraps(execute)
+    def wrapper(self, enter_params, result_writer, log_writer, temp_dir=None):
+        if not getattr(enter_params, 'profile', False):
+            return execute(self, enter_params, result_writer, log_writer, temp_dir)
+        profile = QueryProfile()
+        token = _profile.set(profile)
+        try:
+            return execute(self, enter_params, TimedWriter(result_writer), log_writer, temp_dir)
+        finally:
+            _profile.reset(token)
+            profile.report(log_writer.info)
+    return wrapper
@@ -0,0 +1,211 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import json
+import random
+import functools
+import threading
+import asyncio
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+# region load Namecoin block cache
+try:
+    from NamecoinCache import block_cache
+except ImportError as cache_exception:
+    print('...missing or invalid NamecoinCache')
+    raise cache_exception
+# endregion
+
+POOL_SIZE = 16
+TIMEOUT = 30
+# max. count of calls in one batch request
+RPC_BATCH_SIZE = 500
+# names in one name_history batch of crawler
+NAMES_BATCH_SIZE = 50
+# seconds for one call of crawler, timeout of its requests - DEADLINE / (RETRIES + 1)
+DEADLINE = 30
+RETRIES = 3
+# first delay before retry, seconds (random in [0, RETRY_DELAY * 2^attempt])
+RETRY_DELAY = 0.5
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class NamecoinRPCError(Exception):
+    pass
+
+
+class NamecoinRPC(object):
+    """
+    JSON-RPC client of namecoind: one keep-alive session (pool of connections) per server,
+    several calls - in one JSON-RPC 2.0 batch request
+    """
+
+    def __init__(self, server, user, password, pool_size=POOL_SIZE, timeout=TIMEOUT):
+        self.server = server
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(user, password)
+        self.session.headers.update({'content-type': 'text/plain'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, payload, timeout=None):
+        response = self.session.post(self.server, data=json.dumps(payload), timeout=timeout or self.timeout)
+        try:
+            return response.json()
+        except ValueError:
+            raise NamecoinRPCError(f'bad answer of server: {response.status_code}')
+
+    def call(self, method, *params, timeout=None):
+        data = self.post({"method": method, "params": list(params), "jsonrpc": "2.0", "id": 0}, timeout)
+        if data.get('error'):
+            raise NamecoinRPCError(data['error'])
+        return data.get('result')
+
+    def batch(self, method, params_list, timeout=None):
+        """
+        :param params_list: list of params for every call of method
+        :param timeout: timeout of requests, None - timeout of client
+        :return: list of results in the same order, None - for failed call
+        """
+        results = []
+        for start in range(0, len(params_list), RPC_BATCH_SIZE):
+            chunk = params_list[start:start + RPC_BATCH_SIZE]
+            payload = [{"method": method, "params": list(params), "jsonrpc": "2.0", "id": i}
+                       for i, params in enumerate(chunk)]
+            data = self.post(payload, timeout)
+            if not isinstance(data, list):
+                raise NamecoinRPCError(data.get('error') if isinstance(data, dict) else data)
+            answers = {answer.get('id'): answer for answer in data}
+            results.extend(answers.get(i, {}).get('result') for i in range(len(chunk)))
+        return results
+
+    def blocks(self, heights, timeout=None):
+        """
+        (hash, time) of blocks: from block cache, unknown - two batch requests (getblockhash, getblockheader),
+        confirmed blocks are stored in cache
+        :return: dict height -> (hash, time)
+        """
+        cache = block_cache()
+        result = cache.blocks(heights)
+        need = [height for height in set(heights) if height not in result]
+        if not need:
+            return result
+        hashes = self.batch('getblockhash', [[height] for height in need], timeout)
+        known = [(height, blockhash) for height, blockhash in zip(need, hashes) if blockhash]
+        headers = self.batch('getblockheader', [[blockhash] for _, blockhash in known], timeout)
+        rows = []
+        for (height, blockhash), header in zip(known, headers):
+            if header and 'time' in header:
+                result[height] = (blockhash, header['time'])
+                rows.append((height, blockhash, header['time'], header.get('confirmations', 0)))
+        cache.put(rows)
+        return result
+
+
+def rpc_client(server, user, password):
+    """
+    One client (session) per server and user in process
+    """
+    key = (server, user, password)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = NamecoinRPC(server, user, password)
+        return _clients[key]
+
+
+async def call_with_retry(executor, function, *args, deadline=DEADLINE, retries=RETRIES):
+    """
+    Blocking call of client in executor with deadline, failed call is repeated after random (jitter) delay;
+    wait_for does not stop thread of executor - timeout of requests of every attempt is deadline / (retries + 1),
+    so blocking call returns by itself
+    :param function: method of client with timeout argument
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(function, *args, timeout=deadline / (retries + 1))
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(executor, call), deadline)
+        except (asyncio.TimeoutError, requests.RequestException, NamecoinRPCError):
+            if attempt == retries:
+                raise
+            await asyncio.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+
+
+async def history_batch(rpc, executor, values, deadline, retries):
+    """
+    :return: list of (name, history or None, blocks of history: height -> (hash, time))
+    """
+    histories = await call_with_retry(executor, rpc.batch, 'name_history', [[value] for value in values],
+                                      deadline=deadline, retries=retries)
+    heights = [row['height'] for history in histories if isinstance(history, list)
+               for row in history if 'height' in row]
+    try:
+        blocks = await call_with_retry(executor, rpc.blocks, heights, deadline=deadline, retries=retries)
+    except (asyncio.TimeoutError, requests.RequestException, NamecoinRPCError) as e:
+        # histories are kept, only times of blocks are lost - cached blocks
+        print(f'errors with service, blocks of history...:{e!r}')
+        blocks = block_cache().blocks(heights)
+    return [(value, history, blocks) for value, history in zip(values, histories)]
+
+
+async def crawl_names(rpc, values, concurrency=8, batch_size=NAMES_BATCH_SIZE, deadline=DEADLINE,
+                      retries=RETRIES):
+    """
+    name_history of many names: batches of batch_size names, not more than concurrency batches in flight,
+    results - as soon as batch is done
+    :return: async generator of (name, history or None, blocks)
+    """
+    batches = iter([values[start:start + batch_size] for start in range(0, len(values), batch_size)])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        try:
+            while True:
+                while len(pending) < concurrency:
+                    chunk = next(batches, None)
+                    if chunk is None:
+                        break
+                    task = asyncio.ensure_future(history_batch(rpc, executor, chunk, deadline, retries))
+                    pending[task] = chunk
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    chunk = pending.pop(task)
+                    if task.exception():
+                        print(f'errors with service...:{task.exception()!r}')
+                        for value in chunk:
+                            yield value, None, {}
+                    else:
+                        for result in task.result():
+                            yield result
+        finally:
+            # consumer stopped before the end
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def names_history(server, user, password, values, concurrency=8, **kwargs):
+    """
+    Stream of crawl_names for not async code: event loop runs while next result is waited,
+    so consumer controls the pace
+    """
+    rpc = rpc_client(server, user, password)
+    loop = asyncio.new_event_loop()
+    results = crawl_names(rpc, list(values), concurrency, **kwargs)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import time
+import datetime
+
+# region load Namecoin index and RPC
+try:
+    from NamecoinIndex import open_index, INDEX_PATH, EPOCH
+    from NamecoinMongoDB import INDEX_SCHEME
+    from NamecoinRPC import rpc_client, NamecoinRPCError
+    from NamecoinValues import transaction_ips
+except ImportError as index_exception:
+    print('...missing or invalid NamecoinIndex, NamecoinRPC, NamecoinValues')
+    raise index_exception
+# endregion
+
+# blocks in one getblock batch and one sqlite transaction
+SYNC_BATCH_SIZE = 50
+# the deepest reorganization, which is rolled back
+REORG_DEPTH = 100
+POLL_INTERVAL = 10
+
+
+def transaction_doc(tx, block):
+    """
+    Document of Tx (layout of NamecoinExplorer MongoDB) from transaction of getblock (verbosity 2)
+    """
+    doc = {field: tx[field] for field in ('txid', 'hash', 'version', 'size', 'vsize', 'locktime', 'vin', 'vout')
+           if field in tx}
+    doc['blockhash'] = block['hash']
+    doc['clean_datetime_block'] = EPOCH + datetime.timedelta(seconds=block['time'])
+    for element in doc.get('vout', []):
+        script = element.get('scriptPubKey', {})
+        # newer namecoind - one "address"
+        if 'address' in script and 'addresses' not in script:
+            script['addresses'] = [script['address']]
+        name_op = script.get('nameOp')
+        if name_op and 'clean_name' not in doc:
+            doc['clean_op'] = name_op.get('op')
+            if 'name' in name_op:
+                doc['clean_name'] = name_op['name']
+    ips = transaction_ips(doc)
+    if ips:
+        doc['ips'] = ips
+    return doc
+
+
+def chain_break(heights, blocks, previous):
+    """
+    :param previous: hash of block before the first block
+    :return: height of the first block, which has other height or does not continue previous block, None - no break
+    """
+    for height, block in zip(heights, blocks):
+        if block.get('height') != height or (height > 0 and block.get('previousblockhash') != previous):
+            return height
+        previous = block.get('hash')
+    return None
+
+
+class ChainSync(object):
+    """
+    Incremental synchronization of local index with namecoind: only new blocks are fetched
+    (SYNC_BATCH_SIZE blocks per batch request and per sqlite transaction), blocks orphaned by
+    reorganization are rolled back before new blocks are added
+    """
+
+    def __init__(self, index, rpc, batch_size=SYNC_BATCH_SIZE, log=print):
+        self.index = index
+        self.rpc = rpc
+        self.batch_size = batch_size
+        self.log = log
+
+    def fork_height(self, tip):
+        """
+        :return: height of the last block of index, which is in chain of node
+        """
+        height = min(self.index.last_height(), tip)
+        if height < 0:
+            return height
+        heights = list(range(max(0, height - REORG_DEPTH + 1), height + 1))
+        local = self.index.block_hashes(heights)
+        remote = self.rpc.batch('getblockhash', [[h] for h in heights])
+        for h, blockhash in reversed(list(zip(heights, remote))):
+            if local.get(h) == blockhash:
+                return h
+        raise NamecoinRPCError(f'reorganization is deeper than {REORG_DEPTH} blocks, index has to be rebuilt')
+
+    def sync(self):
+        """
+        :return: count of added blocks
+        """
+        tip = self.rpc.call('getblockcount')
+        last = self.index.last_height()
+        fork = self.fork_height(tip)
+        if fork < last:
+            self.log(f'reorganization: blocks {fork + 1}..{last} are rolled back')
+            self.index.rollback(fork)
+        previous = self.index.block_hashes([fork]).get(fork)
+        added = 0
+        for start in range(fork + 1, tip + 1, self.batch_size):
+            heights = list(range(start, min(start + self.batch_size, tip + 1)))
+            hashes = self.rpc.batch('getblockhash', [[h] for h in heights])
+            blocks = self.rpc.batch('getblock', [[blockhash, 2] for blockhash in hashes if blockhash])
+            if len(blocks) != len(heights) or not all(blocks):
+                self.log(f'blocks {heights[0]}..{heights[-1]} are not available, sync is stopped')
+                break
+            # hashes and blocks are fetched by two requests - batch can be from two chains
+            changed = chain_break(heights, blocks, previous)
+            if changed is not None:
+                # chain is changed while sync - next sync rolls it back
+                self.log(f'chain is changed at {changed}, sync is stopped')
+                break
+            self.write(blocks)
+            previous = blocks[-1]['hash']
+            added += len(blocks)
+            self.log(f'height {heights[-1]} of {tip}')
+        return added
+
+    def write(self, blocks):
+        index = self.index
+        with index.write_lock, index.connection as connection:
+            index.add_blocks([(block['hash'], block['height'], block['time']) for block in blocks], connection)
+            index.add_transactions((transaction_doc(tx, block) for block in blocks for tx in block.get('tx', [])
+                                    if isinstance(tx, dict)), connection)
+            index.set_meta('height', blocks[-1]['height'], connection)
+
+    def follow(self, interval=POLL_INTERVAL):
+        while True:
+            try:
+                self.sync()
+            except (NamecoinRPCError, OSError) as e:
+                self.log(f'errors with service...:{e}')
+            time.sleep(interval)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='incremental synchronization of local index with namecoind')
+    parser.add_argument('--path', default=INDEX_PATH)
+    parser.add_argument('--server', default='http://127.0.0.1:8336', help='JSON-RPC of namecoind')
+    parser.add_argument('--user', default='user')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--follow', action='store_true', help=f'poll node every {POLL_INTERVAL} sec.')
+    args = parser.parse_args()
+    chain_sync = ChainSync(open_index(INDEX_SCHEME + args.path), rpc_client(args.server, args.user, args.password))
+    if args.follow:
+        chain_sync.follow()
+    else:
+        print(chain_sync.sync(), 'blocks are added')
@@ -0,0 +1,83 @@
+# -*- coding: utf8 -*-
+__author__ = 'sai'
+
+import re
+import json
+import ipaddress
+from functools import lru_cache
+
+# values of names are repeated in history and in outputs of transactions
+VALUE_CACHE_SIZE = 65536
+# nesting of "map" (subdomains)
+MAP_DEPTH = 8
+
+ipv4_pattern = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
+
+
+def valid_ips(candidates, result):
+    """
+    :param candidates: str or list of str
+    :param result: dict (ordered set), valid ips are added
+    """
+    if isinstance(candidates, str):
+        # "1.2.3.4, 5.6.7.8" or one address (IPv6 too)
+        candidates = ipv4_pattern.findall(candidates) or [candidates]
+    if not isinstance(candidates, list):
+        return
+    for candidate in candidates:
+        if not isinstance(candidate, str):
+            continue
+        try:
+            result[str(ipaddress.ip_address(candidate.strip()))] = None
+        except ValueError:
+            continue
+
+
+def domain_ips(data, result, depth=0):
+    """
+    ips of d/ value (JSON object): "ip", "ip6", "ns" and "translate" given by address, "map" - recursively
+    """
+    valid_ips(data.get('ip'), result)
+    valid_ips(data.get('ip6'), result)
+    valid_ips(data.get('ns'), result)
+    valid_ips(data.get('translate'), result)
+    subdomains = data.get('map')
+    if isinstance(subdomains, dict) and depth < MAP_DEPTH:
+        for subdomain in subdomains.values():
+            if isinstance(subdomain, dict):
+                domain_ips(subdomain, result, depth + 1)
+            else:
+                # old form of map: {"": "1.2.3.4"}
+                valid_ips(subdomain, result)
+
+
+@lru_cache(maxsize=VALUE_CACHE_SIZE)
+def value_ips(value):
+    """
+    ips of value of name, compiled once and memoized by value;
+    value is not JSON object - all IPv4-like strings of it
+    :return: tuple of unique ips in order of value
+    """
+    result = {}
+    try:
+        # strict=False - new lines and tabs inside strings of values
+        data = json.loads(value, strict=False)
+    except (ValueError, TypeError):
+        data = None
+    if isinstance(data, dict):
+        domain_ips(data, result)
+    elif isinstance(value, str):
+        valid_ips(ipv4_pattern.findall(value), result)
+    return tuple(result)
+
+
+def transaction_ips(doc):
+    """
+    ips of name operation of transaction (document of Tx) - for ips at ingestion
+    """
+    result = {}
+    for element in doc.get('vout', []):
+        name_op = element.get('scriptPubKey', {}).get('nameOp') or {}
+        if isinstance(name_op.get('value'), str):
+            result.update(dict.fromkeys(value_ips(name_op['value'])))
+    return list(result)
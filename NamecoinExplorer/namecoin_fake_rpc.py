@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -
+
+#
+# In-process fake namecoind (JSON-RPC over HTTP: name_history, getblockhash, getblockheader, getblock)
+# with synthetic names for offline benchmarks of Blockchain_Namecoin_find_by_name_RPC.py
+#
+# run benchmarks:  python namecoin_fake_rpc.py
+#                  python namecoin_fake_rpc.py --names 50000 --latency 5 --errors 1
+#
+# lamp imports ontology, so root of repository must be in sys.path
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TIP = 500000
+FIRST_TIME = 1300000000
+
+
+def block_hash(height):
+    return hashlib.sha256(str(height).encode()).hexdigest()
+
+
+class FakeChain(object):
+    """
+    names d/name0 .. d/name{count-1}, every name - several updates with ip in value
+    """
+
+    def __init__(self, history=5):
+        self.history = history
+        self.heights = {block_hash(height): height for height in range(TIP + 1)}
+
+    def name_history(self, name):
+        if not name.startswith('d/name'):
+            raise KeyError(name)
+        rnd = random.Random(name)
+        rows = []
+        for i in range(self.history):
+            height = rnd.randint(1, TIP)
+            txid = hashlib.sha256(f'{name}{i}'.encode()).hexdigest()
+            ip = f'10.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}'
+            rows.append({'name': name, 'value': json.dumps({'ip': ip}), 'txid': txid, 'vout': 0,
+                         'address': 'N' + txid[:33], 'height': height, 'expires_in': 36000 - (TIP - height),
+                         'expired': TIP - height > 36000})
+        return sorted(rows, key=lambda row: row['height'])
+
+    @staticmethod
+    def header(blockhash, height):
+        return {'hash': blockhash, 'height': height, 'time': FIRST_TIME + height * 600,
+                'confirmations': TIP - height + 1}
+
+    def dispatch(self, call):
+        method, params = call.get('method'), call.get('params', [])
+        try:
+            if method == 'name_history':
+                result = self.name_history(params[0])
+            elif method == 'getblockhash':
+                if not 0 <= params[0] <= TIP:
+                    raise KeyError(params[0])
+                result = block_hash(params[0])
+            elif method in ('getblockheader', 'getblock'):
+                height = self.heights[params[0]]
+                result = self.header(params[0], height)
+            else:
+                return {'result': None, 'error': {'code': -32601, 'message': 'Method not found'}, 'id': call.get('id')}
+        except (KeyError, IndexError, TypeError, ValueError):
+            return {'result': None, 'error': {'code': -8, 'message': 'not found'}, 'id': call.get('id')}
+        return {'result': result, 'error': None, 'id': call.get('id')}
+
+
+class FakeRPCHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.stats_lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if random.random() < server.errors:
+            # overloaded server - client has to retry
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if isinstance(data, list):
+            answer = [server.chain.dispatch(call) for call in data]
+        else:
+            answer = server.chain.dispatch(data)
+        body = json.dumps(answer).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeRPCServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, chain, latency=0.0, errors=0.0):
+        super().__init__(('127.0.0.1', 0), FakeRPCHandler)
+        self.chain = chain
+        self.latency = latency
+        self.errors = errors
+        self.requests = 0
+        self.stats_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def benchmark(lamp, names=500, threads=8, latency=0.0, errors=0.0):
+    import NamecoinCache
+
+    NamecoinCache.BLOCKS_CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'blocks.sqlite')
+
+    class LogFake:
+        @classmethod
+        def info(cls, message, *args):
+            pass
+
+    domains = [f'name{i}.bit' for i in range(names)]
+    with FakeRPCServer(FakeChain(), latency, errors) as server:
+        for title in ('cold block cache', 'warm block cache'):
+            server.requests = 0
+            start = time.perf_counter()
+            rows = sum(1 for _ in lamp.return_massive_about_domains(domains, server.url, threads, LogFake,
+                                                                    'user', 'password'))
+            elapsed = time.perf_counter() - start
+            print(f'{"names, " + title:<32} {names / elapsed:>12.0f} names/sec. {rows / elapsed:>12.0f} rows/sec. '
+                  f'{server.requests} http requests')
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import Blockchain_Namecoin_find_by_name_RPC
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--names', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of every http request, ms')
+    parser.add_argument('--errors', type=float, default=0.0, help='http requests answered by 503, percent')
+    args = parser.parse_args()
+    benchmark(Blockchain_Namecoin_find_by_name_RPC, args.names, args.threads, args.latency / 1000, args.errors / 100)